@@ -1,11 +1,18 @@
 #type: ignore
 
-from flask import Flask,request,jsonify, Response
-from main import setup, add_note, get_note, delete_note, health_check
+from flask import Flask,request,jsonify, Response, stream_with_context, g
+from main import setup, add_note, add_notes, get_note, get_notes, stream_notes, NoteStream, get_notes_page, search_notes, search_titles, autocomplete, delete_note, delete_notes, health_check
 from typing import Optional, Tuple
-from functools import wraps
+from functools import wraps, partial
+from json import dumps
+from time import perf_counter, time
+from cProfile import Profile
 import os
+import re
 from main import ErrorCode
+from metrics import REGISTRY, CONTENT_TYPE
+from tracing import TRACER, Span
+from profiling import PROFILES, SORTS, SAMPLER, profile_stream, collapse
 
 
 #----------------
@@ -19,7 +26,8 @@ ERROR_MAP = {
     ErrorCode.NOT_FOUND_USE_LOCAL:  (200, "Using local data as fallback (remote not found)"),
     ErrorCode.PERMISSION_DENIED_USE_LOCAL: (200, "Using local data as fallback (permission denied)"),
     ErrorCode.SERVER_ERROR_USE_LOCAL: (200, "Using local data as fallback (server error)"),
-    ErrorCode.SETUP_REQUIRED: (403, "Setup must be run first.")
+    ErrorCode.SETUP_REQUIRED: (403, "Setup must be run first."),
+    ErrorCode.INDEX_NOT_READY: (503, "Search index is not ready yet.")
 }
 
 
@@ -29,8 +37,82 @@ ERROR_MAP = {
 #----------------
 
 app = Flask(__name__)
+
+#Keep keys in the order main.py built them, so a page of notes comes back in id order rather than sorted as strings.
+app.json.sort_keys = False
 API_key = os.getenv("API_KEY", "default_key")
 
+#Sent as X-ADMIN-KEY to profile a request or read profiles back. Without it, both are turned off.
+ADMIN_KEY = os.getenv("ADMIN_KEY") or None
+
+#How many request profiles are kept in memory, and an optional folder they're also written to as .prof files.
+PROFILES.configure(int(os.getenv("PROFILE_KEEP") or 20),os.getenv("PROFILE_DIR") or None)
+
+#Longest window /profiles/sample will sample for, in seconds.
+SAMPLE_MAX_SECONDS = float(os.getenv("SAMPLE_MAX_SECONDS") or 60)
+
+#Streamed listings are sent in pieces of roughly this many bytes.
+STREAM_BUFFER = int(os.getenv("STREAM_BUFFER") or 64 * 1024)
+
+
+#----------
+#Request Metrics and Traces
+#-----------
+
+#Routes that aren't traced, so scrapes and reading traces don't crowd out the requests being looked at.
+UNTRACED = ("/metrics","/traces","/traces/<trace_id>","/profiles","/profiles/<profile_id>","/profiles/sample")
+
+REQUESTS = REGISTRY.counter("http_requests_total","Requests answered, by route, method and status.",("route","method","status"))
+REQUEST_SECONDS = REGISTRY.histogram("http_request_duration_seconds","Time from the request arriving to the last byte of the response.",("route","method"))
+IN_FLIGHT = REGISTRY.gauge("http_requests_in_flight","Requests being handled right now.",("route","method"))
+
+@app.before_request
+def start_request_metrics():
+    """Note when the request arrived and count it as in flight.
+    """
+    #The rule, not the path, so /notes?id=1 and /notes?id=2 are one series.
+    g.route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    g.started = perf_counter()
+    g.status = 500
+    IN_FLIGHT.inc(route=g.route,method=request.method)
+
+    #Every storage call made while handling the request becomes a child of this span.
+    if TRACER.enabled and g.route not in UNTRACED:
+        g.trace = TRACER.start_trace(f"{request.method} {g.route}",path=request.path)
+
+@app.after_request
+def note_status(response:Response) -> Response:
+    """Record the request once the response is closed. For streamed listings that's after the last chunk is sent.
+    Teardown is no good for that, since it first runs as soon as the view returns.
+    """
+    if "trace" in g:
+        response.headers["X-Trace-Id"] = g.trace.trace_id
+
+    #Taken out of g, so teardown knows the request is already taken care of.
+    response.call_on_close(partial(finish_request,g.pop("started",None),g.route,request.method,response.status_code,g.pop("trace",None)))
+    return response
+
+@app.teardown_request
+def finish_unanswered(exc):
+    """Record a request that never got as far as a response, e.g. because its error handler raised.
+    """
+    started = g.pop("started",None)
+    if started is not None:
+        finish_request(started,g.route,request.method,g.status,g.pop("trace",None),exc)
+
+def finish_request(started:Optional[float], route:str, method:str, status:int, trace:Optional[Span], exc:Optional[BaseException] = None):
+    """Count the request as answered, time it, and close its trace.
+    """
+    if started is None:
+        return
+
+    IN_FLIGHT.dec(route=route,method=method)
+    REQUEST_SECONDS.observe(perf_counter() - started,route=route,method=method)
+    REQUESTS.inc(route=route,method=method,status=status)
+
+    if trace is not None:
+        trace.set(status=status)
+        TRACER.finish(trace,exc)
 
 #----------
 #Wrapper Functions
@@ -84,7 +166,12 @@ def handle_response(key: str = None):
 
 
                     if result[0]:
-                        return jsonify({"success": result[0],"notes":result[2]})
+
+                        #Listings that ask to be streamed are sent as they're read instead of built up first.
+                        if isinstance(result[2],NoteStream):
+                            return Response(stream_with_context(stream_json(key,result[2])),mimetype="application/json")
+
+                        return jsonify({"success": result[0],key:result[2]})
                     
                     else:
                         code, err = map_error(result[1])
@@ -94,12 +181,51 @@ def handle_response(key: str = None):
                             return  jsonify({"success": True,"message":err}), code
                         
                         return jsonify({"success": result[0],"error":err}), code
+
+            #This is for our paged get
+            elif len(result) == 4:
+
+                if result[0]:
+                    return jsonify({"success": result[0],"notes":result[2],"next_cursor":result[3]})
+
+                code, err = map_error(result[1])
+                return jsonify({"success": result[0],"error":err}), code
         
             return jsonify({"success": False,"error":"Unknown error"}), 500
 
         return wrapper
     return decorator
 
+def stream_json(key: str, items):
+    """
+    Generator that writes {"success": true, key: {...}} one item at a time.
+
+    -Each item is serialized on its own, so the whole listing is never one string in memory.
+    -Pieces are buffered up to STREAM_BUFFER bytes, so the client isn't sent one tiny chunk per note.
+
+    Args:
+        key (str): Key to put the items under.
+        items (Iterator): (id, value) pairs.
+    """
+    buffer = ['{"success": true, ' + dumps(key) + ': {']
+    size = 0
+    separator = ""
+
+    for id, value in items:
+        part = separator + dumps(id) + ": " + dumps(value)
+        separator = ", "
+
+        buffer.append(part)
+        size += len(part)
+
+        if size >= STREAM_BUFFER:
+            yield "".join(buffer)
+            buffer = []
+            size = 0
+
+    buffer.append("}}")
+    yield "".join(buffer)
+
 def require_api_key(func):
     """
     Decorator for Flask endpoints.
@@ -113,9 +239,95 @@ def require_api_key(func):
 
         if key != API_key:
             return jsonify({"success": False,"error":"Unauthorized"}), 401
+
+        #An admin can have this one request run under cProfile.
+        if request.headers.get("X-Profile") == "1":
+            if not is_admin():
+                return jsonify({"success": False,"error":"Admin key required to profile."}), 403
+
+            return run_profiled(func,*args,**kwargs)
         
         return func(*args,**kwargs)
     return wrapper
+
+def is_admin() -> bool:
+    """Check the X-ADMIN-KEY header. Always False if ADMIN_KEY isn't set.
+    """
+    return ADMIN_KEY is not None and request.headers.get("X-ADMIN-KEY") == ADMIN_KEY
+
+def require_admin_key(func):
+    """
+    Decorator for Flask endpoints.
+
+    -Handles checking of the admin key, for endpoints that show the server's internals.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not is_admin():
+            return jsonify({"success": False,"error":"Unauthorized"}), 401
+
+        return func(*args,**kwargs)
+    return wrapper
+
+def parse_seconds(value:Optional[str], default:float, most:float) -> Optional[float]:
+    """
+    Returns:
+        Optional[float]: The value, or default if it's missing. None if it isn't a number above 0 and at most most.
+    """
+    if value is None:
+        return default
+
+    try:
+        seconds = float(value)
+    except ValueError:
+        return None
+
+    return seconds if 0 < seconds <= most else None
+
+def valid_regex(pattern:str) -> bool:
+    try:
+        re.compile(pattern)
+        return True
+    except re.error:
+        return False
+
+def run_profiled(func, *args, **kwargs) -> Response:
+    """
+    Run an endpoint under cProfile and keep the stats in PROFILES.
+
+    -The id to read them back with is sent in the X-Profile-Id header.
+    -Streamed listings are profiled while each chunk is made too, and kept once the last one is sent.
+    -Only the request's own thread is profiled. Work handed to the GCS thread pools shows up as time waiting on them.
+    """
+    if not PROFILES.running.acquire(blocking=False):
+        return jsonify({"success": False,"error":"Another request is being profiled."}), 409
+
+    started = time()
+    label = f"{request.method} {request.full_path.rstrip('?')}"
+    id = PROFILES.new_id()
+    profile = Profile()
+
+    def keep():
+        try:
+            PROFILES.add(id,profile,label,started)
+        finally:
+            PROFILES.running.release()
+
+    try:
+        response = app.make_response(profile.runcall(func,*args,**kwargs))
+    except Exception:
+        keep()
+        raise
+
+    response.headers["X-Profile-Id"] = id
+
+    if response.is_streamed:
+        response.response = profile_stream(profile,response.response)
+        response.call_on_close(keep)
+    else:
+        keep()
+
+    return response
     
         
     
@@ -175,11 +387,159 @@ def health_check_endpoint() -> Tuple[Response,Optional[int]]:
     else:
         return jsonify({"success": True,"error":msg}), 200
 
+#Prometheus scrape endpoint.
+# Not protected by the API key, since scrapers don't send one, nor the handle_response() wrapper since it isn't JSON.
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint() -> Response:
+    """
+    GET /metrics
+    Request counts, latency histograms and in-flight requests per route, plus storage timings, bytes moved,
+    note count, meta size and the storage counters, in the Prometheus text format.
+
+    Returns:
+        Response: text/plain in the Prometheus exposition format.
+    """
+    return Response(REGISTRY.render(),mimetype=None,content_type=CONTENT_TYPE)
+
+#Function to list recent traces, through the traces route and the GET HTML type.
+# Not wrapped by handle_response(), since there's no main.py call behind it.
+@app.route("/traces", methods=["GET"])
+@require_api_key
+def traces_endpoint() -> Tuple[Response,Optional[int]]:
+    """
+    GET /traces:?
+    Summaries of the kept traces: the root span's name and duration, and per span name how many there were and
+    their total time. Shows which storage calls dominate slow requests.
+
+    Query Parameters:
+        limit (optional): Most traces to return. 50 if not given.
+        slowest (optional): If 1, longest first instead of newest first.
+
+    Returns:
+        (Response,Optional[int]):
+            - Response: jsonified response with "success" and "traces" fields, or "success" and "error".
+            - Optional[int]: If not successful, error code.
+    """
+    limit = request.args.get("limit") or "50"
+    if not limit.isdigit():
+        return jsonify({"success": False,"error":ERROR_MAP[ErrorCode.INVALID_INPUT][1]}), 400
+
+    return jsonify({"success": True,"traces":TRACER.recent(int(limit),request.args.get("slowest") == "1")})
+
+#Function to get every span of one trace, through the traces route and the GET HTML type.
+@app.route("/traces/<trace_id>", methods=["GET"])
+@require_api_key
+def trace_endpoint(trace_id:str) -> Tuple[Response,Optional[int]]:
+    """
+    GET /traces/<trace_id>
+    Every span of one trace, in the order they started. The id is in the X-Trace-Id header of each response.
+
+    Returns:
+        (Response,Optional[int]):
+            - Response: jsonified response with "success", "spans" and "dropped" fields, or "success" and "error".
+            - Optional[int]: If not successful, error code.
+    """
+    spans = TRACER.get(trace_id)
+    if spans is None:
+        return jsonify({"success": False,"error":ERROR_MAP[ErrorCode.NOT_FOUND][1]}), 404
+
+    return jsonify({"success": True,"trace_id":trace_id,"dropped":TRACER.dropped(trace_id),"spans":spans})
+
+#Function to list the kept request profiles, through the profiles route and the GET HTML type.
+# Needs the admin key rather than the API key, since profiles show the server's internals.
+@app.route("/profiles", methods=["GET"])
+@require_admin_key
+def profiles_endpoint() -> Tuple[Response,Optional[int]]:
+    """
+    GET /profiles
+    Every kept request profile, newest first. Requests are profiled by sending X-Profile: 1 with the admin key.
+
+    Returns:
+        (Response,Optional[int]):
+            - Response: jsonified response with "success" and "profiles" fields, each with id, label, started and seconds.
+            - Optional[int]: If not successful, error code.
+    """
+    return jsonify({"success": True,"profiles":PROFILES.list()})
+
+#Function to sample every thread's stack for a while, through the profiles/sample route and the GET HTML type.
+@app.route("/profiles/sample", methods=["GET"])
+@require_admin_key
+def sample_endpoint() -> Tuple[Response,Optional[int]]:
+    """
+    GET /profiles/sample:?
+    Samples the stack of every thread for a while and returns them collapsed, one "stack count" line each,
+    ready for flamegraph.pl or speedscope. Meant to be run while the server is under real load.
+
+    Query Parameters:
+        seconds (optional): How long to sample for. 10 if not given, at most SAMPLE_MAX_SECONDS.
+        interval (optional): Seconds between samples. 0.01 if not given.
+        threads (optional): Only sample threads whose name matches this regex, e.g. process_request.
+
+    Returns:
+        (Response,Optional[int]):
+            - Response: text/plain collapsed stacks, with the number of samples in X-Samples.
+                jsonified "success" and "error" fields if failed.
+            - Optional[int]: If not successful, error code.
+    """
+    seconds = parse_seconds(request.args.get("seconds"),10,SAMPLE_MAX_SECONDS)
+    interval = parse_seconds(request.args.get("interval"),0.01,1)
+    only = request.args.get("threads")
+    if seconds is None or interval is None or (only and not valid_regex(only)):
+        return jsonify({"success": False,"error":ERROR_MAP[ErrorCode.INVALID_INPUT][1]}), 400
+
+    if not SAMPLER.running.acquire(blocking=False):
+        return jsonify({"success": False,"error":"Already sampling."}), 409
+
+    try:
+        stacks, samples = SAMPLER.sample(seconds,interval,only)
+    finally:
+        SAMPLER.running.release()
+
+    return Response(collapse(stacks),mimetype="text/plain",headers={"X-Samples":str(samples)})
+
+#Function to read one request profile, through the profiles route and the GET HTML type.
+@app.route("/profiles/<profile_id>", methods=["GET"])
+@require_admin_key
+def profile_endpoint(profile_id:str) -> Tuple[Response,Optional[int]]:
+    """
+    GET /profiles/<profile_id>:?
+    One request profile, as pstats prints it. The id is in the X-Profile-Id header of the profiled response.
+
+    Query Parameters:
+        sort (optional): cumulative (default), tottime, ncalls, filename or name.
+        limit (optional): Most functions listed. 40 if not given.
+        filter (optional): Only list functions whose file:line(function) matches this regex, e.g. app.py|load_notes|json/|google/cloud.
+        format (optional): prof for the raw stats instead, to open with pstats or snakeviz.
+
+    Returns:
+        (Response,Optional[int]):
+            - Response: text/plain report, or the .prof file. jsonified "success" and "error" fields if failed.
+            - Optional[int]: If not successful, error code.
+    """
+    if request.args.get("format") == "prof":
+        raw = PROFILES.raw(profile_id)
+        if raw is None:
+            return jsonify({"success": False,"error":ERROR_MAP[ErrorCode.NOT_FOUND][1]}), 404
+
+        return Response(raw,mimetype="application/octet-stream",headers={"Content-Disposition":f"attachment; filename={profile_id}.prof"})
+
+    sort = request.args.get("sort") or "cumulative"
+    limit = request.args.get("limit") or "40"
+    pattern = request.args.get("filter")
+    if sort not in SORTS or not limit.isdigit() or (pattern and not valid_regex(pattern)):
+        return jsonify({"success": False,"error":ERROR_MAP[ErrorCode.INVALID_INPUT][1]}), 400
+
+    report = PROFILES.report(profile_id,sort,int(limit),pattern)
+    if report is None:
+        return jsonify({"success": False,"error":ERROR_MAP[ErrorCode.NOT_FOUND][1]}), 404
+
+    return Response(report,mimetype="text/plain")
+
 #Function to handle the posting of notes, through the notes route and the POST HTML type.
 @app.route("/notes", methods = ["POST"])
 @require_api_key
 @handle_response()
-def add_note_endpoint() -> tuple(Response,Optional[int]):
+def add_note_endpoint() -> Tuple[Response,Optional[int]]:
     """
     POST /notes
     Calls add_note() in main.py
@@ -219,6 +579,9 @@ def get_note_endpoint() -> Tuple[Response,Optional[int]]:
     Query Parameters:
         id (optional): If provided, returns the note with this id. Must be positive
             and exist in the cloud storage.
+        ids (optional): Comma separated ids. If provided, returns each of these notes, or null for ones that don't exist.
+        limit (optional): If provided, returns one page of at most this many notes, plus "next_cursor".
+        cursor (optional): "next_cursor" from the previous page, to get the page after it.
 
     Returns:
         (Response,Optional[int]):
@@ -228,8 +591,77 @@ def get_note_endpoint() -> Tuple[Response,Optional[int]]:
     """    
 
     note_id = request.args.get("id")
+    limit = request.args.get("limit")
+    cursor = request.args.get("cursor")
+    ids = request.args.get("ids")
+
+    if note_id is None and ids is not None:
+        return get_notes(ids.split(","))
+
+    if note_id is None and (limit is not None or cursor is not None):
+        return get_notes_page(limit,cursor)
+
+    #Without an id, every note is streamed back rather than loaded into one response.
+    if note_id is None:
+        return stream_notes()
+
     return get_note(note_id)
 
+#Function to handle searching notes, through the notes/search route and the GET HTML type.
+@app.route("/notes/search",methods=["GET"])
+@require_api_key
+@handle_response("results")
+def search_notes_endpoint() -> Tuple[Response,Optional[int]]:
+    """
+    GET /notes/search:?
+    Calls search_notes() in main.py
+
+    Query Parameters:
+        q: Words to search for in note titles and content.
+        title~: Instead of q. Part of a title, matched as a substring or with typos.
+        limit (optional): Most results to return.
+
+    Returns:
+        (Response,Optional[int]):
+            - Response: jsonified response with "success" and "error" fields if failed, "success"
+                and "results" field for success, best match first.
+            - Optional[int]: If not successful, error code.
+    """
+    title = request.args.get("title~")
+    if title:
+        return search_titles(title,request.args.get("limit"))
+
+    query = request.args.get("q")
+    if not query:
+        return False, "q or title~ was not included."
+
+    return search_notes(query,request.args.get("limit"))
+
+#Function to handle title suggestions, through the notes/autocomplete route and the GET HTML type.
+@app.route("/notes/autocomplete",methods=["GET"])
+@require_api_key
+@handle_response("results")
+def autocomplete_endpoint() -> Tuple[Response,Optional[int]]:
+    """
+    GET /notes/autocomplete:?
+    Calls autocomplete() in main.py
+
+    Query Parameters:
+        prefix: Required. Start of a title.
+        limit (optional): Most titles to return.
+
+    Returns:
+        (Response,Optional[int]):
+            - Response: jsonified response with "success" and "error" fields if failed, "success"
+                and "results" field for success, in title order.
+            - Optional[int]: If not successful, error code.
+    """
+    prefix = request.args.get("prefix")
+    if not prefix:
+        return False, "prefix was not included."
+
+    return autocomplete(prefix,request.args.get("limit"))
+
 #Function to handle the deletion of notes, through the notes route and the GET HTML type.
 @app.route("/notes",methods=["DELETE"])
 @require_api_key
@@ -254,6 +686,62 @@ def delete_note_endpoint() -> Tuple[Response,Optional[int]]:
     
     return delete_note(idx)
 
+#Function to handle adding many notes at once, through the notes/batch route and the POST HTML type.
+@app.route("/notes/batch", methods = ["POST"])
+@require_api_key
+@handle_response("results")
+def add_notes_endpoint() -> Tuple[Response,Optional[int]]:
+    """
+    POST /notes/batch
+    Calls add_notes() in main.py
+
+    Request JSON:
+    {
+        "notes": [{"title": "<note title>", "content": "<note content>"}, ...]
+    }
+
+    Returns:
+        (Response,Optional[int]):
+            - Response: jsonified response with "success" and "error" fields if failed, "success"
+                and "results" field for success, with an id or an error for each note.
+            - Optional[int]: If not successful, error code.
+    """
+
+    data = request.get_json()
+
+    if not data or "notes" not in data:
+        return False,"notes is a required field."
+
+    return add_notes(data["notes"])
+
+#Function to handle deleting many notes at once, through the notes/batch route and the DELETE HTML type.
+@app.route("/notes/batch", methods = ["DELETE"])
+@require_api_key
+@handle_response("results")
+def delete_notes_endpoint() -> Tuple[Response,Optional[int]]:
+    """
+    DELETE /notes/batch
+    Calls delete_notes() in main.py
+
+    Request JSON:
+    {
+        "ids": [<id>, ...]
+    }
+
+    Returns:
+        (Response,Optional[int]):
+            - Response: jsonified response with "success" and "error" fields if failed, "success"
+                and "results" field for success, with whether each note was found.
+            - Optional[int]: If not successful, error code.
+    """
+
+    data = request.get_json()
+
+    if not data or "ids" not in data:
+        return False,"ids is a required field."
+
+    return delete_notes(data["ids"])
+
 #---------------
 # Conditional Execution/ Ports
 #---------------
@@ -0,0 +1,303 @@
+from typing import Optional, Callable
+from json import loads, dumps
+from pathlib import Path
+from os import environ, devnull
+from contextlib import redirect_stdout
+from tempfile import TemporaryDirectory
+from time import perf_counter, time
+from random import Random
+import subprocess
+import platform
+import argparse
+import sys
+
+
+#-----------
+# Benchmark
+#-----------
+#Times add_note, get_note (one and all) and delete_note against stores of different sizes and backends, e.g.
+#
+#   python benchmark.py --sizes 10 1000 100000 --backends file blob --out results.json
+#
+#Each (backend, size) runs in a process of its own, since main.py reads its settings once at import and peak RSS
+#is only meaningful per process. The online backends talk to fake_gcs.py, served from this process.
+
+SIZES:tuple = (10, 1000, 100000, 1000000)
+OPERATIONS:tuple = ("add", "get", "get_all", "delete")
+BUCKET:str = "bench"
+
+#What each backend sets before main.py is imported. LOCAL, SQLITE_FILE and GCS_ENDPOINT are filled in per run.
+BACKENDS:dict = {
+    "file":{"STORAGE_SOURCE":"offline","LOCAL_MODE":"file"},
+    "log":{"STORAGE_SOURCE":"offline","LOCAL_MODE":"log"},
+    "sqlite":{"STORAGE_SOURCE":"sqlite"},
+    "memory":{"STORAGE_SOURCE":"memory"},
+    "blob":{"STORAGE_SOURCE":"online","ONLINE_LAYOUT":"blob"},
+    "objects":{"STORAGE_SOURCE":"online","ONLINE_LAYOUT":"objects"},
+    "sharded":{"STORAGE_SOURCE":"online","ONLINE_LAYOUT":"sharded"},
+}
+
+def percentile(samples:list, fraction:float) -> Optional[float]:
+    """Nearest-rank percentile.
+
+    Args:
+        samples (list): Sorted samples.
+        fraction (float): From 0 to 1.
+
+    Returns:
+        Optional[float]: The sample at that rank. None if there are no samples.
+    """
+    if not samples:
+        return None
+
+    return samples[min(len(samples) - 1, max(0, int(round(fraction * len(samples))) - 1))]
+
+def peak_rss() -> Optional[int]:
+    """Peak resident memory of this process so far.
+
+    Returns:
+        Optional[int]: Bytes. None if the platform doesn't say.
+    """
+    try:
+        import resource
+    except ImportError:
+        resource = None
+
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        #Linux reports kilobytes, macOS bytes.
+        return peak if sys.platform == "darwin" else peak * 1024
+
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class Counters(ctypes.Structure):
+            _fields_ = [("cb",wintypes.DWORD),("PageFaultCount",wintypes.DWORD)] + \
+                [(name,ctypes.c_size_t) for name in ("PeakWorkingSetSize","WorkingSetSize","QuotaPeakPagedPoolUsage",
+                 "QuotaPagedPoolUsage","QuotaPeakNonPagedPoolUsage","QuotaNonPagedPoolUsage","PagefileUsage","PeakPagefileUsage")]
+
+        counters = Counters()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process,ctypes.byref(counters),counters.cb):
+            return counters.PeakWorkingSetSize
+    except (ImportError, AttributeError, OSError):
+        pass
+
+    return None
+
+def make_note(i:int, content_bytes:int) -> dict:
+    """A note for seeding the store. Titles are distinct, contents all the same size.
+    """
+    return {"title":f"Note {i}","content":("lorem ipsum dolor sit amet " * (content_bytes // 27 + 1))[:content_bytes]}
+
+#-----------
+# Worker
+#-----------
+
+def measure(name:str, op:Callable[[int], bool], count:int, budget:float) -> dict:
+    """Run an operation up to count times, or until budget seconds are used up.
+
+    Args:
+        name (str): Name of the operation.
+        op (Callable[[int], bool]): Called with the iteration number. Returns False if it failed.
+        count (int): Most iterations.
+        budget (float): Seconds after which no more iterations start.
+
+    Returns:
+        dict: ops, errors, seconds, throughput, p50/p99/mean/max latency in ms, and peak RSS so far.
+    """
+    latencies = []
+    errors = 0
+    start = perf_counter()
+
+    for i in range(count):
+        if i > 0 and perf_counter() - start >= budget:
+            break
+
+        began = perf_counter()
+        if not op(i):
+            errors += 1
+        latencies.append(perf_counter() - began)
+
+    seconds = perf_counter() - start
+    latencies.sort()
+    rss = peak_rss()
+
+    return {
+        "op":name,
+        "ops":len(latencies),
+        "errors":errors,
+        "seconds":round(seconds,6),
+        "throughput":round(len(latencies) / seconds,3) if seconds > 0 else None,
+        "p50_ms":round(percentile(latencies,0.50) * 1000,3) if latencies else None,
+        "p99_ms":round(percentile(latencies,0.99) * 1000,3) if latencies else None,
+        "mean_ms":round(sum(latencies) / len(latencies) * 1000,3) if latencies else None,
+        "max_ms":round(latencies[-1] * 1000,3) if latencies else None,
+        "peak_rss_mb":round(rss / 1048576,1) if rss is not None else None,
+    }
+
+def run_worker(size:int, operations:list, count:int, get_all_count:int, budget:float, content_bytes:int, seed:int) -> dict:
+    """Seed a store with size notes and time each operation against it. Settings come from the environment.
+
+    Returns:
+        dict: Seeding time, and one result per operation.
+    """
+    #Imported here so the parent never loads main.py, and the environment is set before it reads its settings.
+    import main
+    from ids import IdAllocator
+
+    rng = Random(seed)
+
+    ok, err = main.setup(BUCKET)
+    if not ok:
+        raise RuntimeError(f"Setup failed: {err}")
+
+    #Seeding through add_note would rewrite the whole document once per note, so the store is written in one go.
+    began = perf_counter()
+    main.save_notes({str(i):make_note(i,content_bytes) for i in range(size)})
+    main.state.ids = IdAllocator(size,reuse=main.ID_REUSE)
+    main.save_meta(main.current_meta(size),guarded=False)
+    main.setup(BUCKET)
+    seeded = perf_counter() - began
+
+    #The ids adds were given, so deletes can remove exactly what was added.
+    added = []
+
+    def add(i:int) -> bool:
+        #add_note doesn't hand the id back. Ids come off state.ids lowest first, so a copy of it says which one it will use.
+        id = str(IdAllocator.from_meta(main.state.ids.to_meta(),main.ID_REUSE).allocate())
+        ok = main.add_note(f"Bench {i}",make_note(i,content_bytes)["content"])[0]
+        if ok:
+            added.append(id)
+        return ok
+
+    def get(i:int) -> bool:
+        return main.get_note(str(rng.randrange(size)))[0] if size else True
+
+    def get_all(i:int) -> bool:
+        ok, err, notes = main.get_note()
+        return ok and notes is not None
+
+    def stream(i:int) -> bool:
+        ok, err, notes = main.stream_notes()
+        if ok:
+            for _ in notes:
+                pass
+        return ok
+
+    def delete(i:int) -> bool:
+        if i >= len(added):
+            return main.delete_note(str(rng.randrange(size)))[0]
+        return main.delete_note(added[i])[0]
+
+    ops = {"add":add,"get":get,"get_all":get_all,"stream":stream,"delete":delete}
+    results = []
+
+    for name in operations:
+        results.append(measure(name,ops[name],get_all_count if name in ("get_all","stream") else count,budget))
+
+    return {"seed_seconds":round(seeded,6),"results":results}
+
+#-----------
+# Runner
+#-----------
+
+def run_one(backend:str, size:int, args:argparse.Namespace, endpoint:Optional[str]) -> dict:
+    """Run one (backend, size) in its own process.
+
+    Returns:
+        dict: The worker's output plus the backend and size, or an error.
+    """
+    with TemporaryDirectory(prefix="notes-bench-") as folder:
+        env = dict(environ)
+        env.update({"LOCAL":str(Path(folder) / "notes.json"),"SQLITE_FILE":str(Path(folder) / "notes.db"),"SEARCH_INDEX":"0"})
+        env.update(BACKENDS[backend])
+        env.update(dict(pair.split("=",1) for pair in args.env))
+
+        if endpoint is not None:
+            env["GCS_ENDPOINT"] = endpoint
+
+        command = [sys.executable,str(Path(__file__).resolve()),"--worker","--sizes",str(size),"--operations",*args.operations,
+                   "--count",str(args.count),"--get-all-count",str(args.get_all_count),"--budget",str(args.budget),
+                   "--content-bytes",str(args.content_bytes),"--seed",str(args.seed)]
+
+        began = perf_counter()
+        done = subprocess.run(command,env=env,cwd=folder,capture_output=True,text=True)
+        wall = perf_counter() - began
+
+    row = {"backend":backend,"size":size,"wall_seconds":round(wall,3)}
+    lines = done.stdout.strip().splitlines()
+
+    if done.returncode != 0 or not lines:
+        row["error"] = (done.stderr.strip().splitlines() or ["exit code " + str(done.returncode)])[-1]
+        return row
+
+    row.update(loads(lines[-1]))
+    return row
+
+def main():
+    """Parse arguments and run every (backend, size), or be one worker.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark note operations across store sizes and backends. Prints JSON.")
+    parser.add_argument("--sizes",type=int,nargs="+",default=list(SIZES))
+    parser.add_argument("--backends",nargs="+",default=["file","blob"],choices=list(BACKENDS))
+    parser.add_argument("--operations",nargs="+",default=list(OPERATIONS),choices=list(OPERATIONS) + ["stream"])
+    parser.add_argument("--count",type=int,default=200,help="Most timed add, get and delete calls per run.")
+    parser.add_argument("--get-all-count",type=int,default=20,help="Most timed get_all calls per run.")
+    parser.add_argument("--budget",type=float,default=30,help="Seconds after which an operation stops starting new calls.")
+    parser.add_argument("--content-bytes",type=int,default=100,help="Size of each note's content.")
+    parser.add_argument("--seed",type=int,default=1)
+    parser.add_argument("--latency",type=float,default=0,help="Seconds the fake bucket adds to every request.")
+    parser.add_argument("--jitter",type=float,default=0,help="Up to this many more seconds per request, at random.")
+    parser.add_argument("--env",action="append",default=[],help="KEY=VALUE passed to every run, e.g. WRITE_BEHIND=1. Can be repeated.")
+    parser.add_argument("--out",help="Write the JSON here instead of printing it.")
+    parser.add_argument("--worker",action="store_true",help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        #main.py prints on every call. That would swamp the timings, and only the result belongs on stdout.
+        with open(devnull,"w") as sink, redirect_stdout(sink):
+            result = run_worker(args.sizes[0],args.operations,args.count,args.get_all_count,args.budget,args.content_bytes,args.seed)
+        print(dumps(result))
+        return
+
+    server = None
+    if any(BACKENDS[name]["STORAGE_SOURCE"] == "online" for name in args.backends):
+        from fake_gcs import FakeGCS
+        server = FakeGCS(buckets=(BUCKET,),latency=args.latency,jitter=args.jitter)
+        server.start()
+
+    report = {
+        "started":time(),
+        "python":platform.python_version(),
+        "platform":platform.platform(),
+        "settings":{k:v for k, v in vars(args).items() if k not in ("worker","out")},
+        "runs":[],
+    }
+
+    try:
+        for backend in args.backends:
+            for size in args.sizes:
+                online = BACKENDS[backend]["STORAGE_SOURCE"] == "online"
+                if online:
+                    server.clear()
+
+                print(f"Benchmarking {backend} with {size} notes...",file=sys.stderr)
+                report["runs"].append(run_one(backend,size,args,server.endpoint if online else None))
+    finally:
+        if server is not None:
+            server.stop()
+
+    text = dumps(report,indent=2)
+
+    if args.out:
+        Path(args.out).write_text(text,encoding="utf-8")
+        print(f"Wrote {args.out}",file=sys.stderr)
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,591 @@
+from typing import Optional, Tuple
+from dataclasses import dataclass, field
+from json import loads, dumps, JSONDecodeError
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, quote, unquote
+from email.parser import BytesParser
+from email.policy import HTTP
+from threading import Lock, Thread
+from hashlib import md5
+from base64 import b64encode
+from datetime import datetime, timezone
+from time import sleep, time_ns
+from random import random
+from os import getenv
+from uuid import uuid4
+import argparse
+import re
+
+#Comes with google-cloud-storage, which checks uploads against it.
+from google_crc32c import value as crc32c
+
+
+#-----------
+# Fake GCS
+#-----------
+#A stand-in for the parts of the GCS JSON API that storage.Client uses here. Point the client at it with
+#GCS_ENDPOINT=http://127.0.0.1:4443 and run
+#
+#   python fake_gcs.py --bucket my-bucket --latency 0.02
+#
+#Everything lives in memory and is gone when the server stops.
+
+@dataclass
+class FakeObject:
+    """One live object.
+    """
+    data:bytes
+    generation:int
+    metageneration:int = 1
+    content_type:str = "application/octet-stream"
+    updated:str = ""
+
+    def hashes(self) -> Tuple[str,str]:
+        """
+        Returns:
+            Tuple[str,str]: The base64 CRC32C and MD5 of the data, as GCS reports them.
+        """
+        return b64encode(crc32c(self.data).to_bytes(4,"big")).decode("ascii"), b64encode(md5(self.data).digest()).decode("ascii")
+
+@dataclass
+class FakeUpload:
+    """A resumable upload that hasn't been finished yet.
+    """
+    bucket:str
+    name:str
+    content_type:str
+    query:dict
+    data:bytearray = field(default_factory=bytearray)
+
+class FakeGCSError(Exception):
+    """A JSON API error response.
+    """
+
+    def __init__(self, code:int, reason:str, message:str):
+        super().__init__(message)
+        self.code = code
+        self.reason = reason
+        self.message = message
+
+class FakeGCS(ThreadingHTTPServer):
+    """The server, and the buckets it holds.
+
+    Generations come from a microsecond clock and only ever go up, the way real ones do, so a precondition
+    taken from one upload never matches the next. There's no object versioning: asking for a generation that
+    isn't the live one is a 404.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address:Tuple[str,int] = ("127.0.0.1",0), buckets:tuple = (), latency:float = 0.0, jitter:float = 0.0,
+                 bandwidth:float = 0.0, auto_create:bool = False):
+        """
+        Args:
+            address (Tuple[str,int]): Host and port to listen on. Port 0 picks a free one.
+            buckets (tuple): Names of buckets that exist from the start.
+            latency (float): Seconds added to every request.
+            jitter (float): Up to this many more seconds, picked at random per request.
+            bandwidth (float): Bytes per second that request and response bodies are held to. 0 for no limit.
+            auto_create (bool): Create a bucket the first time it's used instead of answering 404.
+        """
+        super().__init__(address,FakeGCSHandler)
+        self.buckets:dict[str, dict[str, FakeObject]] = {name:{} for name in buckets}
+        self.uploads:dict[str, FakeUpload] = {}
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.auto_create = auto_create
+        self.requests = 0
+        self.lock = Lock()
+        self._last_generation = 0
+        self._thread:Optional[Thread] = None
+
+    @property
+    def endpoint(self) -> str:
+        """
+        Returns:
+            str: Base URL to hand storage.Client as its api_endpoint.
+        """
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> str:
+        """Serve on a background thread.
+
+        Returns:
+            str: The endpoint.
+        """
+        self._thread = Thread(target=self.serve_forever,name="fake-gcs",daemon=True)
+        self._thread.start()
+        return self.endpoint
+
+    def stop(self):
+        """Stop serving and close the socket.
+        """
+        self.shutdown()
+        self.server_close()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def delay(self, size:int = 0):
+        """Sleep for the injected latency, plus the time size bytes take at the configured bandwidth.
+
+        Args:
+            size (int): Bytes in the request and response bodies.
+        """
+        wait = self.latency + self.jitter * random()
+
+        if self.bandwidth > 0:
+            wait += size / self.bandwidth
+
+        if wait > 0:
+            sleep(wait)
+
+    def next_generation(self) -> int:
+        """Must be called holding the lock.
+        """
+        self._last_generation = max(self._last_generation + 1,time_ns() // 1000)
+        return self._last_generation
+
+    def bucket(self, name:str) -> dict:
+        """Must be called holding the lock.
+
+        Raises:
+            FakeGCSError: 404 if the bucket doesn't exist.
+        """
+        if name not in self.buckets:
+            if not self.auto_create:
+                raise FakeGCSError(404,"notFound","The specified bucket does not exist.")
+
+            self.buckets[name] = {}
+
+        return self.buckets[name]
+
+    def clear(self):
+        """Delete every object, keeping the buckets.
+        """
+        with self.lock:
+            for objects in self.buckets.values():
+                objects.clear()
+
+            self.uploads.clear()
+
+#-----------
+# Preconditions
+#-----------
+
+def check_preconditions(query:dict, current:Optional[FakeObject], read:bool = False):
+    """Apply the ifGeneration*/ifMetageneration* parameters of a request.
+
+    Args:
+        query (dict): The request's query parameters.
+        current (Optional[FakeObject]): The live object. None if there isn't one, which counts as generation 0.
+        read (bool): Whether this is a read. A failed ifGenerationNotMatch on a read is a 304, not a 412.
+
+    Raises:
+        FakeGCSError: 412 or 304 if a precondition isn't met.
+    """
+    generation = current.generation if current is not None else 0
+    metageneration = current.metageneration if current is not None else 0
+
+    match = query.get("ifGenerationMatch")
+    if match is not None and int(match) != generation:
+        raise FakeGCSError(412,"conditionNotMet","At least one of the pre-conditions you specified did not hold.")
+
+    not_match = query.get("ifGenerationNotMatch")
+    if not_match is not None and int(not_match) == generation:
+        if read:
+            raise FakeGCSError(304,"notModified","Not Modified")
+        raise FakeGCSError(412,"conditionNotMet","At least one of the pre-conditions you specified did not hold.")
+
+    match = query.get("ifMetagenerationMatch")
+    if match is not None and int(match) != metageneration:
+        raise FakeGCSError(412,"conditionNotMet","At least one of the pre-conditions you specified did not hold.")
+
+    not_match = query.get("ifMetagenerationNotMatch")
+    if not_match is not None and int(not_match) == metageneration:
+        if read:
+            raise FakeGCSError(304,"notModified","Not Modified")
+        raise FakeGCSError(412,"conditionNotMet","At least one of the pre-conditions you specified did not hold.")
+
+def parse_range(header:Optional[str], size:int) -> Optional[Tuple[int,int]]:
+    """Turn a Range header into the bytes it asks for.
+
+    Args:
+        header (Optional[str]): The header, like "bytes=0-99", "bytes=100-" or "bytes=-100".
+        size (int): Size of the object.
+
+    Returns:
+        Optional[Tuple[int,int]]: First and last byte, both inclusive. None for the whole object.
+
+    Raises:
+        FakeGCSError: 416 if the range starts past the end.
+    """
+    if not header:
+        return None
+
+    found = re.fullmatch(r"bytes=(\d*)-(\d*)",header.strip())
+    if found is None or found.group(1) == found.group(2) == "":
+        return None
+
+    if found.group(1) == "":
+        #The last N bytes.
+        return max(size - int(found.group(2)),0), size - 1
+
+    start = int(found.group(1))
+    end = int(found.group(2)) if found.group(2) else size - 1
+
+    if start >= size:
+        raise FakeGCSError(416,"requestedRangeNotSatisfiable","The requested range cannot be satisfied.")
+
+    return start, min(end,size - 1)
+
+#-----------
+# Request Handler
+#-----------
+
+class FakeGCSHandler(BaseHTTPRequestHandler):
+    """Routes one request to the right piece of the JSON API.
+    """
+
+    protocol_version = "HTTP/1.1"
+    server:FakeGCS
+
+    #Headers and body go out in separate writes. With Nagle on, the body waits on the client's delayed ACK, which adds ~40ms per request.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        #One line per request would drown out everything else during a benchmark.
+        pass
+
+    def do_GET(self):
+        self.route("GET")
+
+    def do_POST(self):
+        self.route("POST")
+
+    def do_PUT(self):
+        self.route("PUT")
+
+    def do_DELETE(self):
+        self.route("DELETE")
+
+    def do_PATCH(self):
+        self.route("PATCH")
+
+    def route(self, method:str):
+        """Read the request, answer it, and inject the configured latency.
+        """
+        url = urlsplit(self.path)
+        path = url.path
+        query = {k:v[-1] for k, v in parse_qs(url.query,keep_blank_values=True).items()}
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+        with self.server.lock:
+            self.server.requests += 1
+
+        try:
+            if method == "GET" and (found := re.fullmatch(r"/download/storage/v1/b/([^/]+)/o/(.+)",path)):
+                status, headers, payload = self.download(unquote(found.group(1)),unquote(found.group(2)),query)
+
+            elif method == "POST" and (found := re.fullmatch(r"/upload/storage/v1/b/([^/]+)/o",path)):
+                status, headers, payload = self.upload(unquote(found.group(1)),query,body)
+
+            elif method == "PUT" and (found := re.fullmatch(r"/upload/storage/v1/b/([^/]+)/o",path)):
+                status, headers, payload = self.resume(query.get("upload_id",""),body)
+
+            elif found := re.fullmatch(r"/storage/v1/b/([^/]+)/o/(.+)",path):
+                status, headers, payload = self.object(method,unquote(found.group(1)),unquote(found.group(2)),query)
+
+            elif method == "GET" and (found := re.fullmatch(r"/storage/v1/b/([^/]+)/o",path)):
+                status, headers, payload = self.list(unquote(found.group(1)),query)
+
+            elif method == "GET" and (found := re.fullmatch(r"/storage/v1/b/([^/]+)",path)):
+                with self.server.lock:
+                    self.server.bucket(unquote(found.group(1)))
+                status, headers, payload = 200, {}, self.json({"kind":"storage#bucket","name":unquote(found.group(1)),"id":unquote(found.group(1))})
+
+            elif method == "POST" and path == "/storage/v1/b":
+                status, headers, payload = self.create_bucket(body)
+
+            else:
+                raise FakeGCSError(404,"notFound",f"No such route: {method} {path}")
+
+        except FakeGCSError as e:
+            status, headers = e.code, {}
+            payload = b"" if e.code == 304 else self.json({"error":{"code":e.code,"message":e.message,"errors":[{"reason":e.reason,"message":e.message}]}})
+
+        except (ValueError, KeyError, JSONDecodeError) as e:
+            status, headers = 400, {}
+            payload = self.json({"error":{"code":400,"message":f"Bad request: {e}","errors":[{"reason":"invalid","message":str(e)}]}})
+
+        self.server.delay(len(body) + len(payload))
+        self.send_response(status)
+
+        headers.setdefault("Content-Type","application/json; charset=UTF-8")
+        for name, value in headers.items():
+            self.send_header(name,value)
+
+        self.send_header("Content-Length",str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def json(self, value:dict) -> bytes:
+        return dumps(value).encode("utf-8")
+
+    def resource(self, bucket:str, name:str, obj:FakeObject) -> dict:
+        """The JSON API's view of an object.
+        """
+        host = self.headers.get("Host") or "{}:{}".format(*self.server.server_address[:2])
+        crc, digest = obj.hashes()
+        path = f"b/{quote(bucket,safe='')}/o/{quote(name,safe='')}"
+
+        return {
+            "kind":"storage#object",
+            "id":f"{bucket}/{name}/{obj.generation}",
+            "selfLink":f"http://{host}/storage/v1/{path}",
+            "mediaLink":f"http://{host}/download/storage/v1/{path}?generation={obj.generation}&alt=media",
+            "name":name,
+            "bucket":bucket,
+            "generation":str(obj.generation),
+            "metageneration":str(obj.metageneration),
+            "contentType":obj.content_type,
+            "size":str(len(obj.data)),
+            "crc32c":crc,
+            "md5Hash":digest,
+            "etag":f"{obj.generation}.{obj.metageneration}",
+            "storageClass":"STANDARD",
+            "timeCreated":obj.updated,
+            "updated":obj.updated,
+        }
+
+    def live(self, bucket:str, name:str, query:dict) -> Optional[FakeObject]:
+        """The live object, if it is the generation asked for. Must be called holding the lock.
+        """
+        obj = self.server.bucket(bucket).get(name)
+
+        if obj is not None and query.get("generation") and int(query["generation"]) != obj.generation:
+            return None
+
+        return obj
+
+    def object(self, method:str, bucket:str, name:str, query:dict) -> tuple:
+        """GET, DELETE or PATCH /storage/v1/b/{bucket}/o/{name}.
+        """
+        with self.server.lock:
+            obj = self.live(bucket,name,query)
+
+            if method == "GET" and query.get("alt") == "media":
+                pass
+
+            elif method == "GET":
+                check_preconditions(query,obj,read=True)
+                if obj is None:
+                    raise FakeGCSError(404,"notFound",f"No such object: {bucket}/{name}")
+                return 200, {}, self.json(self.resource(bucket,name,obj))
+
+            elif method == "DELETE":
+                check_preconditions(query,obj)
+                if obj is None:
+                    raise FakeGCSError(404,"notFound",f"No such object: {bucket}/{name}")
+                del self.server.buckets[bucket][name]
+                return 204, {}, b""
+
+            elif method == "PATCH":
+                check_preconditions(query,obj)
+                if obj is None:
+                    raise FakeGCSError(404,"notFound",f"No such object: {bucket}/{name}")
+                obj.metageneration += 1
+                return 200, {}, self.json(self.resource(bucket,name,obj))
+
+            else:
+                raise FakeGCSError(405,"methodNotAllowed",f"{method} is not supported on objects.")
+
+        #Downloads through the metadata URL, the way older clients asked for media.
+        return self.download(bucket,name,query)
+
+    def download(self, bucket:str, name:str, query:dict) -> tuple:
+        """GET /download/storage/v1/b/{bucket}/o/{name}?alt=media, with an optional Range.
+        """
+        with self.server.lock:
+            obj = self.live(bucket,name,query)
+            check_preconditions(query,obj,read=True)
+
+            if obj is None:
+                raise FakeGCSError(404,"notFound",f"No such object: {bucket}/{name}")
+
+            data = obj.data
+            crc, digest = obj.hashes()
+            headers = {
+                "Content-Type":obj.content_type,
+                "ETag":f"{obj.generation}.{obj.metageneration}",
+                "X-Goog-Generation":str(obj.generation),
+                "X-Goog-Metageneration":str(obj.metageneration),
+                "X-Goog-Stored-Content-Length":str(len(obj.data)),
+                "X-Goog-Hash":f"crc32c={crc},md5={digest}",
+                "Accept-Ranges":"bytes",
+            }
+
+        span = parse_range(self.headers.get("Range"),len(data))
+        if span is None:
+            return 200, headers, data
+
+        start, end = span
+        headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+        return 206, headers, data[start:end + 1]
+
+    def upload(self, bucket:str, query:dict, body:bytes) -> tuple:
+        """POST /upload/storage/v1/b/{bucket}/o, as a media, multipart or resumable upload.
+        """
+        kind = query.get("uploadType","media")
+
+        if kind == "media":
+            return self.store(bucket,query["name"],self.headers.get("Content-Type") or "application/octet-stream",body,query)
+
+        if kind == "multipart":
+            message = BytesParser(policy=HTTP).parsebytes(b"Content-Type: " + self.headers["Content-Type"].encode("ascii") + b"\r\n\r\n" + body)
+            parts = list(message.iter_parts())
+            metadata = loads(parts[0].get_content())
+            media = parts[1].get_payload(decode=True) or b""
+            content_type = metadata.get("contentType") or parts[1].get_content_type()
+            return self.store(bucket,metadata.get("name") or query["name"],content_type,media,query)
+
+        if kind == "resumable":
+            metadata = loads(body) if body else {}
+            name = metadata.get("name") or query["name"]
+            content_type = metadata.get("contentType") or self.headers.get("X-Upload-Content-Type") or "application/octet-stream"
+
+            with self.server.lock:
+                #Fail early, the way GCS does, rather than after the whole body is sent.
+                self.server.bucket(bucket)
+                check_preconditions(query,self.server.buckets[bucket].get(name))
+
+                upload_id = uuid4().hex
+                self.server.uploads[upload_id] = FakeUpload(bucket,name,content_type,query)
+
+            host = self.headers.get("Host") or "{}:{}".format(*self.server.server_address[:2])
+            location = f"http://{host}/upload/storage/v1/b/{quote(bucket,safe='')}/o?uploadType=resumable&upload_id={upload_id}"
+            return 200, {"Location":location}, b""
+
+        raise FakeGCSError(400,"invalid",f"Unknown uploadType: {kind}")
+
+    def resume(self, upload_id:str, body:bytes) -> tuple:
+        """PUT a chunk of a resumable upload. The last chunk is the one that names the total size.
+        """
+        with self.server.lock:
+            upload = self.server.uploads.get(upload_id)
+
+        if upload is None:
+            raise FakeGCSError(404,"notFound","No such upload.")
+
+        #"bytes 0-99/*" for a chunk with more to come, "bytes 100-149/150" for the last one, "bytes */150" to finish.
+        found = re.fullmatch(r"bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)",(self.headers.get("Content-Range") or "bytes */*").strip())
+        if found is None:
+            raise FakeGCSError(400,"invalid","Bad Content-Range.")
+
+        if found.group(1) is not None and int(found.group(1)) == len(upload.data):
+            upload.data += body
+
+        total = found.group(3)
+        if total == "*" or int(total) > len(upload.data):
+            headers = {"Range":f"bytes=0-{len(upload.data) - 1}"} if upload.data else {}
+            return 308, headers, b""
+
+        with self.server.lock:
+            self.server.uploads.pop(upload_id,None)
+
+        return self.store(upload.bucket,upload.name,upload.content_type,bytes(upload.data),upload.query)
+
+    def store(self, bucket:str, name:str, content_type:str, data:bytes, query:dict) -> tuple:
+        """Write a new generation of an object, if its preconditions hold.
+        """
+        with self.server.lock:
+            objects = self.server.bucket(bucket)
+            check_preconditions(query,objects.get(name))
+
+            updated = datetime.now(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00","Z")
+            obj = FakeObject(data,self.server.next_generation(),1,content_type,updated)
+            objects[name] = obj
+
+            return 200, {}, self.json(self.resource(bucket,name,obj))
+
+    def list(self, bucket:str, query:dict) -> tuple:
+        """GET /storage/v1/b/{bucket}/o, in name order, with prefix, startOffset, endOffset, delimiter and paging.
+        """
+        prefix = query.get("prefix","")
+        start = query.get("pageToken") or query.get("startOffset") or ""
+        end = query.get("endOffset")
+        delimiter = query.get("delimiter")
+        limit = int(query.get("maxResults") or 1000)
+
+        with self.server.lock:
+            names = sorted(n for n in self.server.bucket(bucket) if n.startswith(prefix) and n >= start and (not end or n < end))
+
+            items = []
+            prefixes = set()
+            token = None
+
+            for name in names:
+                if len(items) + len(prefixes) >= limit:
+                    token = name
+                    break
+
+                #With a delimiter, everything past it under the prefix is one "directory".
+                if delimiter and delimiter in name[len(prefix):]:
+                    prefixes.add(name[:name.index(delimiter,len(prefix)) + len(delimiter)])
+                    continue
+
+                items.append(self.resource(bucket,name,self.server.buckets[bucket][name]))
+
+        result = {"kind":"storage#objects","items":items}
+        if prefixes:
+            result["prefixes"] = sorted(prefixes)
+        if token is not None:
+            result["nextPageToken"] = token
+
+        return 200, {}, self.json(result)
+
+    def create_bucket(self, body:bytes) -> tuple:
+        """POST /storage/v1/b.
+        """
+        name = loads(body)["name"]
+
+        with self.server.lock:
+            if name in self.server.buckets:
+                raise FakeGCSError(409,"conflict","The requested bucket name is not available.")
+
+            self.server.buckets[name] = {}
+
+        return 200, {}, self.json({"kind":"storage#bucket","name":name,"id":name})
+
+#-----------
+# Command Line
+#-----------
+
+def main():
+    """Run the fake until interrupted.
+    """
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the GCS JSON API.")
+    parser.add_argument("--host",default=getenv("FAKE_GCS_HOST") or "127.0.0.1")
+    parser.add_argument("--port",type=int,default=int(getenv("FAKE_GCS_PORT") or 4443))
+    parser.add_argument("--bucket",action="append",default=[],help="A bucket that exists from the start. Can be repeated.")
+    parser.add_argument("--auto-create",action="store_true",help="Create buckets the first time they're used.")
+    parser.add_argument("--latency",type=float,default=float(getenv("FAKE_GCS_LATENCY") or 0),help="Seconds added to every request.")
+    parser.add_argument("--jitter",type=float,default=float(getenv("FAKE_GCS_JITTER") or 0),help="Up to this many more seconds per request, at random.")
+    parser.add_argument("--bandwidth",type=float,default=float(getenv("FAKE_GCS_BANDWIDTH") or 0),help="Bytes per second for bodies. 0 for no limit.")
+    args = parser.parse_args()
+
+    server = FakeGCS((args.host,args.port),tuple(args.bucket),args.latency,args.jitter,args.bandwidth,args.auto_create)
+    print(f"Fake GCS listening on {server.endpoint}. Set GCS_ENDPOINT={server.endpoint} to use it.")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+from typing import Optional, Iterable
+from bisect import bisect_right
+
+
+#-----------
+# Id Allocator
+#-----------
+
+class IdAllocator:
+    """Hands out note ids, reusing freed ones lowest first.
+
+    Free ids are kept as sorted, non-touching ranges (two parallel lists of starts and ends, both inclusive),
+    so a mass delete of neighbouring ids is a handful of ranges instead of one entry per id. Finding where an id
+    belongs is a binary search. Ranges used up from the front are skipped with an offset and trimmed in bulk,
+    so handing out an id doesn't shift the whole list.
+    """
+
+    def __init__(self, next_id:int = 0, free:Iterable[Iterable[int]] = (), reuse:bool = True):
+        """
+        Args:
+            next_id (int): The lowest id that has never been handed out.
+            free (Iterable[Iterable[int]]): Free ranges as [start, end] pairs, both inclusive. Any order.
+            reuse (bool): If False, freed ids are never handed out again and ids only go up.
+        """
+        self.next_id = next_id
+        self.reuse = reuse
+        self._starts:list[int] = []
+        self._ends:list[int] = []
+        self._head = 0
+
+        for start, end in sorted((int(s), int(e)) for s, e in free):
+            end = min(end, next_id - 1)
+            if start <= end:
+                self._add_range(max(start, 0), end)
+
+        self._shrink()
+
+    def allocate(self) -> int:
+        """Hand out an id.
+
+        Returns:
+            int: The lowest free id, or a new one if none are free.
+        """
+        if self.reuse and self._head < len(self._starts):
+            id = self._starts[self._head]
+
+            if id == self._ends[self._head]:
+                self._head += 1
+                self._trim()
+            else:
+                self._starts[self._head] = id + 1
+
+            return id
+
+        id = self.next_id
+        self.next_id += 1
+        return id
+
+    def free(self, id:int):
+        """Give an id back so it can be handed out again.
+
+        Args:
+            id (int): An id that was handed out and is no longer in use.
+        """
+        if not self.reuse or id < 0 or id >= self.next_id:
+            return
+
+        self._add_range(id, id)
+        self._shrink()
+
+    def to_meta(self) -> dict:
+        """Build the part of _meta that belongs to the allocator.
+
+        Returns:
+            dict: id_count and free_ids, with free ids as [start, end] ranges.
+        """
+        return {"id_count":self.next_id,"free_ids":[[s, e] for s, e in zip(self._starts[self._head:], self._ends[self._head:])]}
+
+    @classmethod
+    def from_meta(cls, meta:Optional[dict], reuse:bool = True) -> "IdAllocator":
+        """Rebuild an allocator from _meta. Older stores that kept every freed id in old_ids are read too.
+
+        Args:
+            meta (Optional[dict]): The _meta block.
+            reuse (bool): If False, freed ids are never handed out again.
+
+        Returns:
+            IdAllocator: The allocator.
+        """
+        meta = meta or {}
+        free = [(s, e) for s, e in meta.get("free_ids",[])]
+        free += [(i, i) for i in meta.get("old_ids",[])]
+
+        return cls(meta.get("id_count",0), free, reuse)
+
+    def __len__(self) -> int:
+        """
+        Returns:
+            int: How many freed ids are waiting to be reused.
+        """
+        return sum(e - s + 1 for s, e in zip(self._starts[self._head:], self._ends[self._head:]))
+
+    def _add_range(self, start:int, end:int):
+        """Mark start..end (inclusive) as free, merging with any range it touches or overlaps.
+        """
+        i = bisect_right(self._starts, start, self._head)
+
+        #Merge with the range before, if it reaches us.
+        if i > self._head and self._ends[i - 1] >= start - 1:
+            i -= 1
+            start = self._starts[i]
+            end = max(end, self._ends[i])
+            del self._starts[i]
+            del self._ends[i]
+
+        #Swallow every range after that we now reach.
+        j = i
+        while j < len(self._starts) and self._starts[j] <= end + 1:
+            end = max(end, self._ends[j])
+            j += 1
+        del self._starts[i:j]
+        del self._ends[i:j]
+
+        self._starts.insert(i, start)
+        self._ends.insert(i, end)
+
+    def _shrink(self):
+        """If the last free range runs up to the newest id, step the counter back over it instead of keeping it.
+        """
+        if self._head < len(self._ends) and self._ends[-1] == self.next_id - 1:
+            self.next_id = self._starts.pop()
+            self._ends.pop()
+
+    def _trim(self):
+        """Drop used-up ranges from the front once they make up half the list.
+        """
+        if self._head > len(self._starts) // 2:
+            del self._starts[:self._head]
+            del self._ends[:self._head]
+            self._head = 0
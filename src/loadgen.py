@@ -0,0 +1,562 @@
+from typing import Optional
+from dataclasses import dataclass, field
+from json import dumps, loads
+from pathlib import Path
+from os import environ
+from threading import Thread, Lock, Event
+from queue import Queue, Empty
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep, time
+from random import Random
+from math import ceil, log2, sqrt
+from urllib.parse import urlsplit
+import http.client
+import subprocess
+import argparse
+import socket
+import sys
+
+
+#-----------
+# Load Generator
+#-----------
+#Drives the /notes endpoints of app.py from many workers at a fixed arrival rate, e.g.
+#
+#   python loadgen.py --serve offline --rate 200 --duration 30 --mix get=60,get_all=5,post=25,delete=10
+#
+#Requests are sent on a schedule, not when the last one finishes (open loop). Each one's latency is measured
+#from when it was due, so time spent waiting for a free worker behind a slow request is counted instead of
+#hidden. Without that, a stalled server would simply get fewer requests and look faster than it is.
+
+OPERATIONS:tuple = ("get", "get_all", "page", "post", "delete")
+DEFAULT_MIX:str = "get=60,get_all=5,post=25,delete=10"
+
+#-----------
+# Histogram
+#-----------
+
+class Histogram:
+    """Latency histogram with a fixed relative precision, in the style of HdrHistogram.
+
+    Values below 2^sub_bits are counted exactly. Above that, each power of two is split into 2^(sub_bits-1)
+    equal buckets, so any value is off by at most 1 part in 10^digits, at any magnitude, in a few KB.
+    Values are integer microseconds.
+    """
+
+    def __init__(self, digits:int = 3):
+        """
+        Args:
+            digits (int): Significant decimal digits to keep, 1 to 5.
+        """
+        self.digits = digits
+        self.sub_bits = ceil(log2(2 * 10 ** digits))
+        self.sub_count = 1 << self.sub_bits
+        self.half = self.sub_count >> 1
+        self.counts:dict[int, int] = {}
+        self.total = 0
+        self.min:Optional[int] = None
+        self.max = 0
+        self._sum = 0
+        self._squares = 0
+
+    def _index(self, value:int) -> int:
+        if value < self.sub_count:
+            return value
+
+        shift = value.bit_length() - self.sub_bits
+        return self.sub_count + (shift - 1) * self.half + (value >> shift) - self.half
+
+    def _highest(self, index:int) -> int:
+        """The largest value that lands in a bucket. Reported values are rounded up to it, as HdrHistogram does.
+        """
+        if index < self.sub_count:
+            return index
+
+        shift = (index - self.sub_count) // self.half + 1
+        low = ((index - self.sub_count) % self.half + self.half) << shift
+        return low + (1 << shift) - 1
+
+    def record(self, value:int, count:int = 1):
+        """
+        Args:
+            value (int): Microseconds. Negative values are recorded as 0.
+            count (int): How many times it happened.
+        """
+        value = max(int(value),0)
+        index = self._index(value)
+
+        self.counts[index] = self.counts.get(index,0) + count
+        self.total += count
+        self.min = value if self.min is None else min(self.min,value)
+        self.max = max(self.max,value)
+        self._sum += value * count
+        self._squares += value * value * count
+
+    def merge(self, other:"Histogram"):
+        """Add every value in another histogram with the same digits.
+        """
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index,0) + count
+
+        if other.total:
+            self.min = other.min if self.min is None else min(self.min,other.min)
+            self.max = max(self.max,other.max)
+
+        self.total += other.total
+        self._sum += other._sum
+        self._squares += other._squares
+
+    def percentile(self, percent:float) -> int:
+        """
+        Args:
+            percent (float): From 0 to 100.
+
+        Returns:
+            int: The smallest recorded value (rounded up to its bucket) at or above that share of the values.
+        """
+        if self.total == 0:
+            return 0
+
+        rank = max(1,ceil(percent / 100 * self.total))
+        seen = 0
+
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self._highest(index),self.max)
+
+        return self.max
+
+    def mean(self) -> float:
+        return self._sum / self.total if self.total else 0.0
+
+    def stdev(self) -> float:
+        if not self.total:
+            return 0.0
+        return sqrt(max(self._squares / self.total - self.mean() ** 2,0.0))
+
+    def summary(self) -> dict:
+        """
+        Returns:
+            dict: count, min, mean, stdev, max and the usual percentiles, in milliseconds.
+        """
+        ms = lambda us: round(us / 1000,3)
+        result = {"count":self.total,"min_ms":ms(self.min or 0),"mean_ms":ms(self.mean()),"stdev_ms":ms(self.stdev()),"max_ms":ms(self.max)}
+
+        for percent in (50, 90, 99, 99.9, 99.99):
+            result[f"p{percent:g}_ms"] = ms(self.percentile(percent))
+
+        return result
+
+    def distribution(self, ticks:int = 5) -> str:
+        """The percentile distribution in HdrHistogram's .hgrm text format, in milliseconds.
+
+        Each halving of the distance to 100% gets the same number of rows, so the tail is as detailed as the
+        middle. The file can be loaded into HdrHistogram's online plotter as is.
+
+        Args:
+            ticks (int): Rows per halving.
+
+        Returns:
+            str: The table.
+        """
+        lines = [f"{'Value':>12} {'Percentile':>14} {'TotalCount':>10} {'1/(1-Percentile)':>14}", ""]
+        ordered = sorted(self.counts)
+        seen = 0
+        position = 0
+        percent = 0.0
+
+        while self.total:
+            rank = max(1,ceil(percent / 100 * self.total))
+            while seen < rank:
+                seen += self.counts[ordered[position]]
+                position += 1
+
+            value = min(self._highest(ordered[position - 1]),self.max) / 1000
+            fraction = seen / self.total
+            inverse = f"{1 / (1 - fraction):14.2f}" if fraction < 1 else f"{'inf':>14}"
+            lines.append(f"{value:12.3f} {fraction:14.12f} {seen:10d} {inverse}")
+
+            if seen >= self.total:
+                break
+
+            halves = int(log2(100 / (100 - percent))) + 1
+            percent += 100 / (2 ** halves) / ticks
+
+        lines.append(f"#[Mean    = {self.mean() / 1000:12.3f}, StdDeviation   = {self.stdev() / 1000:12.3f}]")
+        lines.append(f"#[Max     = {self.max / 1000:12.3f}, Total count    = {self.total:12d}]")
+        lines.append(f"#[Buckets = {len(self.counts):12d}, SubBuckets     = {self.sub_count:12d}]")
+        return "\n".join(lines) + "\n"
+
+#-----------
+# Workers
+#-----------
+
+@dataclass
+class OpStats:
+    """What happened to one kind of operation.
+    """
+    latency:Histogram = field(default_factory=Histogram)
+    service:Histogram = field(default_factory=Histogram)
+    statuses:dict = field(default_factory=dict)
+    errors:int = 0
+
+    def summary(self) -> dict:
+        count = self.latency.total
+        return {
+            "requests":count,
+            "errors":self.errors,
+            "error_rate":round(self.errors / count,6) if count else 0.0,
+            "statuses":{str(k):v for k, v in sorted(self.statuses.items(),key=lambda item: str(item[0]))},
+            "latency":self.latency.summary(),
+            "service_time":self.service.summary(),
+        }
+
+class LoadGenerator:
+    """Sends a mix of requests at a fixed rate from a pool of workers, and records what came back.
+    """
+
+    def __init__(self, url:str, api_key:str, mix:dict, workers:int, content_bytes:int = 100, seed:int = 1, timeout:float = 30):
+        """
+        Args:
+            url (str): Base URL of the app, like http://127.0.0.1:5000.
+            api_key (str): Sent as X-API-KEY.
+            mix (dict): Operation name to weight.
+            workers (int): Requests that can be in flight at once.
+            content_bytes (int): Size of the content of each posted note.
+            seed (int): Seed for the operation mix and the ids picked.
+            timeout (float): Seconds before a request counts as failed.
+        """
+        parts = urlsplit(url)
+        self.host = parts.hostname or "127.0.0.1"
+        self.port = parts.port or 80
+        self.api_key = api_key
+        self.ops = [name for name, weight in mix.items() if weight > 0]
+        self.weights = [mix[name] for name in self.ops]
+        self.workers = workers
+        self.content = ("lorem ipsum dolor sit amet " * (content_bytes // 27 + 1))[:content_bytes]
+        self.rng = Random(seed)
+        self.timeout = timeout
+        self.ids:list[str] = []
+        self.lock = Lock()
+        self.stats:dict[str, OpStats] = {}
+        self.lag = Histogram()
+
+    def connect(self) -> http.client.HTTPConnection:
+        return http.client.HTTPConnection(self.host,self.port,timeout=self.timeout)
+
+    def request(self, connection:http.client.HTTPConnection, method:str, path:str, body:Optional[dict] = None) -> tuple:
+        """Send one request on a kept-alive connection and read the whole response.
+
+        Returns:
+            tuple: (status, body bytes).
+        """
+        headers = {"X-API-KEY":self.api_key}
+        data = None
+
+        if body is not None:
+            data = dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+
+        connection.request(method,path,body=data,headers=headers)
+        response = connection.getresponse()
+        return response.status, response.read()
+
+    def seed_notes(self, count:int, batch:int = 1000):
+        """Add notes through /notes/batch, so gets and deletes have ids to use.
+
+        Args:
+            count (int): How many.
+            batch (int): Notes per request.
+        """
+        connection = self.connect()
+
+        try:
+            for start in range(0,count,batch):
+                notes = [{"title":f"Seed {i}","content":self.content} for i in range(start,min(start + batch,count))]
+                status, body = self.request(connection,"POST","/notes/batch",{"notes":notes})
+
+                if status != 200:
+                    raise RuntimeError(f"Seeding failed with {status}: {body[:200]!r}")
+
+                self.ids += [str(item["id"]) for item in loads(body)["results"] if item.get("success")]
+        finally:
+            connection.close()
+
+    def pick(self) -> str:
+        with self.lock:
+            return self.rng.choices(self.ops,self.weights)[0]
+
+    def plan(self, op:str) -> tuple:
+        """Turn an operation into a request.
+
+        Returns:
+            tuple: (method, path, body).
+        """
+        with self.lock:
+            if op == "get":
+                id = self.rng.choice(self.ids) if self.ids else "0"
+                return "GET", f"/notes?id={id}", None
+
+            if op == "delete":
+                #Take the id out of the pool, so later gets don't go looking for it.
+                id = self.ids.pop(self.rng.randrange(len(self.ids))) if self.ids else str(self.rng.randrange(1000000))
+                return "DELETE", f"/notes?id={id}", None
+
+        if op == "get_all":
+            return "GET", "/notes", None
+
+        if op == "page":
+            return "GET", "/notes?limit=100", None
+
+        return "POST", "/notes", {"title":f"Load {perf_counter()}","content":self.content}
+
+    def record(self, op:str, due:float, started:float, finished:float, status:Optional[int], counted:bool):
+        with self.lock:
+            if not counted:
+                return
+
+            stats = self.stats.setdefault(op,OpStats())
+            stats.latency.record((finished - due) * 1e6)
+            stats.service.record((finished - started) * 1e6)
+            stats.statuses[status if status is not None else "exception"] = stats.statuses.get(status if status is not None else "exception",0) + 1
+
+            if status is None or status >= 400:
+                stats.errors += 1
+
+            self.lag.record((started - due) * 1e6)
+
+    def worker(self, queue:Queue, done:Event):
+        connection = self.connect()
+
+        while True:
+            try:
+                item = queue.get(timeout=0.1)
+            except Empty:
+                if done.is_set():
+                    break
+                continue
+
+            op, due, counted = item
+            method, path, body = self.plan(op)
+            started = perf_counter()
+
+            try:
+                status, _ = self.request(connection,method,path,body)
+            except (OSError, http.client.HTTPException):
+                status = None
+                connection.close()
+                connection = self.connect()
+
+            self.record(op,due,started,perf_counter(),status,counted)
+
+        connection.close()
+
+    def run(self, rate:float, duration:float, warmup:float = 0, poisson:bool = False) -> dict:
+        """Send requests at rate per second for warmup + duration seconds. Only the last duration seconds are counted.
+
+        Args:
+            rate (float): Requests per second.
+            duration (float): Seconds counted.
+            warmup (float): Seconds sent first and not counted.
+            poisson (bool): Random gaps with the same average, instead of evenly spaced requests.
+
+        Returns:
+            dict: Summary of the run.
+        """
+        queue:Queue = Queue()
+        done = Event()
+        threads = [Thread(target=self.worker,args=(queue,done),name=f"load-{i}",daemon=True) for i in range(self.workers)]
+
+        for thread in threads:
+            thread.start()
+
+        start = perf_counter()
+        end = start + warmup + duration
+        due = start
+        sent = 0
+
+        #The schedule never waits on responses. If the workers fall behind, requests queue up and their wait is counted.
+        while due < end:
+            delay = due - perf_counter()
+            if delay > 0:
+                sleep(delay)
+
+            queue.put((self.pick(),due,due >= start + warmup))
+            sent += 1
+            due += self.rng.expovariate(rate) if poisson else 1 / rate
+
+        scheduled = perf_counter() - start
+        done.set()
+
+        for thread in threads:
+            thread.join()
+
+        elapsed = perf_counter() - start
+        total = OpStats()
+        for stats in self.stats.values():
+            total.latency.merge(stats.latency)
+            total.service.merge(stats.service)
+            total.errors += stats.errors
+            for status, count in stats.statuses.items():
+                total.statuses[status] = total.statuses.get(status,0) + count
+
+        return {
+            "rate":rate,
+            "duration":duration,
+            "warmup":warmup,
+            "workers":self.workers,
+            "arrivals":"poisson" if poisson else "constant",
+            "sent":sent,
+            "achieved_rate":round(total.latency.total / max(elapsed - warmup,1e-9),3),
+            "drain_seconds":round(elapsed - scheduled,3),
+            "start_lag":self.lag.summary(),
+            "total":total.summary(),
+            "operations":{op:stats.summary() for op, stats in sorted(self.stats.items())},
+        }
+
+#-----------
+# Serving the App
+#-----------
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1",0))
+        return s.getsockname()[1]
+
+def serve_app(mode:str, folder:str, api_key:str, extra:dict) -> tuple:
+    """Start app.py in its own process against the offline backend or a fake bucket, and run setup.
+
+    Args:
+        mode (str): "offline" or "fake".
+        folder (str): Where the local files go.
+        api_key (str): The key the app should expect.
+        extra (dict): More environment for the app.
+
+    Returns:
+        tuple: (url, app process, fake bucket server or None).
+    """
+    fake = None
+    port = free_port()
+    env = dict(environ)
+    env.update({"PORT":str(port),"API_KEY":api_key,"LOCAL":str(Path(folder) / "notes.json"),"SQLITE_FILE":str(Path(folder) / "notes.db")})
+
+    if mode == "fake":
+        from fake_gcs import FakeGCS
+        fake = FakeGCS(buckets=("load",))
+        env.update({"STORAGE_SOURCE":"online","GCS_ENDPOINT":fake.start()})
+    else:
+        env["STORAGE_SOURCE"] = "offline"
+
+    env.update(extra)
+
+    process = subprocess.Popen([sys.executable,str(Path(__file__).with_name("app.py"))],env=env,cwd=folder,
+                               stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+
+    #Wait for it to answer, then run setup the way a client would.
+    for _ in range(200):
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1",port,timeout=5)
+            connection.request("POST","/setup",body=dumps({"bucket":"load"}),headers={"Content-Type":"application/json"})
+            status = connection.getresponse().status
+            connection.close()
+
+            if status == 200:
+                return url, process, fake
+        except OSError:
+            pass
+
+        if process.poll() is not None:
+            break
+        sleep(0.05)
+
+    process.kill()
+    if fake is not None:
+        fake.stop()
+    raise RuntimeError("app.py didn't start.")
+
+def parse_mix(text:str) -> dict:
+    """
+    Args:
+        text (str): Like "get=60,post=30,delete=10".
+
+    Returns:
+        dict: Operation name to weight.
+    """
+    mix = {}
+
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown operation {name}. Use {', '.join(OPERATIONS)}.")
+
+        mix[name] = float(weight or 1)
+
+    return mix
+
+def main():
+    """Parse arguments, start the app if asked, and run the load.
+    """
+    parser = argparse.ArgumentParser(description="Open-loop load generator for the notes API. Prints JSON.")
+    parser.add_argument("--url",help="Base URL of a running app. Leave out and use --serve to start one.")
+    parser.add_argument("--serve",choices=["offline","fake"],help="Start app.py against the offline backend or a local fake bucket.")
+    parser.add_argument("--api-key",default=environ.get("API_KEY") or "default_key")
+    parser.add_argument("--rate",type=float,default=100,help="Requests per second.")
+    parser.add_argument("--duration",type=float,default=30,help="Seconds counted.")
+    parser.add_argument("--warmup",type=float,default=5,help="Seconds sent first and not counted.")
+    parser.add_argument("--workers",type=int,default=64,help="Most requests in flight at once.")
+    parser.add_argument("--mix",default=DEFAULT_MIX,help=f"Operation weights out of {', '.join(OPERATIONS)}.")
+    parser.add_argument("--poisson",action="store_true",help="Random gaps between requests instead of even ones.")
+    parser.add_argument("--seed-notes",type=int,default=1000,help="Notes added through /notes/batch before the run.")
+    parser.add_argument("--content-bytes",type=int,default=100)
+    parser.add_argument("--seed",type=int,default=1)
+    parser.add_argument("--timeout",type=float,default=30)
+    parser.add_argument("--env",action="append",default=[],help="KEY=VALUE for the app started by --serve. Can be repeated.")
+    parser.add_argument("--hgrm",help="Also write a .hgrm percentile distribution per operation, named with this prefix.")
+    parser.add_argument("--out",help="Write the JSON here instead of printing it.")
+    args = parser.parse_args()
+
+    if (args.url is None) == (args.serve is None):
+        parser.error("Give exactly one of --url and --serve.")
+
+    with TemporaryDirectory(prefix="notes-load-") as folder:
+        process = fake = None
+        url = args.url
+
+        if args.serve:
+            print(f"Starting app.py against {args.serve} storage...",file=sys.stderr)
+            url, process, fake = serve_app(args.serve,folder,args.api_key,dict(pair.split("=",1) for pair in args.env))
+
+        try:
+            load = LoadGenerator(url,args.api_key,parse_mix(args.mix),args.workers,args.content_bytes,args.seed,args.timeout)
+
+            if args.seed_notes:
+                print(f"Seeding {args.seed_notes} notes...",file=sys.stderr)
+                load.seed_notes(args.seed_notes)
+
+            print(f"Sending {args.rate:g} requests per second for {args.warmup + args.duration:g} seconds...",file=sys.stderr)
+            report = {"started":time(),"url":url,"serve":args.serve,"mix":parse_mix(args.mix),**load.run(args.rate,args.duration,args.warmup,args.poisson)}
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait()
+            if fake is not None:
+                fake.stop()
+
+    if args.hgrm:
+        for op, stats in load.stats.items():
+            Path(f"{args.hgrm}-{op}.hgrm").write_text(stats.latency.distribution(),encoding="utf-8")
+
+    text = dumps(report,indent=2)
+
+    if args.out:
+        Path(args.out).write_text(text,encoding="utf-8")
+        print(f"Wrote {args.out}",file=sys.stderr)
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
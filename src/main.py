@@ -1,15 +1,33 @@
 
 
-from typing import Optional, Tuple
+from typing import Optional, Tuple, Iterator
 from dataclasses import dataclass, field
 from json import loads, dumps, load, dump, JSONDecodeError
 from google.cloud import storage
 from google.cloud.storage import Blob
 from google.api_core import exceptions as gcs_ex
+from google.auth.credentials import AnonymousCredentials
 from pathlib import Path
-from os import getenv
+from os import getenv, fsync, replace
 from enum import Enum
+from threading import Lock, RLock, Event, Thread, local
+from concurrent.futures import ThreadPoolExecutor, Future
+from itertools import chain, islice
+from heapq import nsmallest, merge
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from binascii import Error as B64Error
+from queue import Queue, Empty
+from zlib import crc32
+import sqlite3
+from time import perf_counter, time, sleep
+from random import random
 from dotenv import load_dotenv
+from ids import IdAllocator
+from search import SearchIndex
+from store import NoteStore, MemoryStore
+from metrics import REGISTRY
+from tracing import TRACER, span, traced, propagate
+import atexit
 
 
 #-----------
@@ -25,6 +43,7 @@ class ErrorCode(Enum):
     PERMISSION_DENIED_USE_LOCAL = 6
     SERVER_ERROR_USE_LOCAL = 7
     SETUP_REQUIRED = 8
+    INDEX_NOT_READY = 9
 
 
 #Dataclass for storing instances of variables. A full class isn't quite needed here. (Maybe in the future.)
@@ -35,15 +54,206 @@ class StorageState:
     bucket: Optional[storage.Bucket] = None
     blob_name: Optional[str] = "notes.json"
     blob_r:Optional[Blob] = None
-    id_count: int = 0
-    old_ids:list[int] = field(default_factory=list)
+    meta_r:Optional[Blob] = None
+    ids:IdAllocator = field(default_factory=IdAllocator)
     source:str =  "online"
+    store:Optional[NoteStore] = None
+    shard_count:int = 1
+    log_lock:Lock = field(default_factory=Lock)
+    log_records:int = 0
+    log_bytes:int = 0
+    snapshot_lock:Lock = field(default_factory=Lock)
+    compactor:Optional[Thread] = None
+    compact_event:Event = field(default_factory=Event)
+    compactions:int = 0
+    last_compaction:Optional[dict] = None
+    write_lock:RLock = field(default_factory=RLock)
+    cache:Optional[dict] = None
+    dirty_since:Optional[float] = None
+    last_write:float = 0.0
+    pending_writes:int = 0
+    flush_lock:Lock = field(default_factory=Lock)
+    flush_event:Event = field(default_factory=Event)
+    flusher:Optional[Thread] = None
+    flushes:int = 0
+    blob_copy:Optional[Tuple[int,dict]] = None
+    blob_reads_skipped:int = 0
+    blob_reads_full:int = 0
+    conflicts:int = 0
+    conflict_retries:int = 0
+    conflicts_exhausted:int = 0
+    group_commit:bool = False
+    commit_queue:Queue = field(default_factory=Queue)
+    committer:Optional[Thread] = None
+    batches:int = 0
+    batched_writes:int = 0
+    db:Optional[sqlite3.Connection] = None
+    db_lock:Lock = field(default_factory=Lock)
+    search:Optional[SearchIndex] = None
+    search_lock:Lock = field(default_factory=Lock)
+    search_ready:Event = field(default_factory=Event)
+    search_backlog:Optional[list] = None
+    search_builds:int = 0
+    search_builds_finished:int = 0
 
 state = StorageState()
 
+#Generations of the objects each thread has read, so its next upload can require that nobody wrote in between.
+seen = local()
+
+#-----------
+# Metrics
+#-----------
+
+STORAGE_SECONDS = REGISTRY.histogram("notes_storage_seconds","Time spent loading or saving the whole store, or its meta.",("operation","backend"))
+STORAGE_BYTES = REGISTRY.counter("notes_storage_bytes_total","Bytes of notes and meta read from or written to the bucket or local files.",("direction","backend"))
+NOTES_COUNT = REGISTRY.gauge("notes_count","Notes in the store as of the last full load or save.")
+META_BYTES = REGISTRY.gauge("notes_meta_bytes","Size of the serialized meta as of the last time it was read or written.")
+
+def backend_name() -> str:
+    """Name the current store for metric labels.
+
+    Returns:
+        str: e.g. "online/blob", "offline/log", "sqlite" or "memory".
+    """
+    if state.source == "online":
+        return f"online/{ONLINE_LAYOUT}"
+
+    if state.source == "offline":
+        return f"offline/{LOCAL_MODE}"
+
+    return state.source
+
+def count_bytes(direction:str,size:int):
+    """Add to the bytes read or written.
+
+    Args:
+        direction (str): "read" or "written".
+        size (int): Bytes. JSON is dumped ASCII-only, so its length in characters is its length in bytes.
+    """
+    STORAGE_BYTES.inc(size,direction=direction,backend=backend_name())
+
+def storage_counters() -> list:
+    """The counters the storage state already keeps, for the /metrics scrape.
+
+    Returns:
+        list: (name, kind, help, value) tuples.
+    """
+    return [
+        ("notes_compactions_total","counter","Log compactions finished.",state.compactions),
+        ("notes_last_compaction_seconds","gauge","How long the last log compaction took.",state.last_compaction["duration_ms"] / 1000 if state.last_compaction else 0),
+        ("notes_log_records","gauge","Records in the local log since the last compaction.",state.log_records),
+        ("notes_log_bytes","gauge","Bytes in the local log since the last compaction.",state.log_bytes),
+        ("notes_cache_flushes_total","counter","Write-behind cache flushes.",state.flushes),
+        ("notes_cache_pending_writes","gauge","Writes in the cache waiting to be flushed.",state.pending_writes),
+        ("notes_blob_reads_skipped_total","counter","notes.json reads answered from memory because its generation hadn't changed.",state.blob_reads_skipped),
+        ("notes_blob_reads_full_total","counter","notes.json reads that downloaded the body.",state.blob_reads_full),
+        ("notes_write_conflicts_total","counter","Writes that lost a race with another server.",state.conflicts),
+        ("notes_conflict_retries_total","counter","Retries after a lost race.",state.conflict_retries),
+        ("notes_conflicts_exhausted_total","counter","Writes that gave up after CONFLICT_RETRIES.",state.conflicts_exhausted),
+        ("notes_group_commit_batches_total","counter","Group commit batches written.",state.batches),
+        ("notes_group_commit_writes_total","counter","Writes applied through group commit.",state.batched_writes),
+        ("notes_free_ids","gauge","Freed ids waiting to be reused.",len(state.ids)),
+        ("notes_search_builds_total","counter","Search index builds finished.",state.search_builds_finished),
+        ("notes_search_indexed","gauge","Notes in the search index.",len(state.search) if state.search is not None else 0),
+    ]
+
+REGISTRY.collector(storage_counters)
+
 load_dotenv()
 LOCAL_FILE:str = getenv("LOCAL") or "local_notes.json"
 
+#The offline id allocator and counters, kept apart from the notes so they can be written on their own.
+LOCAL_META:str = getenv("LOCAL_META") or str(Path(LOCAL_FILE).with_suffix(".meta.json"))
+
+#Bumped when the layout of the meta changes. 2 is the first with meta split out of the notes.
+META_SCHEMA:int = 2
+
+#Where setup() stores notes. "online" tries the bucket and falls back to FALLBACK_SOURCE if it can't be used.
+#"offline" (LOCAL_FILE), "sqlite" (SQLITE_FILE) and "memory" (nothing kept past the process) skip the bucket entirely.
+STORAGE_SOURCE:str = getenv("STORAGE_SOURCE") or "online"
+FALLBACK_SOURCE:str = getenv("FALLBACK_SOURCE") or "offline"
+SQLITE_FILE:str = getenv("SQLITE_FILE") or "notes.db"
+
+#Hand deleted ids back out. With 0, ids only ever go up and _meta never has to remember freed ones.
+ID_REUSE:bool = getenv("ID_REUSE", "1") == "1"
+
+#"file" rewrites LOCAL_FILE on every change. "log" appends each change to LOCAL_LOG and keeps LOCAL_FILE as the snapshot.
+LOCAL_MODE:str = getenv("LOCAL_MODE") or "file"
+LOCAL_LOG:str = getenv("LOCAL_LOG") or LOCAL_FILE + ".log"
+LOG_FSYNC:bool = getenv("LOG_FSYNC", "0") == "1"
+
+#Compaction folds the log into the snapshot once either threshold is crossed. Checked every LOG_COMPACT_INTERVAL seconds.
+LOG_COMPACT_BYTES:int = int(getenv("LOG_COMPACT_BYTES") or 8 * 1024 * 1024)
+LOG_COMPACT_RECORDS:int = int(getenv("LOG_COMPACT_RECORDS") or 10000)
+LOG_COMPACT_INTERVAL:float = float(getenv("LOG_COMPACT_INTERVAL") or 30)
+
+#"blob" keeps every note in one notes.json. "objects" keeps each note in its own NOTES_PREFIX<id>.json, with ids in META_BLOB.
+#"sharded" spreads notes over SHARD_COUNT notes-NN.json objects by a hash of the id, also with ids in META_BLOB.
+ONLINE_LAYOUT:str = getenv("ONLINE_LAYOUT") or "blob"
+SHARD_COUNT:int = int(getenv("SHARD_COUNT") or 16)
+NOTES_PREFIX:str = getenv("NOTES_PREFIX") or "notes/"
+
+#Object names pad ids to this many digits, so listing the bucket returns notes in id order.
+OBJECT_ID_DIGITS:int = 12
+META_BLOB:str = getenv("META_BLOB") or "notes-meta.json"
+GCS_WORKERS:int = int(getenv("GCS_WORKERS") or 16)
+
+#Talk to this URL instead of Google, with no credentials. For the local stand-in in fake_gcs.py.
+GCS_ENDPOINT:Optional[str] = getenv("GCS_ENDPOINT") or None
+
+#Keep notes.json (or the local file) in memory after setup and upload changes in the background. Only use with a single writer.
+#A flush happens FLUSH_INTERVAL seconds after the last write, but never later than MAX_DIRTY_AGE seconds after the first
+#unflushed one, or straight away once MAX_PENDING_WRITES writes are waiting.
+WRITE_BEHIND:bool = getenv("WRITE_BEHIND", "0") == "1"
+FLUSH_INTERVAL:float = float(getenv("FLUSH_INTERVAL") or 1)
+MAX_DIRTY_AGE:float = float(getenv("MAX_DIRTY_AGE") or 5)
+MAX_PENDING_WRITES:int = int(getenv("MAX_PENDING_WRITES") or 100)
+
+#Remember the last notes.json we saw and only download it again if its generation has changed.
+CONDITIONAL_READS:bool = getenv("CONDITIONAL_READS", "1") == "1"
+
+#A write that loses a race (HTTP 412) starts over with a fresh read, up to CONFLICT_RETRIES times.
+#Waits are random up to CONFLICT_BACKOFF * 2^attempt seconds, capped at CONFLICT_BACKOFF_MAX.
+CONFLICT_RETRIES:int = int(getenv("CONFLICT_RETRIES") or 5)
+CONFLICT_BACKOFF:float = float(getenv("CONFLICT_BACKOFF") or 0.05)
+CONFLICT_BACKOFF_MAX:float = float(getenv("CONFLICT_BACKOFF_MAX") or 1)
+
+#Queue concurrent writes to notes.json or the local file and apply them with one load and one save per batch.
+#A batch is up to GROUP_COMMIT_MAX_BATCH writes, gathered for at most GROUP_COMMIT_MAX_WAIT seconds after the first.
+GROUP_COMMIT:bool = getenv("GROUP_COMMIT", "0") == "1"
+GROUP_COMMIT_MAX_BATCH:int = int(getenv("GROUP_COMMIT_MAX_BATCH") or 64)
+GROUP_COMMIT_MAX_WAIT:float = float(getenv("GROUP_COMMIT_MAX_WAIT") or 0.005)
+
+#Listing all notes reads this many at a time from SQLite or note objects, so only one chunk is held per request.
+STREAM_CHUNK:int = int(getenv("STREAM_CHUNK") or 500)
+
+#Paged listings return PAGE_LIMIT notes unless asked for fewer or more, and never more than PAGE_LIMIT_MAX.
+PAGE_LIMIT:int = int(getenv("PAGE_LIMIT") or 100)
+PAGE_LIMIT_MAX:int = int(getenv("PAGE_LIMIT_MAX") or 1000)
+
+#Most notes or ids accepted by one batch request.
+BATCH_MAX:int = int(getenv("BATCH_MAX") or 10000)
+
+#Keep an in-memory search index over every note, built in the background after setup and kept up to date by this
+#server's writes. Searches wait up to SEARCH_WAIT seconds for the build and return SEARCH_LIMIT results unless asked.
+SEARCH_INDEX:bool = getenv("SEARCH_INDEX", "1") == "1"
+SEARCH_WAIT:float = float(getenv("SEARCH_WAIT") or 5)
+SEARCH_LIMIT:int = int(getenv("SEARCH_LIMIT") or 10)
+
+#Least share of a title~= search's trigrams a title needs to count as a near match. Above 1 allows substrings only.
+TITLE_SIMILARITY:float = float(getenv("TITLE_SIMILARITY") or 0.5)
+
+#Record a span for every storage call, grouped into one trace per request and kept for GET /traces/<id>.
+#The newest TRACE_KEEP traces are kept. With TRACE_EXPORT set, each finished trace is also appended to it as a line of JSON.
+TRACING:bool = getenv("TRACING", "1") == "1"
+TRACE_KEEP:int = int(getenv("TRACE_KEEP") or 1000)
+TRACE_EXPORT:Optional[str] = getenv("TRACE_EXPORT") or None
+
+#Streaming the objects layout downloads every note, each in its own span. Past TRACE_MAX_SPANS, spans are only counted.
+TRACE_MAX_SPANS:int = int(getenv("TRACE_MAX_SPANS") or 1000)
+TRACER.configure(TRACING,TRACE_KEEP,TRACE_EXPORT,TRACE_MAX_SPANS)
+
 
 #-----------
 # Try/except Wrapper
@@ -77,11 +287,26 @@ def catch_errors_3(func):
             return (False, str(e),None)
     return catch
 
+def catch_errors_4(func):
+    """Wrapper that handles try/except in functions using the specified Tuple schema. Assumes 4 things in tuple.
+
+    Args:
+        func (function): name of the function to wrap. Usually automatic with the @ syntax.
+    """
+    def catch(*args, **kwargs):
+        try:
+            return func(*args,**kwargs)
+        except Exception as e:
+
+            return (False, str(e),None,None)
+    return catch
+
 #---------
 # Setup functions
 #----------
 
 
+@traced("setup")
 def setup(bucket_n:Optional[str]) -> Tuple[bool, Optional[ErrorCode]]:
     """Set up storage and state object
 
@@ -103,10 +328,27 @@ def setup(bucket_n:Optional[str]) -> Tuple[bool, Optional[ErrorCode]]:
     if not ok:
         return (False, ErrorCode.INVALID_INPUT)
     
+    #Anything still waiting in the cache belongs to the old storage, so write it there first.
+    release_cache()
+
+    #A local source was asked for, so there's no bucket to connect to.
+    if STORAGE_SOURCE != "online":
+        state.client = None
+        state.bucket = None
+        state.blob_r = None
+        state.meta_r = None
+        state.source = STORAGE_SOURCE
+        setup_ensure_meta()
+        return (True,None)
+
     #Set up our stuff
     try:
         #Get the client
-        state.client = storage.Client(project=" project-2-483120")
+        with span("gcs.client"):
+            if GCS_ENDPOINT:
+                state.client = storage.Client(project=" project-2-483120",credentials=AnonymousCredentials(),client_options={"api_endpoint":GCS_ENDPOINT})
+            else:
+                state.client = storage.Client(project=" project-2-483120")
 
         #Set the state of our client
         state.bucket_name = bucket_n
@@ -116,17 +358,34 @@ def setup(bucket_n:Optional[str]) -> Tuple[bool, Optional[ErrorCode]]:
 
         #Attach our blob
         state.blob_r = state.bucket.blob(state.blob_name)
+        state.meta_r = state.bucket.blob(META_BLOB)
+        forget_blob()
 
         #Ensure the file exists.
-        if not state.blob_r.exists():
-            state.blob_r.upload_from_string("{}")
+        if ONLINE_LAYOUT in ("objects","sharded"):
+            #There is no notes.json here. Touching the meta object is enough to surface a missing bucket or bad permissions.
+            with span("gcs.exists",object=META_BLOB) as s:
+                s.set(exists=state.meta_r.exists())
+        else:
+            with span("gcs.exists",object=state.blob_name) as s:
+                exists = state.blob_r.exists()
+                s.set(exists=exists)
+
+            if not exists:
+                try:
+                    #Only create it. Another server may have beaten us to it.
+                    with span("gcs.upload",object=state.blob_name,bytes=2):
+                        state.blob_r.upload_from_string("{}",if_generation_match=0)
+                except gcs_ex.PreconditionFailed:
+                    pass
 
     except gcs_ex.NotFound as e:
     # Bucket does not exist.
         state.client = None
         state.bucket = None
         state.blob_r = None
-        state.source = "offline"
+        state.meta_r = None
+        state.source = FALLBACK_SOURCE
         setup_ensure_meta()
         return (False, ErrorCode.NOT_FOUND_USE_LOCAL)
     
@@ -135,7 +394,8 @@ def setup(bucket_n:Optional[str]) -> Tuple[bool, Optional[ErrorCode]]:
         state.client = None
         state.bucket = None
         state.blob_r = None
-        state.source = "offline"
+        state.meta_r = None
+        state.source = FALLBACK_SOURCE
         setup_ensure_meta()
         return (False, ErrorCode.PERMISSION_DENIED_USE_LOCAL)
 
@@ -147,7 +407,8 @@ def setup(bucket_n:Optional[str]) -> Tuple[bool, Optional[ErrorCode]]:
         state.bucket_name = ""
         state.bucket = None
         state.blob_r = None
-        state.source = "offline"
+        state.meta_r = None
+        state.source = FALLBACK_SOURCE
         setup_ensure_meta()
         return (False,ErrorCode.SERVER_ERROR_USE_LOCAL)
     
@@ -170,13 +431,9 @@ def health_check() -> Tuple[bool, str]:
             - bool: True if setup was success without errors. False if not. 
             - str: Error Message if bool is False. Confirmation message if bool is True.
     """
-    if state.source == "offline" and not Path(LOCAL_FILE).exists():
-        return (False,"Server is responding. Setup has not been ran.")
-        
-    if state.source == "online" and (state.blob_r is None or state.bucket is None):
+    if setup_error() is not None:
         return (False,"Server is responding. Setup has not been run yet.")
-    
-    
+
     return (True,"Server is responding. Setup has been ran.")
 
 
@@ -208,21 +465,73 @@ def add_note(title:str,content:str) -> Tuple[bool,Optional[ErrorCode]]:
         return (False,ErrorCode.INVALID_INPUT)
 
     #Check our sources to ensure setup has ran
-    if state.source == "offline" and not Path(LOCAL_FILE).exists():
-        return (False,ErrorCode.SETUP_REQUIRED)
-        
-    if state.source == "online" and (state.blob_r is None or state.bucket is None):
-        return (False,ErrorCode.SETUP_REQUIRED)
-    
+    err = setup_error()
+    if err is not None:
+        return (False,err)
 
-    notes = load_notes() or {}
+    note = {"title":title,"content":content}
 
-    id = generate_id()
+    #Wait for the group commit writer to save it along with everyone else's.
+    if state.group_commit:
+        id = submit_write(lambda notes: insert_note(notes,note)).result()
+        index_notes([(id,note)])
+        return (True,None)
 
-    notes[str(id)] = {"title":title,"content":content}
-    persist(notes)
+    #Writes in this process take turns, so two of them can't load the same notes and lose each other's change.
+    #Other servers are caught by the generation checks, and the write is retried.
+    with state.write_lock:
+        id = state.store.put([note])[0]
+
+    index_notes([(id,note)])
     return (True,None)
 
+@catch_errors_3
+def add_notes(items:list) -> Tuple[bool,Optional[ErrorCode],Optional[list]]:
+    """Add many notes with one load and one save.
+
+    Args:
+        items (list): Notes, each a dict with a non-empty "title" and "content".
+
+    Returns:
+        Tuple[bool,Optional[str],Optional[list]]:
+            - bool: True if setup was success without errors. False if not.
+            - str: Error Message if bool is False. None if True
+            - list: One result per item, in order. {"success": True, "id"} or {"success": False, "error"}.
+    """
+    if not isinstance(items,list) or len(items) > BATCH_MAX:
+        return (False,ErrorCode.INVALID_INPUT,None)
+
+    err = setup_error()
+    if err is not None:
+        return (False,err,None)
+
+    #A bad item only fails itself. The rest are still added.
+    results = []
+    notes = []
+    for item in items:
+        if not isinstance(item,dict) or not check_string(item.get("title"),item.get("content"))[0]:
+            results.append({"success":False,"error":"title and content fields are required."})
+            continue
+
+        results.append(None)
+        notes.append({"title":item["title"],"content":item["content"]})
+
+    if notes:
+        if state.group_commit:
+            ids = submit_write(lambda document: [insert_note(document,note) for note in notes]).result()
+
+        else:
+            with state.write_lock:
+                ids = state.store.put(notes)
+
+        index_notes(list(zip(ids,notes)))
+
+        ids = iter(ids)
+        results = [result or {"success":True,"id":next(ids)} for result in results]
+
+    print(f"Adding {len(notes)} of {len(items)} notes successful.")
+    return (True,None,results)
+
 @catch_errors_3
 def get_note(id:Optional[str] = None) -> Tuple[bool,Optional[ErrorCode],Optional[dict]]:
     """Get note/notes from cloud storage and serves them.
@@ -237,23 +546,19 @@ def get_note(id:Optional[str] = None) -> Tuple[bool,Optional[ErrorCode],Optional
             - dict: The notes id in string form: the notes retrieved
     """
 
-    #Discriminate between sources
-    if state.source == "offline" and not Path(LOCAL_FILE).exists():
-            return (False,ErrorCode.SETUP_REQUIRED,None)
-        
-    if state.source == "online" and (state.blob_r is None or state.bucket is None):
-        return (False,ErrorCode.SETUP_REQUIRED,None)
-    
-    notes = load_notes()
-    
+    err = setup_error()
+    if err is not None:
+        return (False,err,None)
+
     if id is None:
+        notes = load_notes()
         print("Getting all notes successful.")
         return(True,None,hide_meta(notes))
     
     if parse_id(id) != None:
         return (False,ErrorCode.INVALID_INPUT,None)
     
-    entry = notes.get(id,None)
+    entry = state.store.get(id)
 
     if entry is None:
         print("Getting note with Id failed because Id does not exist.")
@@ -263,6 +568,199 @@ def get_note(id:Optional[str] = None) -> Tuple[bool,Optional[ErrorCode],Optional
     return(True,None,entry)
         
 
+@catch_errors_3
+def stream_notes() -> Tuple[bool,Optional[ErrorCode],Optional["NoteStream"]]:
+    """Get every note as an iterator, so they can be sent as they're read instead of all at once.
+
+    Returns:
+        Tuple[bool,Optional[str],Optional[NoteStream]]:
+            - bool: True if setup was success without errors. False if not.
+            - str: Error Message if bool is False. None if True
+            - NoteStream: (id, note) pairs, in the order the store keeps them.
+    """
+    err = setup_error()
+    if err is not None:
+        return (False,err,None)
+
+    #Read the first note now, so a storage error is still reported as one instead of cutting off a started response.
+    notes = iter_notes()
+    first = next(notes,None)
+
+    print("Getting all notes successful.")
+    return (True,None,NoteStream(notes if first is None else chain([first],notes)))
+
+@catch_errors_3
+def get_notes(ids:list) -> Tuple[bool,Optional[ErrorCode],Optional[dict]]:
+    """Get many notes by id, reading each part of the store at most once.
+
+    Args:
+        ids (list): Ids of the notes in string form. Ids must be positive.
+
+    Returns:
+        Tuple[bool,Optional[str],Optional[dict]]:
+            - bool: True if setup was success without errors. False if not.
+            - str: Error Message if bool is False. None if True
+            - dict: The notes id in string form: the note, or None if it doesn't exist.
+    """
+    if not isinstance(ids,list) or len(ids) > BATCH_MAX:
+        return (False,ErrorCode.INVALID_INPUT,None)
+
+    if any(parse_id(id) != None for id in ids):
+        return (False,ErrorCode.INVALID_INPUT,None)
+
+    err = setup_error()
+    if err is not None:
+        return (False,err,None)
+
+    #"007" and "7" are the same note.
+    ids = [str(int(id)) for id in ids]
+    notes = state.store.get_many(ids)
+
+    print(f"Getting {len(ids)} notes by Id successful.")
+    return (True,None,{id:notes.get(id,None) for id in ids})
+
+@catch_errors_3
+def search_notes(query:Optional[str],limit:Optional[str] = None) -> Tuple[bool,Optional[ErrorCode],Optional[list]]:
+    """Full-text search over note titles and content, best match first.
+
+    Args:
+        query (Optional[str]): Words to search for. Must be a non-empty string.
+        limit (Optional[str]): Most results to return, in string form. SEARCH_LIMIT if not provided, and never more than PAGE_LIMIT_MAX.
+
+    Returns:
+        Tuple[bool,Optional[str],Optional[list]]:
+            - bool: True if setup was success without errors. False if not.
+            - str: Error Message if bool is False. None if True
+            - list: {"id", "title", "score"} for each match.
+    """
+    ok, _ = check_string(query)
+    if not ok:
+        return (False,ErrorCode.INVALID_INPUT,None)
+
+    if limit is None:
+        limit = SEARCH_LIMIT
+    elif parse_id(limit) != None or int(limit) == 0:
+        return (False,ErrorCode.INVALID_INPUT,None)
+
+    err = setup_error()
+    if err is not None:
+        return (False,err,None)
+
+    if not state.search_ready.wait(SEARCH_WAIT):
+        return (False,ErrorCode.INDEX_NOT_READY,None)
+
+    with state.search_lock:
+        hits = state.search.search(query,min(int(limit),PAGE_LIMIT_MAX))
+        results = [{"id":id,"title":state.search.title(id),"score":round(score,4)} for id, score in hits]
+
+    print("Searching notes successful.")
+    return (True,None,results)
+
+@catch_errors_3
+def search_titles(query:Optional[str],limit:Optional[str] = None) -> Tuple[bool,Optional[ErrorCode],Optional[list]]:
+    """Find notes whose title contains the query, then ones whose title nearly matches it.
+
+    Args:
+        query (Optional[str]): Part of a title. Must be a non-empty string.
+        limit (Optional[str]): Most results to return, in string form. SEARCH_LIMIT if not provided, and never more than PAGE_LIMIT_MAX.
+
+    Returns:
+        Tuple[bool,Optional[str],Optional[list]]:
+            - bool: True if setup was success without errors. False if not.
+            - str: Error Message if bool is False. None if True
+            - list: {"id", "title", "score"} for each match. Titles containing the query score 1.
+    """
+    ok, _ = check_string(query)
+    if not ok:
+        return (False,ErrorCode.INVALID_INPUT,None)
+
+    if limit is None:
+        limit = SEARCH_LIMIT
+    elif parse_id(limit) != None or int(limit) == 0:
+        return (False,ErrorCode.INVALID_INPUT,None)
+
+    err = setup_error()
+    if err is not None:
+        return (False,err,None)
+
+    if not state.search_ready.wait(SEARCH_WAIT):
+        return (False,ErrorCode.INDEX_NOT_READY,None)
+
+    with state.search_lock:
+        hits = state.search.match_title(query,min(int(limit),PAGE_LIMIT_MAX),TITLE_SIMILARITY)
+        results = [{"id":id,"title":state.search.title(id),"score":round(score,4)} for id, score in hits]
+
+    print("Searching note titles successful.")
+    return (True,None,results)
+
+@catch_errors_3
+def autocomplete(prefix:Optional[str],limit:Optional[str] = None) -> Tuple[bool,Optional[ErrorCode],Optional[list]]:
+    """Titles that start with a prefix, for suggesting as someone types. Only the search index is read.
+
+    Args:
+        prefix (Optional[str]): Start of a title. Must be a non-empty string.
+        limit (Optional[str]): Most titles to return, in string form. SEARCH_LIMIT if not provided, and never more than PAGE_LIMIT_MAX.
+
+    Returns:
+        Tuple[bool,Optional[str],Optional[list]]:
+            - bool: True if setup was success without errors. False if not.
+            - str: Error Message if bool is False. None if True
+            - list: {"id", "title"} for each title, in title order.
+    """
+    ok, _ = check_string(prefix)
+    if not ok:
+        return (False,ErrorCode.INVALID_INPUT,None)
+
+    if limit is None:
+        limit = SEARCH_LIMIT
+    elif parse_id(limit) != None or int(limit) == 0:
+        return (False,ErrorCode.INVALID_INPUT,None)
+
+    err = setup_error()
+    if err is not None:
+        return (False,err,None)
+
+    if not state.search_ready.wait(SEARCH_WAIT):
+        return (False,ErrorCode.INDEX_NOT_READY,None)
+
+    with state.search_lock:
+        results = [{"id":id,"title":title} for id, title in state.search.complete(prefix,min(int(limit),PAGE_LIMIT_MAX))]
+
+    return (True,None,results)
+
+@catch_errors_4
+def get_notes_page(limit:Optional[str] = None,cursor:Optional[str] = None) -> Tuple[bool,Optional[ErrorCode],Optional[dict],Optional[str]]:
+    """Get one page of notes in id order.
+
+    Args:
+        limit (Optional[str]): Most notes to return, in string form. PAGE_LIMIT if not provided, and never more than PAGE_LIMIT_MAX.
+        cursor (Optional[str]): next_cursor from the previous page. Starts from the beginning if not provided.
+
+    Returns:
+        Tuple[bool,Optional[str],Optional[dict],Optional[str]]:
+            - bool: True if setup was success without errors. False if not.
+            - str: Error Message if bool is False. None if True
+            - dict: The notes on this page, id in string form: the note
+            - str: Cursor for the next page. None once there are no more notes.
+    """
+    err = setup_error()
+    if err is not None:
+        return (False,err,None,None)
+
+    if limit is None:
+        limit = PAGE_LIMIT
+    elif parse_id(limit) != None or int(limit) == 0:
+        return (False,ErrorCode.INVALID_INPUT,None,None)
+
+    position = {} if cursor is None else decode_cursor(cursor)
+    if position is None:
+        return (False,ErrorCode.INVALID_INPUT,None,None)
+
+    page, position = state.store.page(position,min(int(limit),PAGE_LIMIT_MAX))
+
+    print("Getting page of notes successful.")
+    return (True,None,dict(page),None if position is None else encode_cursor(position))
+
 @catch_errors_2
 def delete_note(id:Optional[str]) -> Tuple[bool,Optional[ErrorCode]]:
     """Delete a note by id.
@@ -276,14 +774,11 @@ def delete_note(id:Optional[str]) -> Tuple[bool,Optional[ErrorCode]]:
             - str: Error Message if bool is False. None if True
 
     """
+    err = setup_error()
+    if err is not None:
+        return (False,err)
+
     #If no id, none of the below matters. So we check it.
-    
-    if state.source == "offline" and not Path(LOCAL_FILE).exists():
-        return (False,ErrorCode.SETUP_REQUIRED)
-        
-    if state.source == "online" and (state.blob_r is None or state.bucket is None):
-        return (False,ErrorCode.SETUP_REQUIRED)
-    
 
     if id is None:
         print("Delete note failed because Id was not provided.")
@@ -293,49 +788,114 @@ def delete_note(id:Optional[str]) -> Tuple[bool,Optional[ErrorCode]]:
     if parse_id(id) != None:
         return (False,ErrorCode.INVALID_INPUT)
     
-    #Discriminate between Sources
-    notes = load_notes() or {}
+    if state.group_commit:
+        found = submit_write(lambda notes: pop_note(notes,id)).result()
 
-    note = notes.get(id,None)
+    else:
+        with state.write_lock:
+            found = state.store.delete([id])[0]
 
-    if note is None:
+    if not found:
         print("Id not found in JSON. Continuing...")
         return (True, None)
-    
-    state.old_ids.append(int(id))
-    del notes[id]
 
-
-    persist(notes)
+    unindex_notes([id])
     print("Deleting Note Successful.")
     return(True,None)
 
+@catch_errors_3
+def delete_notes(ids:list) -> Tuple[bool,Optional[ErrorCode],Optional[list]]:
+    """Delete many notes by id with one load and one save.
+
+    Args:
+        ids (list): Ids of the notes in string form. Ids must be positive.
+
+    Returns:
+        Tuple[bool,Optional[str],Optional[list]]:
+            - bool: True if setup was success without errors. False if not.
+            - str: Error Message if bool is False. None if True
+            - list: One result per id, in order. {"id", "success": True, "found"} or {"id", "success": False, "error"}.
+    """
+    if not isinstance(ids,list) or len(ids) > BATCH_MAX:
+        return (False,ErrorCode.INVALID_INPUT,None)
+
+    err = setup_error()
+    if err is not None:
+        return (False,err,None)
+
+    #A bad id only fails itself. The rest are still deleted.
+    valid = list(dict.fromkeys(str(int(id)) for id in ids if parse_id(id) == None))
+
+    if not valid:
+        found = []
+
+    elif state.group_commit:
+        found = submit_write(lambda notes: [pop_note(notes,id) for id in valid]).result()
+
+    else:
+        with state.write_lock:
+            found = state.store.delete(valid)
+
+    found = dict(zip(valid,found))
+    unindex_notes([id for id in valid if found[id]])
+
+    results = []
+    for id in ids:
+        if parse_id(id) != None:
+            results.append({"id":id,"success":False,"error":"id must be a positive integer."})
+        else:
+            results.append({"id":str(int(id)),"success":True,"found":found[str(int(id))]})
+
+    print(f"Deleting {sum(found.values())} of {len(ids)} notes successful.")
+    return (True,None,results)
+
 #-----------
 #Helper Functions
 #-----------
 
-def generate_id() -> int:
-    """Generate an id.
+def insert_note(notes:dict,note:dict) -> str:
+    """Give a note an id and put it in the notes dict. Nothing is saved.
+
+    Args:
+        notes (dict): The notes to add to.
+        note (dict): The note.
 
     Returns:
-        int: The Id which has been chosen.
+        str: The id it was given.
     """
-    #Check to see if there are any pre-used ids.
-    if len(state.old_ids) != 0:
+    id = str(generate_id())
 
-        back = state.old_ids[0]
-        del state.old_ids[0]
-        
-        return back
-    
-    #No pre-used ids. Generate new.
-    else:
-        
-        back = state.id_count
-        
-        state.id_count += 1
+    #The notes decide which ids are taken. The meta is written separately and can be a step behind another server.
+    while id in notes:
+        id = str(generate_id())
 
-        return back
+    notes[id] = note
+    return id
+
+def pop_note(notes:dict,id:str) -> bool:
+    """Take a note out of the notes dict and free its id. Nothing is saved.
+
+    Args:
+        notes (dict): The notes to remove from.
+        id (str): Id of the note.
+
+    Returns:
+        bool: True if the note existed.
+    """
+    if id not in notes:
+        return False
+
+    state.ids.free(int(id))
+    del notes[id]
+    return True
+
+def generate_id() -> int:
+    """Generate an id.
+
+    Returns:
+        int: The Id which has been chosen. The lowest freed id if there is one, otherwise a new one.
+    """
+    return state.ids.allocate()
 
 def load_notes_local() -> dict:
     """Load the local notes and return the JSON
@@ -345,13 +905,38 @@ def load_notes_local() -> dict:
             dict - A dictionary indicative of the local json data. None if file doesn't exist.
     
     """
-    file_path = Path(LOCAL_FILE)
+    with span("file.touch",path=LOCAL_FILE):
+        Path(LOCAL_FILE).touch(exist_ok=True)
 
-    Path(LOCAL_FILE).touch(exist_ok=True)
-    
+    return read_snapshot_local()
+
+def load_log_local() -> dict:
+    """Load the snapshot and replay the log on top of it.
+
+    Returns:
+        dict: Every note, plus _meta if any record carried one.
+    """
+    #In log mode the file is only a snapshot. The log holds everything after it,
+    #plus the log being compacted if the compactor is mid-fold.
+    with state.snapshot_lock:
+        notes = read_snapshot_local()
+        replay_log_local(notes,LOCAL_LOG + ".compacting")
+        replay_log_local(notes,LOCAL_LOG)
+
+    return notes
+
+def read_snapshot_local() -> dict:
+    """Read LOCAL_FILE as is.
+
+    Returns:
+        dict: The JSON in the file. Empty if the file is missing or corrupted.
+    """
     try:
-        with open(file_path,"r",encoding ="utf-8") as f:
-            return load(f)
+        with span("file.read",path=LOCAL_FILE) as s, open(LOCAL_FILE,"r",encoding ="utf-8") as f:
+            notes = load(f)
+            s.set(bytes=f.tell())
+            count_bytes("read",f.tell())
+            return notes
     except (JSONDecodeError,FileNotFoundError):
         #If file is corrupted, start fresh
         return {}
@@ -365,79 +950,295 @@ def save_notes_local(notes:dict):
             dict - The dictionary to make into JSON and save.
 
     """
-    with open(LOCAL_FILE,"w",encoding="utf-8") as f:
+    with span("file.write",path=LOCAL_FILE) as s, open(LOCAL_FILE,"w",encoding="utf-8") as f:
 
         dump(notes, f, indent=2)
+        s.set(bytes=f.tell())
+        count_bytes("written",f.tell())
 
-def load_notes()-> dict:
-    """Load Notes for both types.
+def replay_log_local(notes:dict,path:str) -> int:
+    """Apply every record in a log file on top of a snapshot, in place.
+
+    Args:
+        notes (dict): The snapshot loaded from LOCAL_FILE.
+        path (str): The log file to replay.
 
     Returns:
-        dict: Data that was loaded from the JSON.
+        int: Number of records applied.
     """
+    count = 0
 
-    # Fail early if setup was never run
-    if state.source == "online" and (state.blob_r is None or state.bucket is None):
-        raise RuntimeError("Storage not initialized. Please run setup first.")
+    try:
+        with span("file.replay",path=path) as s, open(path,"r",encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = loads(line)
+                except JSONDecodeError:
+                    #A torn record from a crash mid-append. Skip it, the rest is intact.
+                    continue
 
+                if record.get("op") == "put":
+                    notes[record["id"]] = record["note"]
+                elif record.get("op") == "del":
+                    notes.pop(record["id"],None)
 
-    if state.source == "offline":
-        return load_notes_local() or {}
-    elif state.blob_r != None and state.source == "online":
-        try:
-            return loads(state.blob_r.download_as_text())
-        except JSONDecodeError:
-            return {}
-    
-    return {}
+                if "meta" in record:
+                    notes["_meta"] = record["meta"]
+                count += 1
 
-def save_notes(notes:dict):
-    """Save Notes for both types.
+            s.set(bytes=f.tell(),records=count)
+            count_bytes("read",f.tell())
+    except FileNotFoundError:
+        pass
+
+    return count
+
+def append_log_local(*records:dict):
+    """Append records to the local log, in one write.
 
     Args:
-        notes (dict): Data that is to be stored in the JSON.
+        records (dict): The records. Each either {"op":"put","id","note"} or {"op":"del","id"}, plus "meta" on the last.
     """
+    line = "".join(dumps(record,separators=(",",":")) + "\n" for record in records)
 
-    if state.source == "offline":
-        return save_notes_local(notes)
-    elif state.blob_r != None and state.source == "online":
-        state.blob_r.upload_from_string(dumps(notes))
+    with state.log_lock, span("file.append",path=LOCAL_LOG,bytes=len(line),records=len(records)):
+        with open(LOCAL_LOG,"a",encoding="utf-8") as f:
+            f.write(line)
 
-def setup_ensure_meta():
-    """Ensure metadata is in the JSON. Add it if missing.
-    """
-    if state.source == "offline" and LOCAL_FILE:
-        Path(LOCAL_FILE).touch(exist_ok=True)
-    
+            if LOG_FSYNC:
+                f.flush()
+                fsync(f.fileno())
 
-    notes = load_notes()
+        state.log_records += len(records)
+        state.log_bytes += len(line)
 
-    if '_meta' not in notes:
-        notes["_meta"] = {"id_count":0,"old_ids":[]}
-        save_notes(notes)
-    else:
-        #id_count
+    count_bytes("written",len(line))
 
-        metas = notes.get("_meta",None)
-        if metas is not None:
-            state.id_count = metas.get("id_count",0)
-            state.old_ids = metas.get("old_ids",[])
+    if compaction_due():
+        state.compact_event.set()
 
-def persist(notes:dict):
-    """Writes current data to meta and notes.
+def seal_log_local():
+    """Terminate a torn last line so the next append doesn't get glued onto it. Also recounts the log.
     """
-    notes['_meta'] = {"id_count":state.id_count,"old_ids":state.old_ids}
-    save_notes(notes)
+    path = Path(LOCAL_LOG)
+    if not path.exists() or path.stat().st_size == 0:
+        state.log_records = 0
+        state.log_bytes = 0
+        return
 
-def hide_meta(notes:dict) -> dict:
-    """Hides meta from getting all notes.
+    with open(path,"rb+") as f:
+        f.seek(-1,2)
+        if f.read(1) != b"\n":
+            f.write(b"\n")
+
+        f.seek(0)
+        state.log_records = sum(1 for _ in f)
+        state.log_bytes = f.tell()
+
+def write_snapshot_local(notes:dict):
+    """Write the full notes to the snapshot file and empty the log.
 
     Args:
-        notes (dict): Dictionary storing the notes and meta.
+        notes (dict): Everything, including _meta. Anything in the log must already be folded in.
+    """
+    tmp = LOCAL_FILE + ".tmp"
+
+    with state.snapshot_lock, state.log_lock:
+        with span("file.write",path=LOCAL_FILE) as s, open(tmp,"w",encoding="utf-8") as f:
+            dump(notes,f,separators=(",",":"))
+            f.flush()
+            fsync(f.fileno())
+            s.set(bytes=f.tell())
+            count_bytes("written",f.tell())
+
+        #Swap in the new snapshot before the logs are emptied, so a crash in between only replays records twice.
+        replace(tmp,LOCAL_FILE)
+        open(LOCAL_LOG,"w",encoding="utf-8").close()
+        Path(LOCAL_LOG + ".compacting").unlink(missing_ok=True)
+        state.log_records = 0
+        state.log_bytes = 0
+
+def load_notes()-> dict:
+    """Load Notes for both types.
 
     Returns:
-        dict: Argument dictionary without meta.
+        dict: Data that was loaded from the JSON.
     """
+
+    # Fail early if setup was never run
+    if state.store is None:
+        raise RuntimeError("Storage not initialized. Please run setup first.")
+
+    #A copy, so the caller can read it while writers carry on.
+    if using_cache():
+        with state.write_lock:
+            return dict(state.cache)
+
+    with span("load_notes",backend=backend_name()) as s, STORAGE_SECONDS.time(operation="load",backend=backend_name()):
+        notes = state.store.load()
+        s.set(notes=len(notes) - ("_meta" in notes))
+
+    NOTES_COUNT.set(len(notes) - ("_meta" in notes))
+    return notes
+
+def load_document() -> dict:
+    """Load the whole store for a read-modify-write.
+
+    Returns:
+        dict: Notes and _meta. With WRITE_BEHIND, the live cache itself, which writers change under write_lock.
+    """
+    #A single .get() on the cache is safe without the lock too.
+    if using_cache():
+        return state.cache
+
+    return load_notes() or {}
+
+def save_notes(notes:dict):
+    """Save Notes for both types.
+
+    Args:
+        notes (dict): Data that is to be stored in the JSON.
+    """
+    with span("save_notes",backend=backend_name(),notes=len(notes) - ("_meta" in notes)), STORAGE_SECONDS.time(operation="save",backend=backend_name()):
+        state.store.save(notes)
+
+    NOTES_COUNT.set(len(notes) - ("_meta" in notes))
+
+def setup_ensure_meta():
+    """Pick the store for the source setup() settled on, and ensure metadata exists. Add it if missing.
+    """
+    state.store = open_store()
+    state.group_commit = False
+
+    metas = load_meta()
+
+    #Stores from before the split have it inside the notes.
+    if metas is None and isinstance(state.store,DocumentStore):
+        metas = migrate_meta()
+
+    if metas is None:
+        metas = {"schema":META_SCHEMA,"id_count":0,"free_ids":[]}
+
+        #Only the meta is missing. Saving the whole layout here would wipe any notes already stored.
+        try:
+            save_meta(metas)
+        except gcs_ex.PreconditionFailed:
+            #Another server starting at the same time created it first. Use theirs.
+            metas = load_meta() or metas
+
+    apply_meta(metas)
+
+    #Only whole-document stores are cached or group committed. The other layouts already write one note at a time.
+    if isinstance(state.store,DocumentStore):
+        state.store.start_writers()
+
+    start_indexer()
+
+def load_meta() -> Optional[dict]:
+    """Load the meta from wherever the current store keeps it.
+
+    Returns:
+        Optional[dict]: The meta. None if there isn't any yet.
+    """
+    with span("load_meta",backend=backend_name()), STORAGE_SECONDS.time(operation="load_meta",backend=backend_name()):
+        meta = state.store.load_meta()
+
+    if meta is not None:
+        META_BYTES.set(len(dumps(meta)))
+
+    return meta
+
+def save_meta(meta:dict,guarded:bool = True):
+    """Save the meta wherever the current store keeps it.
+
+    Args:
+        meta (dict): The meta.
+        guarded (bool): Online, require the meta object to be unchanged since this thread read it.
+    """
+    with span("save_meta",backend=backend_name()), STORAGE_SECONDS.time(operation="save_meta",backend=backend_name()):
+        state.store.save_meta(meta,guarded)
+
+    META_BYTES.set(len(dumps(meta)))
+
+def load_meta_local() -> Optional[dict]:
+    """Read LOCAL_META.
+
+    Returns:
+        Optional[dict]: The meta. None if there isn't any yet.
+    """
+    try:
+        with span("file.read",path=LOCAL_META), open(LOCAL_META,"r",encoding="utf-8") as f:
+            return load(f)
+    except (JSONDecodeError,FileNotFoundError):
+        return None
+
+def save_meta_local(meta:dict):
+    """Write LOCAL_META.
+
+    Args:
+        meta (dict): The meta.
+    """
+    with span("file.write",path=LOCAL_META), open(LOCAL_META,"w",encoding="utf-8") as f:
+        dump(meta,f,indent=2)
+
+def migrate_meta() -> Optional[dict]:
+    """Move _meta out of a notes.json or local file written before the split.
+
+    Returns:
+        Optional[dict]: The meta that was moved. None if there wasn't any.
+    """
+    notes = load_notes()
+    metas = notes.pop("_meta",None)
+
+    if metas is None:
+        return None
+
+    #Meta first, so a crash in between leaves it in both places rather than neither.
+    save_meta(dict(metas,schema=META_SCHEMA),guarded=False)
+    save_notes(notes)
+    print("Moved _meta out of the notes into its own file.")
+    return metas
+
+def apply_meta(meta:Optional[dict]):
+    """Load the id allocator from a _meta block.
+
+    Args:
+        meta (Optional[dict]): The _meta block. Nothing happens if None.
+    """
+    if meta is None:
+        return
+
+    state.ids = IdAllocator.from_meta(meta,ID_REUSE)
+
+def current_meta(count:Optional[int] = None) -> dict:
+    """Build the _meta block from the state.
+
+    Args:
+        count (Optional[int]): How many notes there are, if known.
+
+    Returns:
+        dict: schema, id_count and free_ids, plus the note count if given.
+    """
+    meta = {"schema":META_SCHEMA,**state.ids.to_meta()}
+
+    if count is not None:
+        meta["notes"] = count
+
+    return meta
+
+def hide_meta(notes:dict) -> dict:
+    """Hides meta from getting all notes.
+
+    Args:
+        notes (dict): Dictionary storing the notes and meta.
+
+    Returns:
+        dict: Argument dictionary without meta.
+    """
+    #Only a file from before the meta split still has it mixed in, so usually there's nothing to copy.
+    if "_meta" not in notes:
+        return notes
+
     true = {}
 
     for k,v in notes.items():
@@ -447,9 +1248,1595 @@ def hide_meta(notes:dict) -> dict:
             true[k] = v
     return true
        
-#----------------
-# Verification Functions
-#----------------
+#-----------
+# Note Stores
+#-----------
+
+def open_store() -> NoteStore:
+    """Build the store for the current source and layout.
+
+    Returns:
+        NoteStore: The store.
+    """
+    if state.source == "memory":
+        #Setup again shouldn't throw away everything held in memory.
+        #The store hands out ids from state.ids, so the meta and metrics see the same allocator it does.
+        return state.store if isinstance(state.store,MemoryStore) else MemoryStore(ID_REUSE,lambda: state.ids)
+
+    if state.source == "sqlite":
+        open_sqlite()
+        return SqliteStore()
+
+    if state.source == "offline":
+        return LogStore() if LOCAL_MODE == "log" else FileStore()
+
+    if ONLINE_LAYOUT == "objects":
+        return ObjectStore()
+
+    if ONLINE_LAYOUT == "sharded":
+        return ShardedStore()
+
+    return BlobStore()
+
+class DocumentStore:
+    """A store kept as one document of every note, so each change is a read-modify-write of all of it.
+
+    Subclasses say where the document and meta live. With WRITE_BEHIND the document is the cache instead.
+    """
+
+    def get(self, id:str) -> Optional[dict]:
+        #A single .get() on the cache is safe without the lock.
+        return load_document().get(id)
+
+    def get_many(self, ids:list) -> dict:
+        #Pick from the cache in place rather than copying all of it.
+        if using_cache():
+            with state.write_lock:
+                return {id:state.cache[id] for id in ids if id in state.cache}
+
+        return load_notes()
+
+    def put(self, notes:list) -> list:
+        def attempt() -> list:
+            document = load_document()
+            self.refresh_ids()
+
+            ids = [insert_note(document,note) for note in notes]
+            self.persist(document)
+            return ids
+
+        return with_retries(attempt)
+
+    def delete(self, ids:list) -> list:
+        def attempt() -> list:
+            document = load_document()
+            self.refresh_ids()
+
+            found = [pop_note(document,id) for id in ids]
+
+            if any(found):
+                self.persist(document)
+
+            return found
+
+        return with_retries(attempt)
+
+    def scan(self) -> Iterator[Tuple[str,dict]]:
+        #One document, so it has to be read whole either way.
+        notes = load_notes()
+        return ((id,note) for id, note in notes.items() if id != "_meta")
+
+    def page(self, position:dict, limit:int) -> Tuple[list,Optional[dict]]:
+        return load_page_document(position.get("after",-1),limit)
+
+    def refresh_ids(self):
+        """Reload the id allocator before a write, in case another server has handed out or freed ids.
+        """
+        #The cache is only used with a single writer, so the allocator in memory is already right.
+        if using_cache():
+            return
+
+        apply_meta(load_meta())
+
+    def persist(self, notes:dict):
+        """Save the document after a change.
+
+        Args:
+            notes (dict): Every note, without _meta. With WRITE_BEHIND, the cache itself.
+        """
+        #notes is the cache itself here. The flusher uploads it later.
+        if using_cache():
+            return mark_dirty()
+
+        #Notes first. If the meta write is lost, insert_note() still skips ids that are in use.
+        save_notes(notes)
+        save_meta(current_meta(len(notes)),guarded=False)
+
+    def start_writers(self):
+        """Start the write-behind cache, or group commit if the cache is off, whichever is configured.
+        """
+        if WRITE_BEHIND:
+            state.cache = load_notes()
+            start_flusher()
+
+        #The cache already turns a burst of writes into one upload.
+        state.group_commit = GROUP_COMMIT and not using_cache()
+        if state.group_commit:
+            start_committer()
+
+class BlobStore(DocumentStore):
+    """notes.json in the bucket, with the meta in META_BLOB.
+    """
+
+    def load(self) -> dict:
+        return load_notes_blob()
+
+    def save(self, notes:dict):
+        save_notes_blob(notes)
+
+    def load_meta(self) -> Optional[dict]:
+        return load_meta_object()
+
+    def save_meta(self, meta:dict, guarded:bool = True):
+        save_meta_object(meta,guarded)
+
+class FileStore(DocumentStore):
+    """LOCAL_FILE on disk, with the meta in LOCAL_META.
+    """
+
+    def __init__(self):
+        Path(LOCAL_FILE).touch(exist_ok=True)
+
+    def load(self) -> dict:
+        return load_notes_local() or {}
+
+    def save(self, notes:dict):
+        save_notes_local(notes)
+
+    def load_meta(self) -> Optional[dict]:
+        return load_meta_local()
+
+    def save_meta(self, meta:dict, guarded:bool = True):
+        save_meta_local(meta)
+
+class LogStore(MemoryStore):
+    """LOCAL_FILE as a snapshot with every change since appended to LOCAL_LOG. The meta rides along in the records.
+
+    The log is replayed once, when the store is opened, and every note is kept in memory from then on. Reads and
+    deletes never touch the disk, and a write is one append. Compaction folds the same notes into the snapshot, so it
+    leaves the memory as it is. Only one process writes the log, so the id allocator in memory is always current.
+    """
+
+    def __init__(self):
+        super().__init__(ID_REUSE,lambda: state.ids)
+        Path(LOCAL_FILE).touch(exist_ok=True)
+        seal_log_local()
+
+        notes = load_log_local()
+        self._meta = notes.pop("_meta",None)
+        self._notes = notes
+
+        start_compactor()
+
+    def put(self, notes:list) -> list:
+        with self._lock:
+            ids = [str(generate_id()) for _ in notes]
+
+            #Replay keeps the last meta it sees, so the final record is the only one that needs it.
+            records = [{"op":"put","id":id,"note":note} for id, note in zip(ids,notes)]
+            self._append(records)
+            self._notes.update(zip(ids,notes))
+
+        return ids
+
+    def delete(self, ids:list) -> list:
+        with self._lock:
+            found = [id in self._notes for id in ids]
+            gone = [id for id, exists in zip(ids,found) if exists]
+
+            if gone:
+                for id in gone:
+                    state.ids.free(int(id))
+
+                self._append([{"op":"del","id":id} for id in gone])
+                for id in gone:
+                    del self._notes[id]
+
+        return found
+
+    def save(self, notes:dict):
+        with self._lock:
+            notes = {id:note for id, note in notes.items() if id != "_meta"}
+
+            #The snapshot replaces the log, so the meta has to go in with the notes.
+            write_snapshot_local(dict(notes,_meta=self._meta) if self._meta is not None else notes)
+            self._notes = notes
+
+    def save_meta(self, meta:dict, guarded:bool = True):
+        #Replay keeps the meta of any record that has one, so a record with nothing else sets it.
+        with self._lock:
+            append_log_local({"meta":meta})
+            self._meta = meta
+
+    def _append(self, records:list):
+        """Append records with the current meta on the last one. Only changes memory once the append has worked.
+        """
+        records[-1]["meta"] = current_meta()
+        append_log_local(*records)
+        self._meta = records[-1]["meta"]
+
+class ObjectStore:
+    """One object per note under NOTES_PREFIX, with the meta in META_BLOB.
+    """
+
+    def get(self, id:str) -> Optional[dict]:
+        return load_note_object(id)
+
+    def get_many(self, ids:list) -> dict:
+        with ThreadPoolExecutor(max_workers=GCS_WORKERS) as pool:
+            return {id:note for id, note in zip(ids,pool.map(propagate(load_note_object),ids)) if note is not None}
+
+    def put(self, notes:list) -> list:
+        #Claim every id in the meta object first, in one update, so no other server hands them out as well.
+        ids = [str(id) for id in with_retries(lambda: claim_ids(len(notes)))]
+
+        #Nobody else can have these ids, so the uploads need no precondition and no retries.
+        with ThreadPoolExecutor(max_workers=GCS_WORKERS) as pool:
+            list(pool.map(propagate(save_note_object),ids,notes))
+
+        return ids
+
+    def delete(self, ids:list) -> list:
+        with ThreadPoolExecutor(max_workers=GCS_WORKERS) as pool:
+            found = list(pool.map(propagate(lambda id: with_retries(lambda: remove_note_object(id))),ids))
+
+        #Only hand the ids back out once the notes are really gone.
+        freed = [int(id) for id, gone in zip(ids,found) if gone]
+        if freed:
+            with_retries(lambda: free_ids(freed))
+
+        return found
+
+    def scan(self) -> Iterator[Tuple[str,dict]]:
+        return iter_notes_objects()
+
+    def page(self, position:dict, limit:int) -> Tuple[list,Optional[dict]]:
+        return load_page_objects(position.get("after",-1),limit)
+
+    def load(self) -> dict:
+        return load_notes_objects()
+
+    def save(self, notes:dict):
+        save_notes_objects(notes)
+
+    def load_meta(self) -> Optional[dict]:
+        return load_meta_object()
+
+    def save_meta(self, meta:dict, guarded:bool = True):
+        save_meta_object(meta,guarded)
+
+class ShardedStore(ObjectStore):
+    """Notes spread over state.shard_count shard objects by a hash of the id, with the meta in META_BLOB.
+    """
+
+    def get(self, id:str) -> Optional[dict]:
+        return load_shard(shard_for(id)).get(id)
+
+    def get_many(self, ids:list) -> dict:
+        with ThreadPoolExecutor(max_workers=GCS_WORKERS) as pool:
+            shards = list(pool.map(propagate(load_shard),sorted({shard_for(id) for id in ids})))
+
+        return {k:v for shard in shards for k, v in shard.items()}
+
+    def put(self, notes:list) -> list:
+        ids = [str(id) for id in with_retries(lambda: claim_ids(len(notes)))]
+
+        by_shard = {}
+        for id, note in zip(ids,notes):
+            by_shard.setdefault(shard_for(id),{})[id] = note
+
+        def update(index:int):
+            shard = load_shard(index)
+            shard.update(by_shard[index])
+            save_shard(index,shard)
+
+        #Each shard is loaded and saved once, by one worker, so its generation check stays on that worker's thread.
+        with ThreadPoolExecutor(max_workers=GCS_WORKERS) as pool:
+            list(pool.map(propagate(lambda index: with_retries(lambda: update(index))),by_shard))
+
+        return ids
+
+    def delete(self, ids:list) -> list:
+        by_shard = {}
+        for id in ids:
+            by_shard.setdefault(shard_for(id),[]).append(id)
+
+        def update(index:int) -> dict:
+            shard = load_shard(index)
+            found = {id:shard.pop(id,None) is not None for id in by_shard[index]}
+
+            if any(found.values()):
+                save_shard(index,shard)
+
+            return found
+
+        found = {}
+        with ThreadPoolExecutor(max_workers=GCS_WORKERS) as pool:
+            for result in pool.map(propagate(lambda index: with_retries(lambda: update(index))),by_shard):
+                found.update(result)
+
+        freed = [int(id) for id in ids if found[id]]
+        if freed:
+            with_retries(lambda: free_ids(freed))
+
+        return [found[id] for id in ids]
+
+    def scan(self) -> Iterator[Tuple[str,dict]]:
+        return iter_notes_sharded()
+
+    def page(self, position:dict, limit:int) -> Tuple[list,Optional[dict]]:
+        return load_page_sharded(position.get("after",-1),limit)
+
+    def load(self) -> dict:
+        return load_notes_sharded()
+
+    def save(self, notes:dict):
+        save_notes_sharded(notes)
+
+    def load_meta(self) -> Optional[dict]:
+        meta = load_meta_object()
+
+        #Notes were placed with the shard count they were written with, so that wins over SHARD_COUNT.
+        state.shard_count = (meta or {}).get("shards",SHARD_COUNT)
+        return meta
+
+    def save_meta(self, meta:dict, guarded:bool = True):
+        save_meta_object(dict(meta,shards=state.shard_count),guarded)
+
+class SqliteStore:
+    """The notes and meta tables in SQLITE_FILE.
+    """
+
+    def get(self, id:str) -> Optional[dict]:
+        return load_note_sqlite(id)
+
+    def get_many(self, ids:list) -> dict:
+        return load_notes_many_sqlite(ids)
+
+    def put(self, notes:list) -> list:
+        return insert_notes_sqlite(notes)
+
+    def delete(self, ids:list) -> list:
+        return delete_notes_sqlite(ids)
+
+    def scan(self) -> Iterator[Tuple[str,dict]]:
+        return iter_notes_sqlite()
+
+    def page(self, position:dict, limit:int) -> Tuple[list,Optional[dict]]:
+        rows = load_page_sqlite(position.get("after",-1),limit + 1)
+        return rows[:limit], ({"after":int(rows[limit - 1][0])} if len(rows) > limit else None)
+
+    def load(self) -> dict:
+        return load_notes_sqlite()
+
+    def save(self, notes:dict):
+        save_notes_sqlite(notes)
+
+    def load_meta(self) -> Optional[dict]:
+        with state.db_lock:
+            return load_meta_sqlite(state.db)
+
+    def save_meta(self, meta:dict, guarded:bool = True):
+        with state.db_lock, state.db:
+            save_meta_sqlite(state.db,meta)
+
+#-----------
+# Streaming Reads
+#-----------
+
+@dataclass
+class NoteStream:
+    """Notes to be sent as they're read. Handed back instead of a dict, so app.py knows to stream them.
+    """
+    pairs:Iterator[Tuple[str,dict]]
+
+    def __iter__(self) -> Iterator[Tuple[str,dict]]:
+        return iter(self.pairs)
+
+def iter_notes() -> Iterator[Tuple[str,dict]]:
+    """Yield every note, holding as little of the store in memory at once as the layout allows.
+
+    Returns:
+        Iterator[Tuple[str,dict]]: (id, note) pairs. Never _meta.
+    """
+    return state.store.scan()
+
+def iter_notes_sqlite() -> Iterator[Tuple[str,dict]]:
+    """Yield every note in id order, STREAM_CHUNK rows at a time.
+
+    Returns:
+        Iterator[Tuple[str,dict]]: (id, note) pairs.
+    """
+    after = -1
+
+    while True:
+        #Pick up after the last id instead of holding a cursor open, so db_lock is only held for one chunk.
+        rows = load_page_sqlite(after,STREAM_CHUNK)
+        yield from rows
+
+        if len(rows) < STREAM_CHUNK:
+            return
+
+        after = int(rows[-1][0])
+
+def iter_notes_objects() -> Iterator[Tuple[str,dict]]:
+    """Yield every note object, downloading STREAM_CHUNK of them at a time in parallel.
+
+    Returns:
+        Iterator[Tuple[str,dict]]: (id, note) pairs, in id order.
+    """
+    #The listing is paged by the client library, so it never holds every name at once either.
+    blobs = (b for b in state.client.list_blobs(state.bucket,prefix=NOTES_PREFIX) if b.name.endswith(".json"))
+
+    with ThreadPoolExecutor(max_workers=GCS_WORKERS) as pool:
+        while True:
+            chunk = list(islice(blobs,STREAM_CHUNK))
+
+            for blob, body in zip(chunk,pool.map(propagate(download_or_none),chunk)):
+
+                #Deleted between listing and download.
+                if body is None:
+                    continue
+
+                try:
+                    yield note_id_from_name(blob.name), loads(body)
+                except (JSONDecodeError,ValueError):
+                    continue
+
+            if len(chunk) < STREAM_CHUNK:
+                return
+
+def iter_notes_sharded() -> Iterator[Tuple[str,dict]]:
+    """Yield every note one shard at a time, downloading the next shard while this one is sent.
+
+    Returns:
+        Iterator[Tuple[str,dict]]: (id, note) pairs.
+    """
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        upcoming = pool.submit(propagate(load_shard),0) if state.shard_count else None
+
+        for index in range(state.shard_count):
+            shard = upcoming.result()
+
+            if index + 1 < state.shard_count:
+                upcoming = pool.submit(propagate(load_shard),index + 1)
+
+            yield from shard.items()
+
+#-----------
+# Paged Reads
+#-----------
+
+def load_page_document(after:int,limit:int) -> Tuple[list,Optional[dict]]:
+    """Load one page from notes.json, the local file or the cache.
+
+    Args:
+        after (int): Only ids above this one.
+        limit (int): Most notes to return.
+
+    Returns:
+        Tuple[list,Optional[dict]]: The page, and where the next one starts.
+    """
+    #The document is read whole anyway, but only the ids on this page are sorted.
+    notes = load_notes()
+    ids = nsmallest(limit + 1,(i for i in (int(k) for k in notes if k != "_meta") if i > after))
+
+    page = [(str(i),notes[str(i)]) for i in ids[:limit]]
+    return page, ({"after":ids[limit - 1]} if len(ids) > limit else None)
+
+def load_page_objects(after:int,limit:int) -> Tuple[list,Optional[dict]]:
+    """Load one page of note objects. Only the objects on the page are listed and downloaded.
+
+    Args:
+        after (int): Only ids above this one.
+        limit (int): Most notes to return.
+
+    Returns:
+        Tuple[list,Optional[dict]]: The page, in id order, and where the next one starts.
+    """
+    #Names are zero-padded, so listing from the name of the last id hands notes back in id order.
+    #start_offset is inclusive, so the last object of the previous page comes back again and is dropped here.
+    start = note_object_name(str(after)) if after >= 0 else ""
+
+    with span("gcs.list",prefix=NOTES_PREFIX,start_offset=start) as s:
+        listed = state.client.list_blobs(state.bucket,prefix=NOTES_PREFIX,start_offset=start or None,max_results=limit + 2)
+        blobs = [b for b in listed if b.name.endswith(".json") and b.name > start]
+        s.set(objects=len(blobs))
+
+    more = len(blobs) > limit
+    blobs = blobs[:limit]
+
+    with ThreadPoolExecutor(max_workers=GCS_WORKERS) as pool:
+        bodies = list(pool.map(propagate(download_or_none),blobs))
+
+    page = []
+    for blob, body in zip(blobs,bodies):
+
+        #Deleted between listing and download.
+        if body is None:
+            continue
+
+        try:
+            page.append((note_id_from_name(blob.name),loads(body)))
+        except (JSONDecodeError,ValueError):
+            continue
+
+    return page, ({"after":int(note_id_from_name(blobs[-1].name))} if more else None)
+
+def load_page_sharded(after:int,limit:int) -> Tuple[list,Optional[dict]]:
+    """Load one page from the shards, merging them so the page is in id order.
+
+    Every page downloads every shard, in parallel, since any of them can hold the next id.
+
+    Args:
+        after (int): Only ids above this one.
+        limit (int): Most notes to return.
+
+    Returns:
+        Tuple[list,Optional[dict]]: The page, in id order, and where the next one starts.
+    """
+    with ThreadPoolExecutor(max_workers=GCS_WORKERS) as pool:
+        shards = list(pool.map(propagate(load_shard),range(state.shard_count)))
+
+    #Each shard sorted on its own, then merged, so only the ids past the cursor are sorted at all.
+    runs = [sorted(i for i in (int(k) for k in shard) if i > after) for shard in shards]
+    ids = list(islice(merge(*runs),limit + 1))
+
+    notes = {k:v for shard in shards for k, v in shard.items()}
+    page = [(str(i),notes[str(i)]) for i in ids[:limit]]
+    return page, ({"after":ids[limit - 1]} if len(ids) > limit else None)
+
+def encode_cursor(position:dict) -> str:
+    """Turn a page position into the cursor handed to clients.
+
+    Args:
+        position (dict): Where the next page starts.
+
+    Returns:
+        str: URL-safe cursor.
+    """
+    return urlsafe_b64encode(dumps(position,separators=(",",":")).encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor:str) -> Optional[dict]:
+    """Turn a cursor back into a page position.
+
+    Args:
+        cursor (str): A cursor from encode_cursor.
+
+    Returns:
+        Optional[dict]: The position. None if the cursor isn't one of ours.
+    """
+    try:
+        position = loads(urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (B64Error,ValueError):
+        return None
+
+    if not isinstance(position,dict):
+        return None
+
+    #after is the last id of the previous page, whatever the store.
+    if not isinstance(position.get("after",-1),int):
+        return None
+
+    return position
+
+#-----------
+# Object Layout
+#-----------
+
+def note_object_name(id:str) -> str:
+    """Name of the object holding a single note.
+
+    Args:
+        id (str): Id of the note.
+
+    Returns:
+        str: The object name, e.g. notes/000000000003.json. Zero-padded, so names list in id order.
+    """
+    return f"{NOTES_PREFIX}{int(id):0{OBJECT_ID_DIGITS}d}.json"
+
+def note_id_from_name(name:str) -> str:
+    """Id of the note an object holds.
+
+    Args:
+        name (str): The object name, from note_object_name().
+
+    Returns:
+        str: The id, without the padding.
+
+    Raises:
+        ValueError: If the name isn't a note object's.
+    """
+    return str(int(name[len(NOTES_PREFIX):-len(".json")]))
+
+def download_or_none(blob:Blob) -> Optional[str]:
+    """Download a blob as text, treating a missing object as None.
+
+    Args:
+        blob (Blob): The blob to download.
+
+    Returns:
+        Optional[str]: The contents. None if the object doesn't exist.
+    """
+    try:
+        with span("gcs.download",object=blob.name) as s:
+            body = blob.download_as_text()
+            s.set(bytes=len(body))
+    except gcs_ex.NotFound:
+        #Generation 0 means "must not exist", so a later create still can't clobber someone else's.
+        saw_generation(blob.name,0)
+        return None
+
+    saw_generation(blob.name,blob.generation)
+    count_bytes("read",len(body))
+    return body
+
+def load_note_object(id:str) -> Optional[dict]:
+    """Load one note from its own object.
+
+    Args:
+        id (str): Id of the note.
+
+    Returns:
+        Optional[dict]: The note. None if it doesn't exist.
+    """
+    body = download_or_none(state.bucket.blob(note_object_name(id)))
+
+    if body is None:
+        return None
+
+    try:
+        return loads(body)
+    except JSONDecodeError:
+        return None
+
+def save_note_object(id:str,note:Optional[dict]):
+    """Write or delete one note object.
+
+    Args:
+        id (str): Id of the note.
+        note (Optional[dict]): The note. None deletes the object.
+    """
+    blob = state.bucket.blob(note_object_name(id))
+
+    #Ids are claimed in the meta object before the note is written, so a new note never needs a precondition.
+    if note is not None:
+        body = dumps(note)
+        count_bytes("written",len(body))
+        with span("gcs.upload",object=blob.name,bytes=len(body)):
+            return blob.upload_from_string(body,content_type="application/json")
+
+    try:
+        with span("gcs.delete",object=blob.name):
+            blob.delete(if_generation_match=seen_generation(blob.name))
+    except gcs_ex.NotFound:
+        pass
+
+def remove_note_object(id:str) -> bool:
+    """Delete one note object, if it's still the version this thread reads now.
+
+    Args:
+        id (str): Id of the note.
+
+    Returns:
+        bool: True if the note existed.
+    """
+    if load_note_object(id) is None:
+        return False
+
+    save_note_object(id,None)
+    return True
+
+def load_meta_object() -> Optional[dict]:
+    """Load the meta object.
+
+    Returns:
+        Optional[dict]: The meta. None if it doesn't exist yet.
+    """
+    body = download_or_none(state.bucket.blob(META_BLOB))
+
+    if body is None:
+        return None
+
+    try:
+        return loads(body)
+    except JSONDecodeError:
+        return None
+
+def save_meta_object(meta:dict,guarded:bool = True):
+    """Write the meta object.
+
+    Args:
+        meta (dict): id_count and free_ids.
+        guarded (bool): Require the object to be unchanged since this thread read it.
+    """
+    blob = state.bucket.blob(META_BLOB)
+    generation = seen_generation(blob.name) if guarded else None
+    body = dumps(meta)
+    with span("gcs.upload",object=blob.name,bytes=len(body)):
+        blob.upload_from_string(body,content_type="application/json",if_generation_match=generation)
+    count_bytes("written",len(body))
+    saw_generation(blob.name,blob.generation)
+
+def load_notes_objects() -> dict:
+    """Load every note object, downloading them in parallel.
+
+    Returns:
+        dict: Every note. Same shape as notes.json.
+    """
+    with span("gcs.list",prefix=NOTES_PREFIX) as s:
+        blobs = [b for b in state.client.list_blobs(state.bucket,prefix=NOTES_PREFIX) if b.name.endswith(".json")]
+        s.set(objects=len(blobs))
+
+    with ThreadPoolExecutor(max_workers=GCS_WORKERS) as pool:
+        bodies = list(pool.map(propagate(download_or_none),blobs))
+
+    notes = {}
+    for blob, body in zip(blobs,bodies):
+
+        #Deleted between listing and download.
+        if body is None:
+            continue
+
+        try:
+            notes[note_id_from_name(blob.name)] = loads(body)
+        except (JSONDecodeError,ValueError):
+            continue
+
+    return notes
+
+def save_notes_objects(notes:dict):
+    """Write every note in the dict to its own object, plus the meta object.
+
+    Args:
+        notes (dict): Notes and _meta. Same shape as notes.json.
+    """
+    items = [(k,v) for k,v in notes.items() if k != "_meta"]
+
+    with ThreadPoolExecutor(max_workers=GCS_WORKERS) as pool:
+        list(pool.map(propagate(lambda item: save_note_object(*item)),items))
+
+    if "_meta" in notes:
+        save_meta_object(notes["_meta"])
+
+#-----------
+# Sharded Layout
+#-----------
+
+def shard_for(id:str) -> int:
+    """Pick the shard for an id. Uses crc32 since hash() of a str changes between processes.
+
+    Args:
+        id (str): Id of the note.
+
+    Returns:
+        int: Index of the shard.
+    """
+    return crc32(id.encode("utf-8")) % state.shard_count
+
+def shard_name(index:int) -> str:
+    """Name of a shard object.
+
+    Args:
+        index (int): Index of the shard.
+
+    Returns:
+        str: The object name, e.g. notes-07.json
+    """
+    width = max(2,len(str(state.shard_count - 1)))
+    return f"notes-{index:0{width}d}.json"
+
+def load_shard(index:int) -> dict:
+    """Load one shard.
+
+    Args:
+        index (int): Index of the shard.
+
+    Returns:
+        dict: The notes in the shard. Empty if it hasn't been written yet.
+    """
+    body = download_or_none(state.bucket.blob(shard_name(index)))
+
+    if body is None:
+        return {}
+
+    try:
+        return loads(body)
+    except JSONDecodeError:
+        return {}
+
+def save_shard(index:int,notes:dict):
+    """Write one shard.
+
+    Args:
+        index (int): Index of the shard.
+        notes (dict): The notes in the shard. Nothing else.
+    """
+    shard = {k:v for k,v in notes.items() if k != "_meta"}
+
+    blob = state.bucket.blob(shard_name(index))
+    body = dumps(shard)
+    with span("gcs.upload",object=blob.name,bytes=len(body)):
+        blob.upload_from_string(body,content_type="application/json",if_generation_match=seen_generation(blob.name))
+    count_bytes("written",len(body))
+    saw_generation(blob.name,blob.generation)
+
+def load_notes_sharded() -> dict:
+    """Load every shard in parallel and merge them.
+
+    Returns:
+        dict: Every note. Same shape as notes.json.
+    """
+    with ThreadPoolExecutor(max_workers=GCS_WORKERS) as pool:
+        shards = list(pool.map(propagate(load_shard),range(state.shard_count)))
+
+    notes = {}
+    for shard in shards:
+        notes.update(shard)
+
+    return notes
+
+def save_notes_sharded(notes:dict):
+    """Split the notes into their shards and write all of them, plus the meta object.
+
+    Args:
+        notes (dict): Notes and _meta. Same shape as notes.json.
+    """
+    shards = [{} for _ in range(state.shard_count)]
+
+    for k,v in notes.items():
+        if k != "_meta":
+            shards[shard_for(k)][k] = v
+
+    with ThreadPoolExecutor(max_workers=GCS_WORKERS) as pool:
+        list(pool.map(propagate(save_shard),range(state.shard_count),shards))
+
+    if "_meta" in notes:
+        save_meta_object(notes["_meta"])
+
+#-----------
+# Group Commit
+#-----------
+
+def submit_write(operation) -> Future:
+    """Queue a change for the group commit writer.
+
+    Args:
+        operation (function): Takes the loaded notes and changes them in place. Must not save anything.
+
+    Returns:
+        Future: Resolves to whatever operation returns, once its batch has been saved.
+    """
+    future = Future()
+    state.commit_queue.put((operation,future))
+    return future
+
+def commit_batch(batch:list):
+    """Apply a batch of queued changes with one load and one save, then wake everyone waiting on them.
+
+    Args:
+        batch (list): (operation, future) pairs from the queue.
+    """
+    def attempt() -> list:
+        notes = load_document()
+        state.store.refresh_ids()
+
+        #One bad change shouldn't sink the rest of the batch.
+        results = []
+        for operation, _ in batch:
+            try:
+                results.append((True,operation(notes)))
+            except Exception as e:
+                results.append((False,e))
+
+        state.store.persist(notes)
+        return results
+
+    try:
+        with state.write_lock:
+            results = with_retries(attempt)
+    except Exception as e:
+        for _, future in batch:
+            future.set_exception(e)
+        return
+
+    state.batches += 1
+    state.batched_writes += len(batch)
+
+    for (_, future), (ok, result) in zip(batch,results):
+        if ok:
+            future.set_result(result)
+        else:
+            future.set_exception(result)
+
+def committer_loop():
+    """Take changes off the queue in batches and commit them.
+    """
+    while True:
+        batch = [state.commit_queue.get()]
+        deadline = perf_counter() + GROUP_COMMIT_MAX_WAIT
+
+        while len(batch) < GROUP_COMMIT_MAX_BATCH:
+            try:
+                batch.append(state.commit_queue.get(timeout=max(0,deadline - perf_counter())))
+            except Empty:
+                break
+
+        commit_batch(batch)
+
+def start_committer():
+    """Start the group commit writer, if it isn't running already.
+    """
+    if state.committer is not None and state.committer.is_alive():
+        return
+
+    state.committer = Thread(target=committer_loop,name="group-commit",daemon=True)
+    state.committer.start()
+
+#-----------
+# Optimistic Concurrency
+#-----------
+
+def seen_generation(name:str) -> Optional[int]:
+    """The generation of an object when this thread last read or wrote it.
+
+    Args:
+        name (str): Name of the object.
+
+    Returns:
+        Optional[int]: The generation. 0 if it didn't exist. None if this thread hasn't looked, which means no precondition.
+    """
+    return getattr(seen,"generations",{}).get(name,None)
+
+def saw_generation(name:str,generation:Optional[int]):
+    """Record the generation of an object this thread just read or wrote.
+
+    Args:
+        name (str): Name of the object.
+        generation (Optional[int]): Its generation.
+    """
+    if not hasattr(seen,"generations"):
+        seen.generations = {}
+
+    seen.generations[name] = generation
+
+def forget_generations():
+    """Forget every generation this thread has seen, so its next uploads are unconditional.
+    """
+    seen.generations = {}
+
+def with_retries(operation):
+    """Run a read-modify-write, starting over with a fresh read whenever its upload loses a race.
+
+    Args:
+        operation (function): Does the whole read-modify-write. Must re-read everything it depends on.
+
+    Returns:
+        Whatever operation returns.
+    """
+    for attempt in range(CONFLICT_RETRIES + 1):
+        try:
+            return operation()
+        except gcs_ex.PreconditionFailed:
+            state.conflicts += 1
+
+            if attempt == CONFLICT_RETRIES:
+                state.conflicts_exhausted += 1
+                print(f"Write conflict still unresolved after {CONFLICT_RETRIES} retries.")
+                raise
+
+            state.conflict_retries += 1
+            sleep(min(CONFLICT_BACKOFF_MAX,CONFLICT_BACKOFF * 2 ** attempt) * random())
+
+def claim_ids(count:int) -> list:
+    """Hand out many ids with one update of the meta object. For the objects and sharded layouts.
+
+    Args:
+        count (int): How many ids.
+
+    Returns:
+        list: The ids.
+    """
+    apply_meta(state.store.load_meta())
+    ids = [generate_id() for _ in range(count)]
+    state.store.save_meta(current_meta())
+    return ids
+
+def free_ids(ids:list):
+    """Give many ids back to the meta object with one update. For the objects and sharded layouts.
+
+    Args:
+        ids (list): The ids of notes that have been deleted.
+    """
+    apply_meta(state.store.load_meta())
+    for id in ids:
+        state.ids.free(id)
+    state.store.save_meta(current_meta())
+
+#-----------
+# Conditional Blob Reads
+#-----------
+
+def load_notes_blob() -> dict:
+    """Load notes.json, skipping the download if it hasn't changed since we last saw it.
+
+    Returns:
+        dict: Data that was loaded from the JSON. A copy the caller is free to change.
+    """
+    #A fresh Blob each time. Its generation is filled in by the download, and a shared one would race between threads.
+    blob = state.bucket.blob(state.blob_name)
+    copy = state.blob_copy
+
+    if copy is not None:
+        try:
+            #One round trip either way. The body only comes back if someone else has written since.
+            with span("gcs.download",object=blob.name,conditional=True) as s:
+                body = blob.download_as_text(if_generation_not_match=copy[0])
+                s.set(bytes=len(body))
+        except gcs_ex.NotModified:
+            state.blob_reads_skipped += 1
+            saw_generation(blob.name,copy[0])
+            return dict(copy[1])
+    else:
+        with span("gcs.download",object=blob.name) as s:
+            body = blob.download_as_text()
+            s.set(bytes=len(body))
+
+    state.blob_reads_full += 1
+    count_bytes("read",len(body))
+
+    try:
+        notes = loads(body)
+    except JSONDecodeError:
+        notes = {}
+
+    saw_generation(blob.name,blob.generation)
+    remember_blob(notes,blob.generation)
+    return notes
+
+def save_notes_blob(notes:dict):
+    """Upload notes.json. Fails with PreconditionFailed if it changed since this thread last read it.
+
+    Args:
+        notes (dict): Data that is to be stored in the JSON.
+    """
+    blob = state.bucket.blob(state.blob_name)
+    body = dumps(notes)
+    with span("gcs.upload",object=blob.name,bytes=len(body)):
+        blob.upload_from_string(body,if_generation_match=seen_generation(blob.name))
+    count_bytes("written",len(body))
+
+    saw_generation(blob.name,blob.generation)
+    remember_blob(notes,blob.generation)
+
+def remember_blob(notes:dict,generation:Optional[int]):
+    """Keep a copy of notes.json along with the generation it was read or written as.
+
+    Args:
+        notes (dict): The notes as they are in the bucket right now.
+        generation (Optional[int]): The generation of that copy.
+    """
+    #Without a generation there is nothing safe to compare against next time.
+    if not CONDITIONAL_READS or generation is None:
+        return forget_blob()
+
+    #Don't let a slow reader replace a newer copy with an older one.
+    copy = state.blob_copy
+    if copy is not None and copy[0] > generation:
+        return
+
+    #Notes are replaced, never changed in place, so a shallow copy can't be changed under us.
+    #One tuple, so the generation and the notes are always swapped in together.
+    state.blob_copy = (generation,dict(notes))
+
+def forget_blob():
+    """Drop the remembered copy of notes.json.
+    """
+    state.blob_copy = None
+
+#-----------
+# Write-behind Cache
+#-----------
+
+def using_cache() -> bool:
+    """Check if notes are being served from the in-memory cache.
+
+    Returns:
+        bool: True if WRITE_BEHIND is on and setup has loaded the cache.
+    """
+    return state.cache is not None
+
+def mark_dirty():
+    """Record a write to the cache and wake the flusher if needed. Call with write_lock held.
+    """
+    now = time()
+    state.last_write = now
+    state.pending_writes += 1
+
+    #First unflushed write. The flusher is asleep until told otherwise.
+    if state.dirty_since is None:
+        state.dirty_since = now
+        state.flush_event.set()
+
+    if state.pending_writes >= MAX_PENDING_WRITES:
+        state.flush_event.set()
+
+def flush_wait() -> Optional[float]:
+    """Work out how long the flusher can sleep.
+
+    Returns:
+        Optional[float]: Seconds until the next flush is due. None if there is nothing to flush.
+    """
+    if state.dirty_since is None:
+        return None
+
+    if state.pending_writes >= MAX_PENDING_WRITES:
+        return 0
+
+    due = min(state.last_write + FLUSH_INTERVAL,state.dirty_since + MAX_DIRTY_AGE)
+    return max(0,due - time())
+
+def flush_cache() -> bool:
+    """Upload the cache if it has unflushed writes.
+
+    Returns:
+        bool: True if anything was uploaded.
+    """
+    with state.flush_lock:
+        with state.write_lock:
+            if state.cache is None or state.dirty_since is None:
+                return False
+
+            #The cache is the source of truth, so its flush overwrites whatever is there.
+            forget_generations()
+
+            #Notes are replaced, never changed in place, so a shallow copy is a stable snapshot.
+            snapshot = dict(state.cache)
+            meta = current_meta(len(snapshot))
+            dirty_since = state.dirty_since
+            pending = state.pending_writes
+            state.dirty_since = None
+            state.pending_writes = 0
+
+        try:
+            save_notes(snapshot)
+            save_meta(meta,guarded=False)
+        except Exception:
+            #Put the writes back so the next attempt picks them up.
+            with state.write_lock:
+                state.dirty_since = dirty_since if state.dirty_since is None else min(dirty_since,state.dirty_since)
+                state.pending_writes += pending
+            raise
+
+    state.flushes += 1
+    print(f"Flushed {pending} cached writes.")
+    return True
+
+def flusher_loop():
+    """Flush the cache in the background whenever flush_wait() says it's due.
+    """
+    while True:
+        state.flush_event.wait(flush_wait())
+        state.flush_event.clear()
+
+        if flush_wait() != 0:
+            continue
+
+        try:
+            flush_cache()
+        except Exception as e:
+            print(f"Flushing cached notes failed: {e}")
+
+            #Don't spin on a storage outage.
+            state.flush_event.wait(FLUSH_INTERVAL)
+
+def start_flusher():
+    """Start the background flusher, if it isn't running already.
+    """
+    if state.flusher is not None and state.flusher.is_alive():
+        return
+
+    state.flusher = Thread(target=flusher_loop,name="cache-flusher",daemon=True)
+    state.flusher.start()
+
+def release_cache():
+    """Flush and drop the cache, e.g. before setup points us at different storage.
+    """
+    if state.cache is None:
+        return
+
+    try:
+        flush_cache()
+    except Exception as e:
+        print(f"Flushing cached notes failed: {e}")
+
+    state.cache = None
+
+#Don't lose writes that were still waiting when the server stops.
+atexit.register(release_cache)
+
+#-----------
+# SQLite Source
+#-----------
+
+def open_sqlite():
+    """Open SQLITE_FILE in WAL mode and create the tables if they're missing.
+    """
+    if state.db is not None:
+        return
+
+    #One connection shared by every thread. db_lock keeps their statements and transactions apart.
+    db = sqlite3.connect(SQLITE_FILE,check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+
+    with db:
+        db.execute("CREATE TABLE IF NOT EXISTS notes (id INTEGER PRIMARY KEY, title TEXT NOT NULL, content TEXT NOT NULL)")
+        db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    state.db = db
+
+def load_meta_sqlite(db:sqlite3.Connection) -> Optional[dict]:
+    """Read the id allocator from the meta table.
+
+    Args:
+        db (sqlite3.Connection): The connection. Call with db_lock held.
+
+    Returns:
+        Optional[dict]: id_count and free_ids. None if the table is empty.
+    """
+    rows = dict(db.execute("SELECT key, value FROM meta").fetchall())
+
+    if "id_count" not in rows:
+        return None
+
+    return {"id_count":int(rows["id_count"]),"free_ids":loads(rows.get("free_ids","[]"))}
+
+def save_meta_sqlite(db:sqlite3.Connection,meta:dict):
+    """Write the id allocator to the meta table.
+
+    Args:
+        db (sqlite3.Connection): The connection. Call with db_lock held, inside a transaction.
+        meta (dict): id_count and free_ids.
+    """
+    db.executemany(
+        "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+        [("id_count",str(meta["id_count"])),("free_ids",dumps(meta["free_ids"]))]
+    )
+
+def load_note_sqlite(id:str) -> Optional[dict]:
+    """Look up one note by id.
+
+    Args:
+        id (str): Id of the note.
+
+    Returns:
+        Optional[dict]: The note. None if it doesn't exist.
+    """
+    with state.db_lock:
+        row = state.db.execute("SELECT title, content FROM notes WHERE id = ?",(int(id),)).fetchone()
+
+    if row is None:
+        return None
+
+    return {"title":row[0],"content":row[1]}
+
+def insert_notes_sqlite(notes:list) -> list:
+    """Give many notes ids and insert them, in one transaction.
+
+    Args:
+        notes (list): The notes.
+
+    Returns:
+        list: The ids they were given, in order.
+    """
+    with state.db_lock, state.db:
+        #Take the write lock up front, so another process can't hand out the same id between our read and write.
+        state.db.execute("BEGIN IMMEDIATE")
+        apply_meta(load_meta_sqlite(state.db))
+        ids = [generate_id() for _ in notes]
+        state.db.executemany("INSERT INTO notes (id, title, content) VALUES (?, ?, ?)",
+                             [(id,note["title"],note["content"]) for id, note in zip(ids,notes)])
+        save_meta_sqlite(state.db,current_meta())
+
+    return [str(id) for id in ids]
+
+def delete_notes_sqlite(ids:list) -> list:
+    """Delete many notes and free their ids, in one transaction.
+
+    Args:
+        ids (list): Ids of the notes. No repeats.
+
+    Returns:
+        list: For each id, True if the note existed.
+    """
+    with state.db_lock, state.db:
+        state.db.execute("BEGIN IMMEDIATE")
+        found = [state.db.execute("DELETE FROM notes WHERE id = ?",(int(id),)).rowcount > 0 for id in ids]
+
+        if any(found):
+            apply_meta(load_meta_sqlite(state.db))
+            for id, gone in zip(ids,found):
+                if gone:
+                    state.ids.free(int(id))
+            save_meta_sqlite(state.db,current_meta())
+
+    return found
+
+def load_notes_many_sqlite(ids:list) -> dict:
+    """Look up many notes by id.
+
+    Args:
+        ids (list): Ids of the notes.
+
+    Returns:
+        dict: The notes that exist, id: note.
+    """
+    notes = {}
+
+    #Kept well under SQLite's limit on bound parameters.
+    for start in range(0,len(ids),500):
+        chunk = [int(id) for id in ids[start:start + 500]]
+        marks = ",".join("?" * len(chunk))
+
+        with state.db_lock:
+            rows = state.db.execute(f"SELECT id, title, content FROM notes WHERE id IN ({marks})",chunk).fetchall()
+
+        notes.update({str(id):{"title":title,"content":content} for id, title, content in rows})
+
+    return notes
+
+def load_page_sqlite(after:int,limit:int) -> list:
+    """Read notes in id order, starting after an id.
+
+    Args:
+        after (int): Only ids above this one.
+        limit (int): Most notes to return.
+
+    Returns:
+        list: (id, note) pairs.
+    """
+    with state.db_lock:
+        rows = state.db.execute("SELECT id, title, content FROM notes WHERE id > ? ORDER BY id LIMIT ?",(after,limit)).fetchall()
+
+    return [(str(id),{"title":title,"content":content}) for id, title, content in rows]
+
+def load_notes_sqlite() -> dict:
+    """Read every note.
+
+    Returns:
+        dict: Every note. Same shape as notes.json.
+    """
+    with state.db_lock:
+        rows = state.db.execute("SELECT id, title, content FROM notes ORDER BY id").fetchall()
+
+    return {str(id):{"title":title,"content":content} for id, title, content in rows}
+
+def save_notes_sqlite(notes:dict):
+    """Replace every note, and the meta if it's there, in one transaction.
+
+    Args:
+        notes (dict): Notes and _meta. Same shape as notes.json.
+    """
+    rows = [(int(k),v["title"],v["content"]) for k,v in notes.items() if k != "_meta"]
+
+    with state.db_lock, state.db:
+        state.db.execute("DELETE FROM notes")
+        state.db.executemany("INSERT INTO notes (id, title, content) VALUES (?, ?, ?)",rows)
+
+        if "_meta" in notes:
+            save_meta_sqlite(state.db,notes["_meta"])
+
+#-----------
+# Search Index
+#-----------
+
+def start_indexer():
+    """Drop the search index and start building a new one from the store in the background.
+    """
+    if not SEARCH_INDEX:
+        return
+
+    with state.search_lock:
+        state.search = None
+        state.search_ready.clear()
+
+        #Writes that land during the build are kept and replayed on top, in case the build read past them.
+        state.search_backlog = []
+        state.search_builds += 1
+        build = state.search_builds
+
+    Thread(target=build_search_index,args=(build,),name="search-index",daemon=True).start()
+
+def build_search_index(build:int):
+    """Index every note, then swap the index in. Runs on its own thread.
+
+    Args:
+        build (int): Which build this is. A newer setup makes older builds give up.
+    """
+    start = perf_counter()
+    index = SearchIndex()
+
+    try:
+        index.add_many(iter_notes())
+    except Exception as e:
+        print(f"Building the search index failed: {e}")
+
+        with state.search_lock:
+            if build == state.search_builds:
+                state.search_backlog = None
+        return
+
+    with state.search_lock:
+        if build != state.search_builds:
+            return
+
+        for op, id, note in state.search_backlog:
+            if op == "add":
+                index.add(id,note)
+            else:
+                index.remove(id)
+
+        state.search_backlog = None
+        state.search = index
+        state.search_ready.set()
+        state.search_builds_finished += 1
+
+    print(f"Search index built over {len(index)} notes in {perf_counter() - start:.2f}s.")
+
+def index_notes(pairs:list):
+    """Add notes this server just saved to the search index.
+
+    Args:
+        pairs (list): (id, note) pairs.
+    """
+    with state.search_lock:
+        for id, note in pairs:
+            if state.search is not None:
+                state.search.add(id,note)
+            elif state.search_backlog is not None:
+                state.search_backlog.append(("add",id,note))
+
+def unindex_notes(ids:list):
+    """Take notes this server just deleted out of the search index.
+
+    Args:
+        ids (list): Ids of the notes.
+    """
+    with state.search_lock:
+        for id in ids:
+            if state.search is not None:
+                state.search.remove(id)
+            elif state.search_backlog is not None:
+                state.search_backlog.append(("del",id,None))
+
+#-----------
+# Log Compaction
+#-----------
+
+def compaction_due() -> bool:
+    """Check the compaction thresholds.
+
+    Returns:
+        bool: True if the log is over LOG_COMPACT_RECORDS or LOG_COMPACT_BYTES, or a previous compaction was interrupted.
+    """
+    if state.log_records >= LOG_COMPACT_RECORDS or state.log_bytes >= LOG_COMPACT_BYTES:
+        return True
+
+    return Path(LOCAL_LOG + ".compacting").exists()
+
+def compact_log_local() -> Optional[dict]:
+    """Fold the log into the snapshot and empty it.
+
+    The active log is renamed out of the way first, so appends carry on into a fresh log while the
+    old one is folded. Readers replay the renamed log until the new snapshot is swapped in.
+
+    Returns:
+        Optional[dict]: Stats for this compaction. None if there was nothing to fold.
+    """
+    start = perf_counter()
+    folding = Path(LOCAL_LOG + ".compacting")
+
+    #Readers replay the renamed log and then the active one under snapshot_lock, so the rename can't land between the two.
+    with state.snapshot_lock, state.log_lock:
+        #A leftover file means the last compaction died midway. Finish that one first.
+        if not folding.exists() and Path(LOCAL_LOG).exists():
+            replace(LOCAL_LOG,folding)
+            state.log_records = 0
+            state.log_bytes = 0
+
+    if not folding.exists():
+        return None
+
+    log_bytes = folding.stat().st_size
+    notes = read_snapshot_local()
+    records = replay_log_local(notes,str(folding))
+
+    tmp = LOCAL_FILE + ".compact.tmp"
+    with open(tmp,"w",encoding="utf-8") as f:
+        dump(notes,f,separators=(",",":"))
+        f.flush()
+        fsync(f.fileno())
+
+    with state.snapshot_lock:
+        #A full snapshot was written while we were folding. It already has everything, so ours is stale.
+        if not folding.exists():
+            Path(tmp).unlink(missing_ok=True)
+            return None
+
+        replace(tmp,LOCAL_FILE)
+        folding.unlink()
+
+    stats = {
+        "duration_ms": round((perf_counter() - start) * 1000,3),
+        "records": records,
+        "log_bytes": log_bytes,
+        "notes": len(notes) - (1 if "_meta" in notes else 0),
+        "finished_at": time()
+    }
+    state.compactions += 1
+    state.last_compaction = stats
+    print(f"Compacted {records} log records into {stats['notes']} notes in {stats['duration_ms']}ms.")
+    return stats
+
+def compactor_loop():
+    """Run compactions in the background. Wakes every LOG_COMPACT_INTERVAL seconds, or early when an append crosses a threshold.
+    """
+    while True:
+        state.compact_event.wait(LOG_COMPACT_INTERVAL)
+        state.compact_event.clear()
+
+        #Setup may have switched us back online since the thread started.
+        if not isinstance(state.store,LogStore) or not compaction_due():
+            continue
+
+        try:
+            compact_log_local()
+        except Exception as e:
+            print(f"Log compaction failed: {e}")
+
+def start_compactor():
+    """Start the background compactor, if it isn't running already.
+    """
+    if state.compactor is not None and state.compactor.is_alive():
+        return
+
+    state.compactor = Thread(target=compactor_loop,name="log-compactor",daemon=True)
+    state.compactor.start()
+
+#----------------
+# Verification Functions
+#----------------
+
+def setup_error() -> Optional[ErrorCode]:
+    """Check that setup has been run for the current source.
+
+    Returns:
+        Optional[ErrorCode]: None if storage is ready, SETUP_REQUIRED if not.
+    """
+    if state.store is None:
+        return ErrorCode.SETUP_REQUIRED
+
+    if state.source == "offline" and not Path(LOCAL_FILE).exists():
+        return ErrorCode.SETUP_REQUIRED
+
+    if state.source == "online" and (state.blob_r is None or state.bucket is None):
+        return ErrorCode.SETUP_REQUIRED
+
+    if state.source == "sqlite" and state.db is None:
+        return ErrorCode.SETUP_REQUIRED
+
+    return None
 
 def parse_id(id_val: Optional[str]) -> Optional[ErrorCode]:
     """Use check_int_positive and other checks to make sure an id is valid.
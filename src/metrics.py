@@ -0,0 +1,213 @@
+from typing import Callable, Iterable
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+from math import inf
+
+
+#-----------
+# Metrics
+#-----------
+#Counters, gauges and histograms rendered in the Prometheus text format, with nothing to install.
+#Every metric has a fixed list of label names. Each distinct set of label values is its own series.
+
+#Latency buckets in seconds. Finer at the bottom than Prometheus' defaults, since local reads take well under 5ms.
+LATENCY_BUCKETS:tuple = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def escape(value:str) -> str:
+    """Escape a label value for the text format.
+    """
+    return str(value).replace("\\","\\\\").replace("\"","\\\"").replace("\n","\\n")
+
+def format_labels(names:tuple, values:tuple, extra:str = "") -> str:
+    """
+    Returns:
+        str: {name="value",...}, or nothing if there are no labels.
+    """
+    parts = [f'{name}="{escape(value)}"' for name, value in zip(names,values)]
+
+    if extra:
+        parts.append(extra)
+
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def format_value(value:float) -> str:
+    if value == inf:
+        return "+Inf"
+
+    if float(value).is_integer():
+        return str(int(value))
+
+    return repr(float(value))
+
+class Metric:
+    """Shared by every kind of metric: a name, help text, label names, and one value per set of label values.
+    """
+    kind = "untyped"
+
+    def __init__(self, name:str, help:str, labels:Iterable[str] = ()):
+        """
+        Args:
+            name (str): Metric name, e.g. notes_storage_seconds.
+            help (str): One line saying what it measures.
+            labels (Iterable[str]): Label names. Every update has to give a value for each.
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values:dict = {}
+        self._lock = Lock()
+
+    def _key(self, labels:dict) -> tuple:
+        return tuple(str(labels.get(name,"")) for name in self.labels)
+
+    def samples(self) -> list:
+        """
+        Returns:
+            list: (suffix, label string, value) for every series.
+        """
+        with self._lock:
+            return [("",format_labels(self.labels,key),value) for key, value in sorted(self._values.items())]
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}",f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{self.name}{suffix}{labels} {format_value(value)}" for suffix, labels, value in self.samples()]
+        return "\n".join(lines)
+
+class Counter(Metric):
+    """Only goes up.
+    """
+    kind = "counter"
+
+    def inc(self, amount:float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key,0) + amount
+
+class Gauge(Metric):
+    """Goes up and down.
+    """
+    kind = "gauge"
+
+    def set(self, value:float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount:float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key,0) + amount
+
+    def dec(self, amount:float = 1, **labels):
+        self.inc(-amount,**labels)
+
+class Histogram(Metric):
+    """Counts observations into cumulative buckets, plus their sum and count.
+    """
+    kind = "histogram"
+
+    def __init__(self, name:str, help:str, labels:Iterable[str] = (), buckets:tuple = LATENCY_BUCKETS):
+        """
+        Args:
+            buckets (tuple): Upper bounds, in increasing order. +Inf is added at the end.
+        """
+        super().__init__(name,help,labels)
+        self.buckets = tuple(buckets) + (inf,)
+
+    def observe(self, value:float, **labels):
+        key = self._key(labels)
+
+        #First bucket the value fits in. Buckets are made cumulative when rendered, so an update touches one slot.
+        index = next(i for i, bound in enumerate(self.buckets) if value <= bound)
+
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [[0] * len(self.buckets),0.0,0]
+
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the body of a with block takes, in seconds. Also when it raises.
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start,**labels)
+
+    def samples(self) -> list:
+        result = []
+
+        with self._lock:
+            series = sorted((key,([*counts],total,count)) for key, (counts, total, count) in self._values.items())
+
+        for key, (counts, total, count) in series:
+            running = 0
+            for bound, bucket in zip(self.buckets,counts):
+                running += bucket
+                result.append(("_bucket",format_labels(self.labels,key,f'le="{format_value(bound)}"'),running))
+
+            result.append(("_sum",format_labels(self.labels,key),total))
+            result.append(("_count",format_labels(self.labels,key),count))
+
+        return result
+
+class Registry:
+    """Every metric, plus collectors that read values from elsewhere at scrape time.
+    """
+
+    def __init__(self):
+        self._metrics:list[Metric] = []
+        self._collectors:list[Callable[[], list]] = []
+        self._lock = Lock()
+
+    def register(self, metric:Metric) -> Metric:
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def collector(self, collect:Callable[[], list]):
+        """Add a function called on every scrape. For values already counted somewhere else, like the storage state.
+
+        Args:
+            collect (Callable[[], list]): Returns (name, kind, help, value) tuples, kind "counter" or "gauge".
+        """
+        with self._lock:
+            self._collectors.append(collect)
+
+    def counter(self, name:str, help:str, labels:Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name,help,labels))
+
+    def gauge(self, name:str, help:str, labels:Iterable[str] = ()) -> Gauge:
+        return self.register(Gauge(name,help,labels))
+
+    def histogram(self, name:str, help:str, labels:Iterable[str] = (), buckets:tuple = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name,help,labels,buckets))
+
+    def render(self) -> str:
+        """
+        Returns:
+            str: Every metric in the Prometheus text format.
+        """
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = list(self._collectors)
+
+        parts = [metric.render() for metric in metrics]
+
+        for collect in collectors:
+            for name, kind, help, value in collect():
+                parts.append(f"# HELP {name} {help}\n# TYPE {name} {kind}\n{name} {format_value(value)}")
+
+        return "\n".join(parts) + "\n"
+
+#The one registry both main.py and app.py add to.
+REGISTRY = Registry()
+
+#The content type Prometheus expects for the text format.
+CONTENT_TYPE:str = "text/plain; version=0.0.4; charset=utf-8"
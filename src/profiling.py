@@ -0,0 +1,253 @@
+from typing import Optional, Iterable, Iterator, Callable, Tuple
+from collections import OrderedDict, Counter
+from cProfile import Profile
+from pstats import Stats
+from io import StringIO
+from threading import Lock, get_ident, enumerate as all_threads
+from time import perf_counter, sleep
+from pathlib import Path
+from os import urandom, sep
+import marshal
+import sys
+import re
+
+
+#-----------
+# Request Profiles
+#-----------
+#Single requests run under cProfile on demand, kept in memory so their stats can be read back over the API.
+#Optionally also written out as .prof files, which pstats, snakeviz and friends open directly.
+
+#Orders GET /profiles/<id> can sort by. The names pstats itself takes.
+SORTS:tuple = ("cumulative", "tottime", "ncalls", "filename", "name")
+
+def path_trimmer() -> Callable[[str], str]:
+    """A function that trims a file name down to its path under sys.path, e.g. google/cloud/storage/blob.py.
+    Unlike Stats.strip_dirs, the package stays in the name, so filters like json/|google/cloud still match.
+    """
+    folders = sorted({str(Path(p).resolve()) + sep for p in sys.path if p},key=len,reverse=True)
+
+    def trim(filename:str) -> str:
+        folder = next((f for f in folders if filename.startswith(f)),"")
+        return filename[len(folder):]
+
+    return trim
+
+def short_paths(stats:dict) -> dict:
+    """Stats with every file name passed through path_trimmer(), callers included.
+    """
+    trim = path_trimmer()
+
+    def short(func:tuple) -> tuple:
+        return (trim(func[0]),) + func[1:]
+
+    return {short(func):(cc,nc,tt,ct,{short(caller):value for caller, value in callers.items()})
+            for func, (cc,nc,tt,ct,callers) in stats.items()}
+
+class Snapshot:
+    """Kept stats dressed up as a profile, since that is what Stats reads them from.
+    """
+    def __init__(self, stats:dict):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+class ProfileStore:
+    """The most recent request profiles.
+    """
+
+    def __init__(self, keep:int = 20, folder:Optional[str] = None):
+        """
+        Args:
+            keep (int): Most profiles kept in memory. The oldest is dropped first.
+            folder (Optional[str]): Folder each profile is also written to, as <id>.prof.
+        """
+        self.configure(keep,folder)
+        self._profiles:OrderedDict = OrderedDict()
+        self._lock = Lock()
+
+        #Held while a request is being profiled. Only one profiler can run at a time from Python 3.12.
+        self.running = Lock()
+
+    def configure(self, keep:int, folder:Optional[str] = None):
+        self.keep = keep
+        self.folder = folder
+
+    def new_id(self) -> str:
+        """An id for a profile that is still running, so it can be handed out before the profile is added.
+        """
+        return urandom(8).hex()
+
+    def add(self, id:str, profile:Profile, label:str, started:float):
+        """Keep a finished profile.
+
+        Args:
+            id (str): From new_id(). What it's read back with.
+            profile (Profile): Already disabled.
+            label (str): What was profiled, e.g. GET /notes?id=3.
+            started (float): When the request arrived, as a Unix time.
+        """
+        #Stats takes the stats out of what it reads, leaving that empty. So they're kept from Stats itself.
+        stats = Stats(profile)
+        entry = {"id":id,"label":label,"started":started,"seconds":round(stats.total_tt,6),"stats":stats.stats}
+
+        with self._lock:
+            self._profiles[id] = entry
+            while len(self._profiles) > self.keep:
+                self._profiles.popitem(last=False)
+
+        if self.folder:
+            Path(self.folder).mkdir(parents=True,exist_ok=True)
+            (Path(self.folder) / f"{id}.prof").write_bytes(marshal.dumps(entry["stats"]))
+
+    def list(self) -> list:
+        """
+        Returns:
+            list: id, label, started and seconds of every kept profile, newest first.
+        """
+        with self._lock:
+            entries = list(self._profiles.values())
+
+        return [{k:v for k,v in entry.items() if k != "stats"} for entry in reversed(entries)]
+
+    def raw(self, id:str) -> Optional[bytes]:
+        """
+        Returns:
+            Optional[bytes]: The stats in the .prof format. None if the profile isn't kept.
+        """
+        with self._lock:
+            entry = self._profiles.get(id)
+
+        return marshal.dumps(entry["stats"]) if entry is not None else None
+
+    def report(self, id:str, sort:str = "cumulative", limit:int = 40, pattern:Optional[str] = None) -> Optional[str]:
+        """The profile as pstats prints it.
+
+        Args:
+            id (str): From new_id().
+            sort (str): One of SORTS.
+            limit (int): Most functions listed.
+            pattern (Optional[str]): Only list functions whose file:line(name) matches this regex, e.g. load_notes|json/.
+
+        Returns:
+            Optional[str]: The report. None if the profile isn't kept.
+        """
+        with self._lock:
+            entry = self._profiles.get(id)
+
+        if entry is None:
+            return None
+
+        out = StringIO()
+        out.write(f"{entry['label']}\n")
+
+        stats = Stats(Snapshot(short_paths(entry["stats"])),stream=out).sort_stats(sort)
+
+        restrictions = [pattern] if pattern else []
+        stats.print_stats(*restrictions,limit)
+        return out.getvalue()
+
+def profile_stream(profile:Profile, chunks:Iterable) -> Iterator:
+    """Pass a streamed body through, running the profiler only while each chunk is made.
+    A streamed listing does its reading after the view has returned, so this is where most of its time goes.
+
+    Args:
+        profile (Profile): The request's profiler.
+        chunks (Iterable): The response body.
+    """
+    iterator = iter(chunks)
+
+    try:
+        while True:
+            profile.enable()
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                profile.disable()
+
+            yield chunk
+    finally:
+        if hasattr(iterator,"close"):
+            iterator.close()
+
+#The one store app.py keeps profiles in.
+PROFILES = ProfileStore()
+
+#-----------
+# Sampling Profiler
+#-----------
+#Looks at every thread's stack at a fixed interval with sys._current_frames(), instead of hooking every call like cProfile.
+#Cheap enough to run under live load. Stacks come back collapsed, "root;caller;callee count" per line, which
+#flamegraph.pl, speedscope and friends turn straight into a flame graph.
+
+#Numbers in thread names, so Thread-12 (process_request_thread) and Thread-13 (...) are one root in the graph.
+DIGITS = re.compile(r"\d+")
+
+class Sampler:
+    """Samples the stacks of the server's threads.
+    """
+
+    def __init__(self):
+        #Held while sampling. One window at a time is plenty, and two would only slow each other down.
+        self.running = Lock()
+
+    def sample(self, seconds:float, interval:float, only:Optional[str] = None) -> Tuple[Counter, int]:
+        """Sample every other thread's stack until seconds have passed. Blocks the calling thread meanwhile.
+
+        Args:
+            seconds (float): How long to sample for.
+            interval (float): Seconds between samples.
+            only (Optional[str]): Only sample threads whose name matches this regex, e.g. process_request for the
+                threads serving requests, or process_request|ThreadPoolExecutor to add the GCS download pools.
+
+        Returns:
+            Tuple[Counter, int]: How many times each collapsed stack was seen, and how many samples were taken.
+        """
+        me = get_ident()
+        pattern = re.compile(only) if only else None
+        trim = path_trimmer()
+        labels:dict = {}
+        stacks:Counter = Counter()
+        samples = 0
+        deadline = perf_counter() + seconds
+
+        while True:
+            names = {thread.ident:thread.name for thread in all_threads()}
+
+            for ident, frame in sys._current_frames().items():
+                name = names.get(ident,"unknown")
+                if ident == me or (pattern is not None and not pattern.search(name)):
+                    continue
+
+                stack = []
+                while frame is not None:
+                    #One label per code object, worked out the first time it's seen.
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = labels[code] = f"{getattr(code,'co_qualname',code.co_name)} ({trim(code.co_filename)})"
+
+                    stack.append(label)
+                    frame = frame.f_back
+
+                stack.append(DIGITS.sub("N",name))
+                stacks[";".join(reversed(stack))] += 1
+
+            samples += 1
+            if perf_counter() >= deadline:
+                return stacks, samples
+
+            sleep(interval)
+
+def collapse(stacks:Counter) -> str:
+    """
+    Returns:
+        str: One "stack count" line per stack, most seen first.
+    """
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+#The one sampler app.py uses.
+SAMPLER = Sampler()
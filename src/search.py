@@ -0,0 +1,288 @@
+from typing import Optional, Iterable
+from collections import Counter
+from heapq import nlargest, nsmallest
+from math import log
+from bisect import bisect_left, insort
+import re
+
+
+#-----------
+# Search Index
+#-----------
+
+TOKEN = re.compile(r"\w+")
+
+def tokenize(text:str) -> list:
+    """Split text into lowercase word tokens.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        list: The tokens, in order, with repeats.
+    """
+    return TOKEN.findall(text.lower())
+
+def trigrams(text:str, padded:bool = True) -> set:
+    """Every run of three characters in lowercase text.
+
+    Args:
+        text (str): The text.
+        padded (bool): Add spaces around the text first, so its start and end get trigrams of their own.
+            Substring lookups leave this off, since the query's ends needn't be the title's ends.
+
+    Returns:
+        set: The trigrams.
+    """
+    text = text.lower()
+
+    if padded:
+        text = "  " + text + " "
+
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class SearchIndex:
+    """In-memory full-text index over note titles and content, ranked by BM25, plus a trigram index over titles.
+
+    Each token maps to a posting dict of note id to how often the token appears in that note. A query only
+    visits the postings of its own tokens, so it never touches notes that don't share a word with it. Adding
+    or removing a note only updates the postings of that note's tokens.
+
+    Each title trigram maps to the set of ids whose title contains it. Substring candidates are the intersection
+    of the query's trigram sets, and typo-tolerant matches are the titles sharing enough of the query's trigrams.
+
+    Lowercase titles are also kept in one sorted list of (title, id), so every title starting with a prefix sits
+    in a single run that a binary search finds.
+
+    Not thread-safe. The caller serializes access.
+    """
+
+    def __init__(self, k1:float = 1.2, b:float = 0.75):
+        """
+        Args:
+            k1 (float): How quickly repeats of a token stop adding to the score.
+            b (float): How much longer notes are penalized, from 0 (not at all) to 1.
+        """
+        self.k1 = k1
+        self.b = b
+        self._postings:dict[str, dict[str, int]] = {}
+        self._terms:dict[str, tuple] = {}
+        self._lengths:dict[str, int] = {}
+        self._titles:dict[str, str] = {}
+        self._total = 0
+        self._grams:dict[str, set] = {}
+        #(lowercased title, id as a number, id), so equal titles sort by id numerically rather than as strings.
+        self._sorted:list[tuple[str, int, str]] = []
+
+    def add(self, id:str, note:dict):
+        """Index a note, replacing it if it's already indexed.
+
+        Args:
+            id (str): Id of the note.
+            note (dict): The note, with "title" and "content".
+        """
+        self._add(id, note)
+        insort(self._sorted, (self._titles[id].lower(), int(id), id))
+
+    def add_many(self, notes:Iterable):
+        """Index many notes at once. Much faster than add() one by one, since the titles are sorted once at the end.
+
+        Args:
+            notes (Iterable): (id, note) pairs.
+        """
+        for id, note in notes:
+            self._add(id, note)
+            self._sorted.append((self._titles[id].lower(), int(id), id))
+
+        self._sorted.sort()
+
+    def _add(self, id:str, note:dict):
+        """Index a note everywhere but the sorted titles.
+        """
+        self.remove(id)
+
+        tokens = tokenize(note.get("title","")) + tokenize(note.get("content",""))
+        counts = Counter(tokens)
+
+        for term, tf in counts.items():
+            self._postings.setdefault(term, {})[id] = tf
+
+        #The distinct terms are kept so a removal knows which postings to visit without the note itself.
+        self._terms[id] = tuple(counts)
+        self._lengths[id] = len(tokens)
+        self._titles[id] = note.get("title","")
+        self._total += len(tokens)
+
+        for gram in trigrams(self._titles[id]):
+            self._grams.setdefault(gram, set()).add(id)
+
+    def remove(self, id:str) -> bool:
+        """Take a note out of the index.
+
+        Args:
+            id (str): Id of the note.
+
+        Returns:
+            bool: True if it was indexed.
+        """
+        terms = self._terms.pop(id, None)
+
+        if terms is None:
+            return False
+
+        for term in terms:
+            postings = self._postings[term]
+            del postings[id]
+
+            if not postings:
+                del self._postings[term]
+
+        title = self._titles.pop(id)
+
+        key = (title.lower(), int(id), id)
+        i = bisect_left(self._sorted, key)
+
+        #Only off partway through add_many(), before the list has been sorted.
+        if i < len(self._sorted) and self._sorted[i] == key:
+            del self._sorted[i]
+        else:
+            self._sorted.remove(key)
+
+        for gram in trigrams(title):
+            ids = self._grams[gram]
+            ids.discard(id)
+
+            if not ids:
+                del self._grams[gram]
+
+        self._total -= self._lengths.pop(id)
+        return True
+
+    def search(self, query:str, limit:int) -> list:
+        """Find the notes that best match a query.
+
+        Args:
+            query (str): Free text. Each distinct token counts once.
+            limit (int): Most results to return.
+
+        Returns:
+            list: (id, score) pairs, best first.
+        """
+        count = len(self._lengths)
+
+        if count == 0:
+            return []
+
+        average = self._total / count
+        scores:dict[str, float] = {}
+
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+
+            if not postings:
+                continue
+
+            idf = log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+
+            for id, tf in postings.items():
+                norm = self.k1 * (1 - self.b + self.b * self._lengths[id] / average)
+                scores[id] = scores.get(id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+
+        return nlargest(limit, scores.items(), key=lambda item: item[1])
+
+    def match_title(self, query:str, limit:int, similarity:float = 0.5) -> list:
+        """Find titles that contain a query, or nearly match it.
+
+        Args:
+            query (str): Part of a title. Case doesn't matter.
+            limit (int): Most results to return.
+            similarity (float): Least share of the query's trigrams, from 0 to 1, a title needs to have to count
+                as a near match.
+
+        Returns:
+            list: (id, score) pairs, best first. Titles that contain the query score 1 and come first,
+                shortest first. Near matches score the share of the query's trigrams they have.
+        """
+        needle = query.lower()
+        results = []
+
+        #Substring matches. Every trigram of the query has to be in the title, so only ids in all of their sets can match.
+        grams = trigrams(needle, padded=False)
+        if grams:
+            sets = sorted((self._grams.get(gram, set()) for gram in grams), key=len)
+            candidates = set.intersection(*sets) if sets[0] else set()
+        else:
+            #Too short for a trigram of its own, so take every trigram it appears in instead.
+            candidates = set().union(*(ids for gram, ids in self._grams.items() if needle in gram))
+
+        #Trigrams can all be there without being in a row, so each candidate is still checked.
+        found = [id for id in candidates if needle in self._titles[id].lower()]
+        results += [(id, 1.0) for id in nsmallest(limit, found, key=lambda id: (len(self._titles[id]), id))]
+
+        if len(results) >= limit:
+            return results
+
+        #Near matches, scored by how many of the query's trigrams the title has. Only the query's share counts,
+        #so a long title isn't marked down for the words around the match.
+        grams = trigrams(needle)
+        shared:dict[str, int] = {}
+        for gram in grams:
+            for id in self._grams.get(gram, ()):
+                shared[id] = shared.get(id, 0) + 1
+
+        exact = set(found)
+        scores = []
+        for id, count in shared.items():
+            score = count / len(grams)
+
+            if score >= similarity and id not in exact:
+                scores.append((id, score))
+
+        #Between equal scores, the shorter title is the closer match.
+        return results + nlargest(limit - len(results), scores, key=lambda item: (item[1], -len(self._titles[item[0]])))
+
+    def complete(self, prefix:str, limit:int) -> list:
+        """Find titles that start with a prefix.
+
+        Args:
+            prefix (str): Start of a title. Case doesn't matter.
+            limit (int): Most titles to return.
+
+        Returns:
+            list: (id, title) pairs in title order. Each title only once, with the lowest id that has it.
+        """
+        prefix = prefix.lower()
+        results = []
+        last = None
+
+        i = bisect_left(self._sorted, (prefix,))
+        while i < len(self._sorted) and len(results) < limit:
+            title, _, id = self._sorted[i]
+
+            if not title.startswith(prefix):
+                break
+
+            if title != last:
+                results.append((id, self._titles[id]))
+                last = title
+
+            i += 1
+
+        return results
+
+    def title(self, id:str) -> Optional[str]:
+        """
+        Args:
+            id (str): Id of the note.
+
+        Returns:
+            Optional[str]: The title of an indexed note. None if it isn't indexed.
+        """
+        return self._titles.get(id)
+
+    def __len__(self) -> int:
+        """
+        Returns:
+            int: How many notes are indexed.
+        """
+        return len(self._lengths)
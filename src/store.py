@@ -0,0 +1,176 @@
+from typing import Optional, Protocol, Iterator, Tuple, Callable
+from threading import Lock
+from heapq import nsmallest
+from ids import IdAllocator
+
+
+#-----------
+# Note Store
+#-----------
+
+class NoteStore(Protocol):
+    """What every storage backend provides.
+
+    Writes take lists, so a batch is one round trip wherever the backend can manage it. Ids are strings of
+    non-negative integers. load() and save() deal in the whole store, the same shape as notes.json, and are only
+    meant for setup, flushing the cache and moving data between backends.
+    """
+
+    def get(self, id:str) -> Optional[dict]:
+        """
+        Args:
+            id (str): Id of the note.
+
+        Returns:
+            Optional[dict]: The note. None if it doesn't exist.
+        """
+
+    def get_many(self, ids:list) -> dict:
+        """
+        Args:
+            ids (list): Ids of the notes.
+
+        Returns:
+            dict: The notes that exist, id: note. May hold others too.
+        """
+
+    def put(self, notes:list) -> list:
+        """Give each note a new id and save them.
+
+        Args:
+            notes (list): The notes.
+
+        Returns:
+            list: The ids they were given, in order.
+        """
+
+    def delete(self, ids:list) -> list:
+        """Delete notes and free their ids.
+
+        Args:
+            ids (list): Ids of the notes. No repeats.
+
+        Returns:
+            list: For each id, True if the note existed.
+        """
+
+    def scan(self) -> Iterator[Tuple[str, dict]]:
+        """
+        Returns:
+            Iterator[Tuple[str, dict]]: Every note as (id, note), holding as little in memory at once as the backend allows.
+        """
+
+    def page(self, position:dict, limit:int) -> Tuple[list, Optional[dict]]:
+        """
+        Args:
+            position (dict): Where the page starts, as returned with the previous page. Empty for the first page.
+            limit (int): Most notes to return.
+
+        Returns:
+            Tuple[list, Optional[dict]]: (id, note) pairs, and where the next page starts. None if there are no more.
+        """
+
+    def load(self) -> dict:
+        """
+        Returns:
+            dict: Every note, id: note.
+        """
+
+    def save(self, notes:dict):
+        """Replace every note.
+
+        Args:
+            notes (dict): Every note, id: note.
+        """
+
+    def load_meta(self) -> Optional[dict]:
+        """
+        Returns:
+            Optional[dict]: The id allocator's meta. None if there isn't any yet.
+        """
+
+    def save_meta(self, meta:dict, guarded:bool = True):
+        """
+        Args:
+            meta (dict): The id allocator's meta.
+            guarded (bool): Where the backend supports it, fail if the meta changed since it was last read.
+        """
+
+class MemoryStore:
+    """Notes kept in a dict and nothing else. Gone when the process exits.
+
+    Useful for tests and for benchmarking the server without any storage cost.
+    """
+
+    def __init__(self, reuse:bool = True, ids:Optional[Callable[[], IdAllocator]] = None):
+        """
+        Args:
+            reuse (bool): Hand the ids of deleted notes out again.
+            ids (Optional[Callable[[], IdAllocator]]): Returns the id allocator to hand ids out from, so a caller that
+                keeps its own can share it with the store. The store keeps a private one if not given.
+        """
+        self._notes:dict[str, dict] = {}
+        self._meta:Optional[dict] = None
+        self._own = IdAllocator(reuse=reuse)
+        self._ids = ids or (lambda: self._own)
+        self._lock = Lock()
+
+    def get(self, id:str) -> Optional[dict]:
+        return self._notes.get(id)
+
+    def get_many(self, ids:list) -> dict:
+        with self._lock:
+            return {id:self._notes[id] for id in ids if id in self._notes}
+
+    def put(self, notes:list) -> list:
+        with self._lock:
+            allocator = self._ids()
+            ids = [str(allocator.allocate()) for _ in notes]
+            self._notes.update(zip(ids, notes))
+            self._meta = allocator.to_meta()
+
+        return ids
+
+    def delete(self, ids:list) -> list:
+        with self._lock:
+            allocator = self._ids()
+            found = [self._notes.pop(id, None) is not None for id in ids]
+
+            for id, gone in zip(ids, found):
+                if gone:
+                    allocator.free(int(id))
+
+            self._meta = allocator.to_meta()
+
+        return found
+
+    def scan(self) -> Iterator[Tuple[str, dict]]:
+        #A snapshot of the items, so writers can carry on while it's read.
+        with self._lock:
+            return iter(list(self._notes.items()))
+
+    def page(self, position:dict, limit:int) -> Tuple[list, Optional[dict]]:
+        after = position.get("after", -1)
+
+        with self._lock:
+            ids = nsmallest(limit + 1, (i for i in map(int, self._notes) if i > after))
+            page = [(str(i), self._notes[str(i)]) for i in ids[:limit]]
+
+        return page, ({"after":ids[limit - 1]} if len(ids) > limit else None)
+
+    def load(self) -> dict:
+        with self._lock:
+            return dict(self._notes)
+
+    def save(self, notes:dict):
+        with self._lock:
+            self._notes = {id:note for id, note in notes.items() if id != "_meta"}
+
+    def load_meta(self) -> Optional[dict]:
+        return self._meta
+
+    def save_meta(self, meta:dict, guarded:bool = True):
+        #A shared allocator is the caller's to rebuild from the meta.
+        with self._lock:
+            self._meta = meta
+            self._own = IdAllocator.from_meta(meta, self._own.reuse)
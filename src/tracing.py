@@ -0,0 +1,265 @@
+from typing import Optional, Callable
+from dataclasses import dataclass, field
+from contextlib import contextmanager
+from contextvars import ContextVar
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock
+from time import perf_counter, time
+from json import dumps
+from os import urandom
+
+
+#-----------
+# Tracing
+#-----------
+#Spans with a start, a duration, attributes and a parent, grouped into one trace per request, with nothing to install.
+#The span a thread is in is kept in a ContextVar, so spans opened inside it become its children.
+#Finished traces are kept in memory, and optionally appended to a file as one line of JSON each.
+
+@dataclass
+class Span:
+    """One timed operation.
+    """
+    name:str
+    trace_id:str
+    span_id:str
+    parent:Optional["Span"] = field(default=None,repr=False)
+    attributes:dict = field(default_factory=dict)
+    start:float = field(default_factory=time)
+    began:float = field(default_factory=perf_counter,repr=False)
+    duration:Optional[float] = None
+    error:Optional[str] = None
+
+    def set(self, **attributes):
+        """Add or replace attributes, e.g. the bytes a download turned out to be.
+        """
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> dict:
+        return {
+            "name":self.name,
+            "trace_id":self.trace_id,
+            "span_id":self.span_id,
+            "parent_id":self.parent.span_id if self.parent is not None else None,
+            "start":self.start,
+            "duration_ms":round(self.duration * 1000,3) if self.duration is not None else None,
+            "attributes":self.attributes,
+            "error":self.error,
+        }
+
+class NoSpan:
+    """Stands in for a span while tracing is off, so callers don't have to check.
+    """
+    def set(self, **attributes):
+        pass
+
+NO_SPAN = NoSpan()
+
+def summarize(trace_id:str, spans:list, dropped:int = 0) -> dict:
+    """Sum up one trace: how long its root took and where the time went.
+
+    Args:
+        trace_id (str): Id of the trace.
+        spans (list): Its finished spans, as dicts.
+        dropped (int): Spans that went over the cap and weren't kept.
+
+    Returns:
+        dict: trace_id, name, start and duration_ms of the root, per span name how many there were and their total ms,
+            and how many spans were dropped.
+    """
+    root = next((s for s in spans if s["parent_id"] is None),spans[0] if spans else None)
+    by_name:dict = {}
+
+    for s in spans:
+        if s is root:
+            continue
+
+        entry = by_name.setdefault(s["name"],{"count":0,"total_ms":0.0})
+        entry["count"] += 1
+        entry["total_ms"] = round(entry["total_ms"] + (s["duration_ms"] or 0),3)
+
+    return {
+        "trace_id":trace_id,
+        "name":root["name"] if root else None,
+        "start":root["start"] if root else None,
+        "duration_ms":root["duration_ms"] if root else None,
+        "spans":len(spans),
+        "dropped":dropped,
+        "by_name":by_name,
+    }
+
+class Tracer:
+    """Starts and finishes spans, and keeps the most recent traces.
+    """
+
+    def __init__(self, enabled:bool = True, keep:int = 1000, export:Optional[str] = None, max_spans:int = 1000):
+        """
+        Args:
+            enabled (bool): Record spans at all.
+            keep (int): Most traces kept in memory. The oldest is dropped first.
+            export (Optional[str]): File each finished trace is appended to, as a line of JSON.
+            max_spans (int): Most spans kept per trace, root aside. Later ones are only counted, so a request that
+                downloads every note object doesn't keep a span for each.
+        """
+        self.configure(enabled,keep,export,max_spans)
+        self._current:ContextVar = ContextVar("span",default=None)
+        self._traces:OrderedDict = OrderedDict()
+        self._dropped:dict = {}
+        self._lock = Lock()
+        self._export_lock = Lock()
+
+    def configure(self, enabled:bool, keep:int, export:Optional[str] = None, max_spans:int = 1000):
+        self.enabled = enabled
+        self.keep = keep
+        self.export = export
+        self.max_spans = max_spans
+
+    def current(self) -> Optional[Span]:
+        return self._current.get()
+
+    def start(self, name:str, **attributes) -> Span:
+        """Open a span as a child of the current one, or as the root of a new trace, and make it current.
+
+        Returns:
+            Span: The span. Has to be given to finish().
+        """
+        return self.start_under(self._current.get(),name,**attributes)
+
+    def start_trace(self, name:str, **attributes) -> Span:
+        """Open the root span of a new trace, whatever is current. For a request on a thread that served others before.
+        """
+        return self.start_under(None,name,**attributes)
+
+    def start_under(self, parent:Optional[Span], name:str, **attributes) -> Span:
+        """Open a span under the given parent, or as a root if there is none, and make it current.
+        """
+        trace_id = parent.trace_id if parent is not None else urandom(16).hex()
+        span = Span(name,trace_id,urandom(8).hex(),parent,attributes)
+        self._current.set(span)
+        return span
+
+    def finish(self, span:Span, error:Optional[BaseException] = None):
+        """Close a span, record it, and make its parent current again.
+
+        Args:
+            span (Span): From start().
+            error (Optional[BaseException]): What it raised, if it did.
+        """
+        span.duration = perf_counter() - span.began
+
+        if error is not None:
+            span.error = type(error).__name__
+
+        self._current.set(span.parent)
+
+        with self._lock:
+            spans = self._traces.get(span.trace_id)
+            if spans is None:
+                spans = self._traces[span.trace_id] = []
+                while len(self._traces) > self.keep:
+                    self._dropped.pop(self._traces.popitem(last=False)[0],None)
+
+            #The root finishes last and is what the trace is summed up by, so it's always kept.
+            if len(spans) < self.max_spans or span.parent is None:
+                spans.append(span.to_dict())
+            else:
+                self._dropped[span.trace_id] = self._dropped.get(span.trace_id,0) + 1
+
+            dropped = self._dropped.get(span.trace_id,0)
+
+        if span.parent is None and self.export:
+            line = dumps({"trace_id":span.trace_id,"dropped":dropped,"spans":list(spans)}) + "\n"
+            with self._export_lock, open(self.export,"a",encoding="utf-8") as f:
+                f.write(line)
+
+    @contextmanager
+    def span(self, name:str, **attributes):
+        """Time the body of a with block as a span. Yields the span, so attributes found inside can be added.
+        Only opens one under a current span. Work outside a request, like the flusher or compactor thread, isn't
+        traced unless it was handed over with propagate(), so it doesn't push requests out of the kept traces.
+        """
+        if not self.enabled or self._current.get() is None:
+            yield NO_SPAN
+            return
+
+        span = self.start(name,**attributes)
+        try:
+            yield span
+        except BaseException as e:
+            self.finish(span,e)
+            raise
+        self.finish(span)
+
+    def traced(self, name:str):
+        """Decorator that runs every call of a function in a span.
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args,**kwargs)
+            return wrapper
+        return decorator
+
+    def propagate(self, func:Callable) -> Callable:
+        """Make spans opened by func in another thread children of the span current here.
+        ContextVars don't follow work handed to a thread pool on their own.
+        """
+        parent = self._current.get()
+        if parent is None:
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            token = self._current.set(parent)
+            try:
+                return func(*args,**kwargs)
+            finally:
+                self._current.reset(token)
+        return wrapper
+
+    def get(self, trace_id:str) -> Optional[list]:
+        """
+        Returns:
+            Optional[list]: Every kept span of the trace, in the order they started. None if it isn't kept.
+        """
+        with self._lock:
+            spans = self._traces.get(trace_id)
+            spans = list(spans) if spans is not None else None
+
+        return sorted(spans,key=lambda s: s["start"]) if spans is not None else None
+
+    def dropped(self, trace_id:str) -> int:
+        """
+        Returns:
+            int: Spans of the trace that went over max_spans and weren't kept.
+        """
+        with self._lock:
+            return self._dropped.get(trace_id,0)
+
+    def recent(self, limit:int = 50, slowest:bool = False) -> list:
+        """Summaries of the kept traces.
+
+        Args:
+            limit (int): Most to return.
+            slowest (bool): Longest first instead of newest first.
+
+        Returns:
+            list: One summarize() per trace.
+        """
+        with self._lock:
+            traces = [(trace_id,list(spans),self._dropped.get(trace_id,0)) for trace_id, spans in self._traces.items()]
+
+        summaries = [summarize(trace_id,spans,dropped) for trace_id, spans, dropped in reversed(traces)]
+
+        if slowest:
+            summaries.sort(key=lambda s: s["duration_ms"] or 0,reverse=True)
+
+        return summaries[:limit]
+
+#The one tracer both main.py and app.py use.
+TRACER = Tracer()
+span = TRACER.span
+traced = TRACER.traced
+propagate = TRACER.propagate
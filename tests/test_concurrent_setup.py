@@ -0,0 +1,55 @@
+import sys
+import os
+import subprocess
+from pathlib import Path
+from time import time
+
+import pytest
+
+SRC = Path(__file__).resolve().parent.parent / "src"
+sys.path.insert(0,str(SRC))
+
+from fake_gcs import FakeGCS
+
+
+#-----------
+# Concurrent Setup
+#-----------
+#Several servers starting at once against a fresh bucket all find the meta missing and race to create it.
+#Only one create can win. The rest have to pick up the winner's meta instead of failing setup.
+
+SERVERS = 4
+
+#Each server waits until the same moment before calling setup, so their creates really overlap.
+SETUP = """
+import sys, time
+import main
+time.sleep(max(0,float(sys.argv[1]) - time.time()))
+ok, err = main.setup("bucket")
+print(ok, err, main.state.ids.to_meta())
+"""
+
+@pytest.fixture
+def fake():
+    server = FakeGCS(buckets=("bucket",))
+    endpoint = server.start()
+    yield server, endpoint
+    server.stop()
+
+@pytest.mark.parametrize("layout",["blob","objects","sharded"])
+def test_concurrent_setup_fresh_bucket(fake, layout, tmp_path):
+    server, endpoint = fake
+    env = dict(os.environ,GCS_ENDPOINT=endpoint,STORAGE_SOURCE="online",ONLINE_LAYOUT=layout,SEARCH_INDEX="0",
+               LOCAL=str(tmp_path / "notes.json"),PYTHONPATH=os.pathsep.join(filter(None,[str(SRC),os.environ.get("PYTHONPATH")])))
+    start = time() + 2
+
+    processes = [subprocess.Popen([sys.executable,"-c",SETUP,str(start)],cwd=tmp_path,env=env,
+                                  stdout=subprocess.PIPE,stderr=subprocess.PIPE,text=True) for _ in range(SERVERS)]
+
+    for process in processes:
+        out, err = process.communicate(timeout=60)
+        assert process.returncode == 0, err
+        assert out.strip().splitlines()[-1] == "True None {'id_count': 0, 'free_ids': []}", out + err
+
+    #One meta object, created once.
+    assert "notes-meta.json" in server.bucket("bucket")